@@ -0,0 +1,392 @@
+__author__ = 'James Dozier'
+
+import Terraria
+import WorldGen
+import argparse
+import io
+import json
+import math
+import numpy
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+
+# World sizes in tiles, the small, medium and large worlds of the game.
+SIZES = {
+    'small': (1750, 900),
+    'medium': (4200, 1200),
+    'large': (8400, 2400),
+}
+
+# Generation passes that build a benchmark world, in order, as the WorldGenerator method and its arguments.
+PASSES = (
+    ('fill_dirt', ()),
+    ('surface_terrain', ()),
+    ('carve_caves', ()),
+    ('spawn_ore', (7, 1)),  # Copper
+    ('spawn_ore', (6, 1)),  # Iron
+    ('spawn_ore', (9, 1)),  # Silver
+    ('spawn_ore', (8, 1)),  # Gold
+    ('pour_liquids', (8, 0.05)),  # Water
+    ('pour_liquids', (16, 0.01)),  # Lava
+)
+
+
+def new_world(x_tiles, y_tiles):
+    """
+    Returns an empty World of (x_tiles) by (y_tiles) with the surface and rock layer at the depths of the game.
+    :param x_tiles:
+    :param y_tiles:
+    :return: world
+    :return type: Terraria.World
+    """
+    world = Terraria.World()
+    world.header.x_tiles = x_tiles
+    world.header.y_tiles = y_tiles
+    world.header.surface_level = int(y_tiles * 0.25)
+    world.header.rock_layer = int(y_tiles * 0.35)
+    world.map = Terraria.Map(world.tile_importance, x_tiles, y_tiles)
+
+    return world
+
+
+def generate_world(world, seed=0, timer=None):
+    """
+    Runs PASSES on (world) to give it a realistic mix of tiles: terrain, caves, ores and liquids, then adds a few
+    chests and signs. (timer), if given, is called with the name of every pass and a function that runs it.
+    :param world:
+    :param seed:
+    :param timer:
+    :return: world
+    """
+    generator = WorldGen.WorldGenerator(world, seed)
+
+    for name, args in PASSES:
+        run = getattr(generator, name)
+        if timer is None:
+            run(*args)
+        else:
+            timer(name, lambda: run(*args))
+
+    for i in range(0, 20):
+        x = (i * 211) % (world.header.x_tiles - 2)
+        generator.add_chest(x, int(world.header.surface_level) - 2)
+        generator.add_sign(x + 1, int(world.header.surface_level) - 4, 'Sign %i' % i)
+
+    return world
+
+
+def measure(function, memory=False):
+    """
+    Runs (function) once and returns the seconds it took and its peak traced memory in bytes, or None for the memory
+    unless (memory) is set. Tracing slows most code down, so timings taken with (memory) are not comparable.
+    :param function:
+    :param memory:
+    :return: seconds, peak memory, result of function
+    """
+    if memory:
+        tracemalloc.start()
+
+    try:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+
+    return seconds, peak, result
+
+
+def benchmark_size(name, x_tiles, y_tiles, repeat=3, memory=True):
+    """
+    Benchmarks every generation pass, World.save_world, World.load_world and Map.validate on a world of (x_tiles) by
+    (y_tiles). Each is timed (repeat) times and, with (memory), run once more under tracemalloc for its peak memory.
+    :param name:
+    :param x_tiles:
+    :param y_tiles:
+    :param repeat:
+    :param memory:
+    :return: list of results, one per operation
+    """
+    tiles = x_tiles * y_tiles
+    samples = {}
+    peaks = {}
+    sizes = {}
+    order = []
+
+    def run(operation, function, i):
+        seconds, peak, result = measure(function, i == repeat)
+
+        if operation not in samples:
+            samples[operation] = [0.0] * repeat
+            order.append(operation)
+        if i == repeat:
+            peaks[operation] = max(peak, peaks.get(operation, 0))
+        else:
+            samples[operation][i] += seconds
+
+        return result
+
+    # Passes that run more than once, like spawn_ore, are timed together. The last run traces memory.
+    for i in range(0, repeat + (1 if memory else 0)):
+        world = new_world(x_tiles, y_tiles)
+        generate_world(world, timer=lambda operation, function: run(operation, function, i))
+
+        f = io.BytesIO()
+        run('save_world', lambda: world.save_world(f), i)
+        data = f.getvalue()
+        sizes['save_world'] = sizes['load_world'] = len(data)
+
+        loaded = Terraria.World()
+        run('load_world', lambda: loaded.load_world(io.BytesIO(data)), i)
+        run('validate', loaded.map.validate, i)
+
+    results = []
+    for operation in order:
+        seconds = min(samples[operation])
+        result = {
+            'size': name,
+            'x_tiles': x_tiles,
+            'y_tiles': y_tiles,
+            'operation': operation,
+            'seconds': seconds,
+            'samples': samples[operation],
+            'tiles_per_second': tiles / seconds if seconds else None,
+            'bytes': sizes.get(operation),
+            'megabytes_per_second': sizes[operation] / seconds / 1e6 if operation in sizes and seconds else None,
+            'peak_memory': peaks.get(operation),
+        }
+        results.append(result)
+
+    return results
+
+
+def run_benchmarks(sizes=None, repeat=3, memory=True, label=None):
+    """
+    Benchmarks worlds of every size in (sizes), a dict of size name to (x_tiles, y_tiles), all of SIZES if None.
+    :param sizes:
+    :param repeat:
+    :param memory:
+    :param label: name of the run, like a version or commit, to tell result files apart
+    :return: report, ready for json
+    """
+    if sizes is None:
+        sizes = SIZES
+
+    results = []
+    for name, (x_tiles, y_tiles) in sizes.items():
+        results.extend(benchmark_size(name, x_tiles, y_tiles, repeat, memory))
+
+    return new_report(results, repeat, label)
+
+
+def new_report(results, repeat, label=None):
+    """
+    Returns a report of (results) with what is needed to tell runs apart: (label), the time and the Python, NumPy and
+    platform versions.
+    :param results:
+    :param repeat:
+    :param label:
+    :return: report, ready for json
+    """
+    return {
+        'label': label,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def mann_whitney_u(a, b):
+    """
+    Returns the two sided p value of the Mann-Whitney U test that samples (a) and (b) come from the same distribution,
+    from the normal approximation with a correction for ties. It makes no assumption about the shape of the timings,
+    but needs a handful of samples on each side: with 3 and 3 the p value is never below 0.05.
+    :param a:
+    :param b:
+    :return: p value
+    """
+    n_a = len(a)
+    n_b = len(b)
+    if n_a == 0 or n_b == 0:
+        return 1.0
+
+    values = sorted([(value, 0) for value in a] + [(value, 1) for value in b])
+
+    # Average ranks over runs of tied values.
+    rank_sum = 0.0
+    ties = 0.0
+    i = 0
+    while i < len(values):
+        j = i
+        while j < len(values) and values[j][0] == values[i][0]:
+            j += 1
+        rank = (i + j + 1) / 2.0
+        rank_sum += rank * sum(1 for value in values[i:j] if value[1] == 0)
+        ties += (j - i) ** 3 - (j - i)
+        i = j
+
+    n = n_a + n_b
+    u = rank_sum - n_a * (n_a + 1) / 2.0
+    variance = n_a * n_b / 12.0 * ((n + 1) - ties / (n * (n - 1))) if n > 1 else 0.0
+    if variance <= 0:
+        return 1.0
+
+    z = (abs(u - n_a * n_b / 2.0) - 0.5) / math.sqrt(variance)
+
+    return min(1.0, 2 * (1 - statistics.NormalDist().cdf(max(z, 0.0))))
+
+
+def compare_reports(old, new, alpha=0.01, threshold=0.05, baseline=None):
+    """
+    Compares the results that reports (old) and (new) have in common, matched by size and operation. A result is a
+    regression if its median time grew by more than (threshold), as a fraction, and mann_whitney_u gives a p value
+    below (alpha), so noise within the runs is not reported. A machine that is faster or slower as a whole between
+    the runs shifts every result, with (baseline), the name of an operation in both reports, all times are divided by
+    the median time of that operation in their report first.
+    :param old:
+    :param new:
+    :param alpha:
+    :param threshold:
+    :param baseline:
+    :return: list of comparisons, one per result
+    """
+    old_results = {(result.get('size'), result['operation']): result for result in old['results']}
+    new_results = {(result.get('size'), result['operation']): result for result in new['results']}
+
+    old_scale = 1.0
+    new_scale = 1.0
+    if baseline is not None:
+        if (None, baseline) not in old_results or (None, baseline) not in new_results:
+            raise KeyError('Both reports need the baseline operation: %s' % baseline)
+
+        old_scale = statistics.median(old_results[(None, baseline)]['samples'])
+        new_scale = statistics.median(new_results[(None, baseline)]['samples'])
+
+    comparisons = []
+    for result in new['results']:
+        key = (result.get('size'), result['operation'])
+        if key not in old_results or key == (None, baseline):
+            continue
+
+        old_samples = [sample / old_scale for sample in old_results[key]['samples']]
+        new_samples = [sample / new_scale for sample in result['samples']]
+        old_median = statistics.median(old_samples)
+        new_median = statistics.median(new_samples)
+
+        change = new_median / old_median - 1 if old_median else 0.0
+        p_value = mann_whitney_u(old_samples, new_samples)
+        significant = p_value < alpha and abs(change) > threshold
+
+        comparisons.append({
+            'size': key[0],
+            'operation': key[1],
+            'old': old_median,
+            'new': new_median,
+            'change': change,
+            'p_value': p_value,
+            'regression': significant and change > 0,
+            'improvement': significant and change < 0,
+        })
+
+    return comparisons
+
+
+def print_comparisons(comparisons, file=sys.stdout):
+    """
+    Prints (comparisons), as returned by compare_reports, as a table.
+    :param comparisons:
+    :param file:
+    :return:
+    """
+    for comparison in comparisons:
+        if comparison['regression']:
+            verdict = 'REGRESSION'
+        elif comparison['improvement']:
+            verdict = 'improvement'
+        else:
+            verdict = ''
+
+        name = comparison['operation'] if comparison['size'] is None else \
+            '%s %s' % (comparison['size'], comparison['operation'])
+        print('%-40s %12.6g %12.6g %+8.1f%% p=%.4f %s' % (name, comparison['old'], comparison['new'],
+                                                             100 * comparison['change'], comparison['p_value'],
+                                                             verdict), file=file)
+
+
+def main(args=None):
+    """
+    Runs the benchmarks from the command line and writes the report as JSON, or compares two reports. Exits with 1 if
+    the comparison finds a regression.
+    :param args:
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks loading, saving and generating worlds.')
+    parser.add_argument('sizes', nargs='*', help='world sizes to benchmark: %s, all of them if none are given' %
+                        ', '.join(SIZES))
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timed runs of every operation')
+    parser.add_argument('-o', '--output', help='file to write the JSON report to, standard output if not given')
+    parser.add_argument('-l', '--label', help='name of the run, like a version or commit')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run for peak memory')
+    parser.add_argument('-c', '--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON reports, of these benchmarks or of Microbenchmarks, instead')
+    parser.add_argument('--alpha', type=float, default=0.01, help='significance level of a comparison')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='smallest change in median time, as a fraction, that a comparison reports')
+    parser.add_argument('--normalize', metavar='OPERATION',
+                        help='divide the times of a comparison by those of this operation, like baseline')
+    args = parser.parse_args(args)
+
+    if args.compare:
+        reports = []
+        for name in args.compare:
+            with open(name) as f:
+                reports.append(json.load(f))
+
+        comparisons = compare_reports(reports[0], reports[1], args.alpha, args.threshold, args.normalize)
+        print_comparisons(comparisons)
+
+        if any(comparison['regression'] for comparison in comparisons):
+            sys.exit(1)
+        return
+
+    for name in args.sizes:
+        if name not in SIZES:
+            parser.error('unknown size: %s' % name)
+
+    sizes = {name: SIZES[name] for name in args.sizes} if args.sizes else None
+    report = run_benchmarks(sizes, args.repeat, not args.no_memory, args.label)
+
+    write_report(report, args.output)
+
+    for result in report['results']:
+        print('%-7s %-16s %9.4f s %14.0f tiles/s' % (result['size'], result['operation'], result['seconds'],
+                                                      result['tiles_per_second'] or 0), file=sys.stderr)
+
+
+def write_report(report, output=None):
+    """
+    Writes (report) as JSON to file (output), or to standard output if None.
+    :param report:
+    :param output:
+    :return:
+    """
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+__author__ = 'James Dozier'
+
+import Benchmarks
+import Terraria
+import argparse
+import io
+import sys
+import time
+import timeit
+
+
+def new_tile(**fields):
+    """
+    Returns a Tile with (fields) set.
+    :param fields:
+    :return: tile
+    :return type: Tile
+    """
+    tile = Terraria.Tile()
+    for name, value in fields.items():
+        setattr(tile, name, value)
+
+    return tile
+
+
+# Tiles that cover the header combinations of the tile format, by name, with the RLE count they are encoded with.
+HEADER_COMBINATIONS = {
+    'empty': (new_tile(), 0),
+    'dirt': (new_tile(active=True, tile_type=0), 0),
+    'dirt rle': (new_tile(active=True, tile_type=0), 64),
+    'dirt long rle': (new_tile(active=True, tile_type=0), 1000),
+    'framed': (new_tile(active=True, tile_type=28, u=18, v=108), 0),
+    'wide type': (new_tile(active=True, tile_type=300), 0),
+    'wall': (new_tile(wall=5), 0),
+    'liquid': (new_tile(liquid_type=8, liquid_amount=255), 0),
+    'wired': (new_tile(active=True, tile_type=0, wire_red=True, wire_blue=True, brick_style=1), 0),
+    'painted': (new_tile(active=True, tile_type=1, color=3, wall=2, wall_color=4), 0),
+    'actuator': (new_tile(active=True, tile_type=0, actuator=True, actuator_inactive=True), 0),
+    'everything': (new_tile(active=True, tile_type=300, u=18, v=18, color=3, wall=2, wall_color=4, liquid_type=16,
+                            liquid_amount=128, wire_red=True, wire_green=True, brick_style=2, actuator=True), 1000),
+}
+
+
+def microbenchmarks():
+    """
+    Returns the microbenchmarks of the codec primitives, as a list of names and functions that take no arguments.
+    :return:
+    """
+    tile_importance = Terraria.World().tile_importance
+
+    # Plain Python work that the codecs never change, for Benchmarks.compare_reports to normalize by.
+    numbers = list(range(0, 1000))
+    benchmarks = [('baseline', lambda: sum(numbers))]
+
+    for name, (tile, rle) in HEADER_COMBINATIONS.items():
+        # The RLE count is not part of what parse_tile_record reads.
+        record = tile.generate_bytestring(0, tile_importance)
+
+        benchmarks.append(('generate_bytestring %s' % name,
+                           lambda tile=tile, rle=rle: tile.generate_bytestring(rle, tile_importance)))
+        benchmarks.append(('parse_tile_record %s' % name,
+                           lambda record=record: Terraria.parse_tile_record(record, tile_importance)))
+
+    name = 'Default World Name'
+    pstring = Terraria.store_pstring(name)
+    benchmarks.append(('store_pstring', lambda: Terraria.store_pstring(name)))
+    benchmarks.append(('get_pstring', lambda: Terraria.get_pstring(io.BytesIO(pstring))))
+
+    tile = HEADER_COMBINATIONS['everything'][0]
+    clone = tile.clone()
+    other = HEADER_COMBINATIONS['framed'][0]
+    benchmarks.append(('Tile.__eq__ equal', lambda: tile == clone))
+    benchmarks.append(('Tile.__eq__ different', lambda: tile == other))
+    benchmarks.append(('Tile.clone', tile.clone))
+
+    flags = Terraria.pack_tile_importance(tile_importance)
+    benchmarks.append(('pack_tile_importance', lambda: Terraria.pack_tile_importance(tile_importance)))
+    benchmarks.append(('unpack_tile_importance',
+                       lambda: Terraria.unpack_tile_importance(flags, len(tile_importance))))
+
+    return benchmarks
+
+
+def calibrate(function, warmup=0.1):
+    """
+    Runs (function) untimed for (warmup) seconds, then returns how often to call it per time so one time takes about a
+    hundredth of a second, long enough that short functions are not lost to timer overhead.
+    :param function:
+    :param warmup:
+    :return: calls per time
+    """
+    deadline = time.perf_counter() + warmup
+    while time.perf_counter() < deadline:
+        function()
+
+    number, seconds = timeit.Timer(function).autorange()
+
+    # autorange settles on at least 0.2 s, a twentieth of that keeps the times short.
+    return max(1, number // 20)
+
+
+def run_microbenchmarks(names=None, repeat=20, warmup=0.1, label=None):
+    """
+    Runs the microbenchmarks whose names start with any of (names), all of them if None. Each is timed (repeat) times
+    after a warmup, see calibrate. The times go round the benchmarks, so a slow spell on the machine spreads over all
+    of them instead of shifting one, which keeps the samples of a benchmark independent enough to compare.
+    :param names:
+    :param repeat:
+    :param warmup:
+    :param label: name of the run, like a version or commit, to tell result files apart
+    :return: report, ready for json, see Benchmarks.new_report
+    """
+    benchmarks = [(name, timeit.Timer(function), calibrate(function, warmup)) for name, function in microbenchmarks()
+                  if not names or any(name.startswith(prefix) for prefix in names)]
+
+    samples = [[] for benchmark in benchmarks]
+    for i in range(0, repeat):
+        for (name, timer, number), times in zip(benchmarks, samples):
+            times.append(timer.timeit(number) / number)
+
+    results = []
+    for (name, timer, number), times in zip(benchmarks, samples):
+        results.append({
+            'operation': name,
+            'seconds': min(times),
+            'samples': times,
+            'calls': number,
+        })
+
+    return Benchmarks.new_report(results, repeat, label)
+
+
+def main(args=None):
+    """
+    Runs the microbenchmarks from the command line and writes the report as JSON. Benchmarks.py --compare compares
+    two of them, with --normalize baseline if they ran at different times.
+    :param args:
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the tile and string codecs.')
+    parser.add_argument('names', nargs='*', help='run only the benchmarks whose names start with these')
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='timed runs of every benchmark')
+    parser.add_argument('-w', '--warmup', type=float, default=0.1, help='seconds to run every benchmark untimed')
+    parser.add_argument('-o', '--output', help='file to write the JSON report to, standard output if not given')
+    parser.add_argument('-l', '--label', help='name of the run, like a version or commit')
+    args = parser.parse_args(args)
+
+    report = run_microbenchmarks(args.names, args.repeat, args.warmup, args.label)
+
+    Benchmarks.write_report(report, args.output)
+
+    for result in report['results']:
+        print('%-40s %10.3f us' % (result['operation'], result['seconds'] * 1e6), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
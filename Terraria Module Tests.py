@@ -1,6 +1,16 @@
 __author__ = 'James Dozier'
 
+import gc
+import io
+import json
+import numpy
+import os
+import tempfile
+import time
+import tracemalloc
 import unittest
+import Benchmarks
+import Microbenchmarks
 import Terraria
 import WorldGen
 import random
@@ -88,6 +98,11 @@ class TSculpt_Tests(unittest.TestCase):
 
         self.assertEqual(tile.generate_bytestring(0, tile_importance), b'\x22\x00\x01')
 
+        #Tile ID 255 still fits in one byte
+        tile.tile_type = 255
+
+        self.assertEqual(tile.generate_bytestring(0, tile_importance), b'\x02\xff')
+
         #Actuator Tile
         tile = Terraria.Tile()
 
@@ -130,6 +145,632 @@ class TSculpt_Tests(unittest.TestCase):
         self.assertEqual(clone, tile)
         self.assertTrue(clone == tile)
 
+    def test_tile_state(self):
+        """
+        Test interned, immutable tile states
+        :return:
+        """
+        dirt = Terraria.TileState(active=True, tile_type=0)
+
+        self.assertIs(dirt, Terraria.TileState(tile_type=0, active=True))
+        self.assertIs(dirt, dirt.clone())
+        self.assertRaises(AttributeError, setattr, dirt, 'tile_type', 1)
+        self.assertRaises(TypeError, Terraria.TileState, tile=1)
+
+        tile = dirt.thaw()
+        self.assertEqual(tile, dirt)
+        self.assertEqual(dirt, tile)
+        self.assertIs(tile.freeze(), dirt)
+
+        #Copy on write
+        stone = dirt.replace(tile_type=1)
+        self.assertIsNot(stone, dirt)
+        self.assertEqual(dirt.tile_type, 0)
+        self.assertIs(stone, Terraria.TileState(active=True, tile_type=1))
+
+        self.assertEqual(Terraria.TileState().generate_bytestring(0, Terraria.World().tile_importance),
+                         Terraria.Tile().generate_bytestring(0, Terraria.World().tile_importance))
+
+        map = Terraria.Map(Terraria.World().tile_importance, 4, 4)
+        map.map[1][2] = stone
+        self.assertEqual(map.map[1][2], stone)
+        self.assertIs(map.map[1][2].freeze(), stone)
+        self.assertIs(map.map[0][0].freeze(), Terraria.TileState())
+
+        #States nothing refers to any more leave the intern table once they are not among the recent ones
+        row = Terraria.TileState(active=True, tile_type=2, u=36, v=54).row
+        self.assertIn(row, Terraria.TileState.interned)
+        for u in range(0, Terraria.TileState.recent_size):
+            Terraria.TileState(active=True, tile_type=3, u=u)
+        gc.collect()
+        self.assertNotIn(row, Terraria.TileState.interned)
+        self.assertEqual(len(Terraria.TileState.recent), Terraria.TileState.recent_size)
+        self.assertIn(stone.row, Terraria.TileState.interned)
+        self.assertIs(Terraria.TileState.from_row(row), Terraria.TileState(active=True, tile_type=2, u=36, v=54))
+
+    def test_columnar_map(self):
+        """
+        Test that the columnar tile store behaves like a nested list of Tiles
+        :return:
+        """
+        map = Terraria.Map(Terraria.World().tile_importance, 10, 20)
+
+        self.assertEqual(len(map.map), 10)
+        self.assertEqual(len(map.map[0]), 20)
+        self.assertEqual(map.map[3][4], Terraria.Tile())
+        self.assertRaises(IndexError, map.map.__getitem__, 10)
+        self.assertRaises(IndexError, map.map[0].__getitem__, 20)
+
+        tile = Terraria.Tile()
+        tile.active = True
+        tile.tile_type = 28
+        tile.u = 18
+        tile.v = 108
+        tile.wall = 5
+
+        map.map[3][4] = tile
+        self.assertEqual(map.map[3][4], tile)
+        self.assertEqual(map.map[3][4].clone(), tile)
+        self.assertIsNone(map.map[3][4].color)
+
+        #Writes through a view land in the store
+        map.map[3][5].liquid_type = 8
+        map.map[3][5].liquid_amount = 255
+        self.assertEqual(map.map[3][5].liquid_amount, 255)
+
+        self.assertTrue(map.validate())
+        map.map[0][0].active = True
+        self.assertFalse(map.validate())
+
+        map.map.clear()
+        self.assertEqual(map.map[3][4], Terraria.Tile())
+
+    def test_palette_map(self):
+        """
+        Test that the palette tile store behaves like the columnar one
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        map = Terraria.Map(tile_importance, 10, 20, Terraria.PaletteTileStore)
+        columnar = Terraria.Map(tile_importance, 10, 20)
+
+        self.assertEqual(map.map.ids.dtype.itemsize, 2)
+        self.assertEqual(map.map[3][4], Terraria.Tile())
+
+        dirt = Terraria.TileState(active=True, tile_type=0)
+        chest = Terraria.TileState(active=True, tile_type=21, u=18, v=0)
+        for x in range(0, 10):
+            for y in range(10, 20):
+                map.map[x][y] = dirt
+                columnar.map[x][y] = dirt
+        map.map[3][4] = chest
+        columnar.map[3][4] = chest
+        map.map[3][5].wall = 2
+        columnar.map[3][5].wall = 2
+
+        self.assertEqual(map.map[3][4], chest)
+        self.assertEqual(map.map[3][5].wall, 2)
+        self.assertEqual(len(map.map.palette), 4)
+        self.assertEqual(map.generate_bytestring(), columnar.generate_bytestring())
+        self.assertEqual(map.tile_type_counts().tolist(), columnar.tile_type_counts().tolist())
+        self.assertEqual(map.tile_type_counts()[0], 100)
+
+        #Decoding into a palette store gives the same tiles
+        loaded = Terraria.Map(tile_importance, 0, 0, Terraria.PaletteTileStore)
+        loaded.load_map(io.BytesIO(columnar.generate_bytestring()), 0, 10, 20, tile_importance)
+        self.assertIsInstance(loaded.map, Terraria.PaletteTileStore)
+        for x in range(0, 10):
+            for y in range(0, 20):
+                self.assertEqual(loaded.map[x][y], columnar.map[x][y])
+
+        #Unused states are dropped when the palette is compacted
+        map.map[3][4] = dirt
+        map.map.compact()
+        self.assertEqual(len(map.map.palette), 3)
+        self.assertEqual(map.map[3][4], dirt)
+
+        #A batch of new states that fills the palette compacts it before any of them gets an id
+        max_palette = Terraria.PaletteTileStore.max_palette
+        Terraria.PaletteTileStore.max_palette = 4
+        try:
+            store = Terraria.PaletteTileStore(2, 2)
+            store.set_state(0, 0, dirt)
+            store.set_state(0, 0, chest)
+            store.set_state(0, 0, Terraria.TileState())
+            stone = Terraria.TileState(active=True, tile_type=1)
+            wood = Terraria.TileState(active=True, tile_type=30)
+            store.write_runs(0, 2, [stone, wood], [0, 1], [2, 2])
+            self.assertEqual(store.palette, [Terraria.TileState(), stone, wood])
+            self.assertEqual([store.get_state(x, y) for x in range(0, 2) for y in range(0, 2)],
+                             [stone, stone, wood, wood])
+
+            store.set_region(0, 0, [dirt, Terraria.TileState()], numpy.array([[0, 1], [1, 0]]))
+            self.assertEqual([store.get_state(x, y) for x in range(0, 2) for y in range(0, 2)],
+                             [dirt, Terraria.TileState(), Terraria.TileState(), dirt])
+        finally:
+            Terraria.PaletteTileStore.max_palette = max_palette
+
+        self.assertTrue(map.validate())
+        map.map[0][0].active = True
+        self.assertFalse(map.validate())
+
+        map.map.clear()
+        self.assertEqual(map.map[3][4], Terraria.Tile())
+
+    def test_chunked_map(self):
+        """
+        Test that the chunked tile store only expands chunks that are written to
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        map = Terraria.Map(tile_importance, 150, 130, Terraria.ChunkedTileStore)
+        columnar = Terraria.Map(tile_importance, 150, 130)
+
+        self.assertEqual(map.map.uniform.shape, (3, 3))
+        self.assertEqual(map.map.dense, {})
+
+        #Rewriting what a uniform chunk holds keeps it uniform
+        map.map[10][10] = Terraria.Tile()
+        self.assertEqual(map.map.dense, {})
+
+        states = [Terraria.TileState(active=True, tile_type=tile_type) for tile_type in range(0, 4)]
+        random.seed(5)
+        for i in range(0, 500):
+            x = random.randrange(0, 150)
+            y = random.randrange(64, 130)
+            state = random.choice(states)
+            map.map[x][y] = state
+            columnar.map[x][y] = state
+
+        self.assertEqual((map.map.uniform[:, 0] >= 0).tolist(), [True, True, True])
+        for x in range(0, 150, 7):
+            for y in range(0, 130, 3):
+                self.assertEqual(map.map[x][y], columnar.map[x][y])
+        self.assertEqual(map.generate_bytestring(), columnar.generate_bytestring())
+        self.assertEqual(map.tile_type_counts().tolist(), columnar.tile_type_counts().tolist())
+
+        #Decoding stores chunks that hold a single state as uniform chunks
+        columnar.map.clear()
+        for x in range(0, 150):
+            for y in range(70, 130):
+                columnar.map[x][y] = states[1]
+        data = columnar.generate_bytestring()
+
+        loaded = Terraria.Map(tile_importance, 0, 0, Terraria.ChunkedTileStore)
+        loaded.load_map(io.BytesIO(data), 0, 150, 130, tile_importance)
+        self.assertEqual(sorted(loaded.map.dense), [(0, 1), (1, 1), (2, 1)])
+        self.assertEqual(loaded.map.uniform[:, 2].tolist(), [1, 1, 1])
+        self.assertEqual(loaded.generate_bytestring(), data)
+
+        loaded.map.collapse()
+        self.assertEqual(len(loaded.map.dense), 3)
+        self.assertTrue(loaded.validate())
+
+    def test_run_length_map(self):
+        """
+        Test that the run-length tile store splits and merges runs on writes
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        map = Terraria.Map(tile_importance, 20, 130, Terraria.RunLengthTileStore)
+        columnar = Terraria.Map(tile_importance, 20, 130)
+
+        dirt = Terraria.TileState(active=True, tile_type=0)
+        map.map[0][50] = dirt
+        self.assertEqual(map.map.starts[0], [0, 50, 51])
+        map.map[0][51] = dirt
+        self.assertEqual(map.map.starts[0], [0, 50, 52])
+        map.map[0][50] = Terraria.Tile()
+        map.map[0][51] = Terraria.Tile()
+        self.assertEqual(map.map.starts[0], [0])
+        self.assertEqual(map.map.states[0], [Terraria.TileState()])
+
+        states = [Terraria.TileState(), dirt, Terraria.TileState(active=True, tile_type=1, wall=2)]
+        random.seed(7)
+        for i in range(0, 2000):
+            x = random.randrange(0, 20)
+            y = random.randrange(0, 130)
+            state = random.choice(states)
+            map.map[x][y] = state
+            columnar.map[x][y] = state
+
+        for x in range(0, 20):
+            for y in range(0, 130):
+                self.assertEqual(map.map[x][y], columnar.map[x][y])
+            self.assertEqual(map.map.starts[x], sorted(set(map.map.starts[x])))
+            for above, below in zip(map.map.states[x], map.map.states[x][1:]):
+                self.assertIsNot(above, below)
+        self.assertEqual(map.generate_bytestring(), columnar.generate_bytestring())
+        self.assertEqual(map.tile_type_counts().tolist(), columnar.tile_type_counts().tolist())
+
+        #Decoding keeps the runs of the file
+        data = columnar.generate_bytestring()
+        loaded = Terraria.Map(tile_importance, 0, 0, Terraria.RunLengthTileStore)
+        loaded.load_map(io.BytesIO(data), 0, 20, 130, tile_importance)
+        self.assertEqual(loaded.map.starts, map.map.starts)
+        self.assertEqual(loaded.generate_bytestring(), data)
+
+    def test_map_regions(self):
+        """
+        Test the bulk region operations on every tile store
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        dirt = Terraria.TileState(active=True, tile_type=0)
+        stone = Terraria.TileState(active=True, tile_type=1)
+        mossy = Terraria.TileState(active=True, tile_type=1, wall=2)
+
+        mask = [[True, False, True], [False, True, False]]
+
+        maps = []
+        for store_type in [None, Terraria.PaletteTileStore, Terraria.ChunkedTileStore, Terraria.RunLengthTileStore]:
+            map = Terraria.Map(tile_importance, 100, 80, store_type)
+
+            map.fill_rect(-5, 70, 10, 200, dirt)
+            map.fill_rect(20, 30, 30, 40, stone)
+            map.map[25][35] = mossy
+            map.apply_mask(mask, 98, 0, stone)
+            map.replace_type(0, 25, 0, 80, 1, 0)
+            map.copy_region(15, 35, 25, 45, 70, 60)
+            map.copy_region(-10, 5, 0, 20, 50, -5)
+
+            self.assertEqual(map.map[0][9], Terraria.Tile())
+            self.assertEqual(map.map[0][79], dirt)
+            self.assertEqual(map.map[69][10], dirt)
+            self.assertEqual(map.map[70][10], Terraria.Tile())
+            self.assertEqual(map.map[24][35], dirt)
+            self.assertEqual(map.map[25][35], mossy)
+            self.assertEqual(map.map[26][35], stone)
+            self.assertEqual(map.map[98][0], stone)
+            self.assertEqual(map.map[98][1], Terraria.Tile())
+            self.assertEqual(map.map[99][1], stone)
+            self.assertEqual(map.map[80][70], mossy)
+            self.assertEqual(map.map[79][70], dirt)
+            self.assertEqual(map.map[90][70], Terraria.Tile())
+            self.assertEqual(map.map[60][4], Terraria.Tile())
+            self.assertEqual(map.map[60][5], dirt)
+            self.assertEqual(map.map[64][5], dirt)
+            self.assertEqual(map.map[65][5], Terraria.Tile())
+
+            maps.append(map.generate_bytestring())
+
+        self.assertEqual(maps, [maps[0]] * 4)
+
+    def test_map_round_trip(self):
+        """
+        Test that a map decodes back to the tiles it was encoded from
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        map = Terraria.Map(tile_importance, 6, 300)
+
+        tiles = [Terraria.Tile() for i in range(0, 6)]
+        tiles[1].active = True
+        tiles[1].tile_type = 0
+        tiles[2].active = True
+        tiles[2].tile_type = 5
+        tiles[2].u = 18
+        tiles[2].v = 36
+        tiles[2].color = 3
+        tiles[3].wall = 2
+        tiles[3].wall_color = 4
+        tiles[3].liquid_type = 16
+        tiles[3].liquid_amount = 128
+        tiles[4].active = True
+        tiles[4].tile_type = 256
+        tiles[4].wire_red = True
+        tiles[4].wire_blue = True
+        tiles[4].actuator = True
+        tiles[4].actuator_inactive = True
+        tiles[5].active = True
+        tiles[5].tile_type = 1
+        tiles[5].brick_style = 2
+        tiles[5].wire_green = True
+
+        random.seed(3)
+        for x in range(0, 6):
+            y = 0
+            while y < 300:
+                tile = random.choice(tiles)
+                for i in range(0, random.choice([1, 2, 5, 200, 280])):
+                    if y < 300:
+                        map.map[x][y] = tile
+                    y += 1
+
+        #Encoder matches Tile.generate_bytestring run by run
+        expected = b''
+        for x in range(0, 6):
+            y = 0
+            while y < 300:
+                tile = map.map[x][y].clone()
+                rle = 0
+                while y + rle + 1 < 300 and map.map[x][y + rle + 1] == tile:
+                    rle += 1
+                expected += tile.generate_bytestring(rle, tile_importance)
+                y += rle + 1
+
+        self.assertEqual(map.generate_bytestring(), expected)
+
+        #Encoding in worker processes over shared memory gives the same bytes
+        self.assertEqual(map.generate_bytestring(processes=2), expected)
+        self.assertIsNotNone(map.map.shared_memory)
+        self.assertEqual(map.generate_bytestring(), expected)
+
+        data = b'pad' + map.generate_bytestring() + b'rest'
+
+        loaded = Terraria.Map(tile_importance, 1, 1)
+        f = io.BytesIO(data)
+        loaded.load_map(f, 3, 6, 300, tile_importance, len(data) - 7)
+
+        self.assertEqual(f.tell(), len(data) - 4)
+        for x in range(0, 6):
+            for y in range(0, 300):
+                self.assertEqual(loaded.map[x][y], map.map[x][y])
+
+        #Parallel decoding gives the same map, even for maps that would normally be decoded serially
+        threshold = Terraria.Map.parallel_threshold
+        Terraria.Map.parallel_threshold = 0
+        try:
+            parallel = Terraria.Map(tile_importance, 1, 1)
+            f = io.BytesIO(data)
+            parallel.load_map(f, 3, 6, 300, tile_importance, len(data) - 7, processes=2)
+        finally:
+            Terraria.Map.parallel_threshold = threshold
+
+        self.assertEqual(f.tell(), len(data) - 4)
+        self.assertIsNotNone(parallel.map.shared_memory)
+        for name in Terraria.TILE_FIELD_NAMES:
+            self.assertEqual(parallel.map.fields[name].tolist(), loaded.map.fields[name].tolist())
+
+        f = io.BytesIO(data[:len(data) // 2])
+        self.assertRaises(Terraria.WorldFormatException, loaded.load_map, f, 3, 6, 300, tile_importance)
+
+    def test_lazy_world(self):
+        """
+        Test that a lazily loaded world only decodes the sections that are used
+        :return:
+        """
+        world = Terraria.World()
+        world.header.x_tiles = 20
+        world.header.y_tiles = 30
+        world.map = Terraria.Map(world.tile_importance, 20, 30)
+        world.map.map[5][6].active = True
+        world.map.map[5][6].tile_type = 0
+        world.change_name('Lazy')
+
+        f = io.BytesIO()
+        world.save_world(f)
+        data = f.getvalue()
+
+        #Back-patched section pointers line up with the sections
+        eager = Terraria.World()
+        eager.load_world(io.BytesIO(data))
+        self.assertEqual(eager.section_pointers[6:], (0, 0, 0, 0))
+
+        lazy = Terraria.World()
+        lazy.load_world(io.BytesIO(data), lazy=True)
+
+        self.assertEqual(lazy.header.world_name, 'Lazy')
+        self.assertEqual(lazy.footer.title, 'Lazy')
+        self.assertNotIn('map', lazy.__dict__)
+        self.assertNotIn('chests', lazy.__dict__)
+
+        self.assertEqual(lazy.map.map[5][6].tile_type, 0)
+
+        lazy.load_all()
+        self.assertIsNone(lazy.source)
+
+        f = io.BytesIO()
+        lazy.save_world(f)
+        self.assertEqual(f.getvalue(), data)
+
+    def test_instrumentation(self):
+        """
+        Test that instrumentation records every section of a load and save and every generation pass
+        :return:
+        """
+        instrumentation = Terraria.Instrumentation()
+
+        world = Terraria.World()
+        world.header.x_tiles = 300
+        world.map = Terraria.Map(world.tile_importance, 300, 1200)
+        worldgen = WorldGen.WorldGenerator(world, 6, instrumentation)
+        worldgen.fill_dirt()
+        worldgen.spawn_ore(7, 1, x_start=100)
+        worldgen.add_chest(10, 200)
+
+        f = io.BytesIO()
+        world.save_world(f, instrumentation=instrumentation)
+        data = f.getvalue()
+
+        lazy = Terraria.World()
+        lazy.load_world(io.BytesIO(data), lazy=True, instrumentation=instrumentation)
+        lazy.map
+
+        records = instrumentation.records
+        self.assertEqual([(record['kind'], record['name']) for record in records],
+                         [('generate', 'fill_dirt'), ('generate', 'spawn_ore')] +
+                         [('save', name) for name in Terraria.World.sections] + [('load', 'header'), ('load', 'map')])
+
+        self.assertEqual(records[0]['counts'], {'tiles': 300 * 1200})
+        self.assertEqual(records[1]['counts'], {'tiles': 200 * 1200})
+
+        saves = records[2:8]
+        self.assertEqual([record['bytes'] for record in saves],
+                         [b - a for a, b in zip(lazy.section_pointers[:6], lazy.section_pointers[1:6] + (len(data),))])
+        self.assertEqual(saves[1]['counts'], {'tiles': 300 * 1200, 'runs': world.map.count_runs()})
+        self.assertEqual(saves[2]['counts'], {'chests': 1})
+        self.assertEqual(records[9]['bytes'], saves[1]['bytes'])
+        self.assertEqual(records[9]['counts'], saves[1]['counts'])
+
+        report = json.loads(json.dumps(instrumentation.report()))
+        self.assertEqual(report['totals']['save']['bytes'], len(data) - lazy.section_pointers[0])
+        self.assertTrue(all(record['seconds'] >= 0 for record in report['records']))
+
+        #Without instrumentation nothing is recorded
+        Terraria.World().load_world(io.BytesIO(data))
+        self.assertEqual(len(instrumentation.records), 10)
+
+    def test_memory_report(self):
+        """
+        Test that the memory report accounts for every section and store
+        :return:
+        """
+        world = Terraria.World()
+        world.header.x_tiles = 200
+        world.header.y_tiles = 300
+        world.map = Terraria.Map(world.tile_importance, 200, 300)
+        worldgen = WorldGen.WorldGenerator(world, 7)
+        worldgen.fill_dirt()
+        worldgen.add_chest(10, 200)
+        worldgen.add_sign(20, 200, 'x' * 200)
+
+        f = io.BytesIO()
+        world.save_world(f)
+        data = f.getvalue()
+
+        report = world.memory_report()
+        self.assertEqual(sorted(report['sections']), sorted(Terraria.World.sections))
+        self.assertEqual(report['sections']['map'],
+                         {'tile fields': sum(field.nbytes for field in world.map.map.fields.values())})
+        self.assertGreater(report['sections']['signs']['strings'], 200)
+        self.assertGreater(report['sections']['chests']['lists'], 0)
+        self.assertEqual(report['total'], sum(report['totals'].values()))
+
+        for store_type, parts in [(Terraria.PaletteTileStore, ['palette', 'tile ids']),
+                                  (Terraria.ChunkedTileStore, ['dense chunks', 'palette', 'uniform chunks']),
+                                  (Terraria.RunLengthTileStore, ['run starts', 'run states'])]:
+            loaded = Terraria.World()
+            loaded.store_type = store_type
+            loaded.load_world(io.BytesIO(data), lazy=True, keep_source=True)
+            loaded.map
+
+            usage = loaded.memory_report()['sections']['map']
+            self.assertEqual(sorted(usage), sorted(parts + ['dirty columns', 'source', 'source offsets']))
+            self.assertEqual(usage['source'], loaded.section_pointers[2] - loaded.section_pointers[1])
+            self.assertEqual(sorted(loaded.memory_report()['sections']), ['header', 'map'])
+
+        #Snapshots trace only while recording
+        instrumentation = Terraria.Instrumentation(snapshots=True, top=2)
+        with instrumentation.record('generate', 'test') as record:
+            numbers = list(range(0, 100000))
+
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreater(record['traced_bytes'], 100000)
+        self.assertGreaterEqual(record['traced_peak'], record['traced_bytes'])
+        self.assertEqual(len(record['allocations']), 2)
+        self.assertGreater(record['allocations'][0]['bytes'], 100000)
+
+    def test_dirty_columns(self):
+        """
+        Test that only columns written to after loading are encoded again
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        dirt = Terraria.Tile()
+        dirt.active = True
+        dirt.tile_type = 0
+
+        #Every column holds two runs of dirt, which encoding would merge into one
+        column = dirt.generate_bytestring(9, tile_importance) + dirt.generate_bytestring(9, tile_importance)
+        data = column * 4
+
+        for store_type in [None, Terraria.PaletteTileStore, Terraria.ChunkedTileStore, Terraria.RunLengthTileStore]:
+            map = Terraria.Map(tile_importance, 0, 0, store_type)
+            map.keep_source = True
+            map.load_map(io.BytesIO(data), 0, 4, 20, tile_importance)
+
+            self.assertEqual(map.map.dirty.tolist(), [False] * 4)
+            self.assertEqual(map.generate_bytestring(), data)
+
+            map.map[2][3].wall = 1
+            map.map[1][19] = Terraria.Tile()
+            self.assertEqual(map.map.dirty.tolist(), [False, True, True, False])
+
+            #Clean columns are views of the loaded bytes, not copies
+            clean = next(map.encode_columns(0, 4))
+            self.assertIsInstance(clean, memoryview)
+            self.assertIs(clean.obj, map.source)
+            self.assertEqual(clean.tobytes(), column)
+
+            air = dirt.generate_bytestring(18, tile_importance) + \
+                Terraria.Tile().generate_bytestring(0, tile_importance)
+            wall = dirt.generate_bytestring(2, tile_importance) + \
+                map.map[2][3].generate_bytestring(0, tile_importance) + dirt.generate_bytestring(15, tile_importance)
+            self.assertEqual(map.generate_bytestring(), column + air + wall + column)
+
+        #Maps only keep their bytes when asked to
+        map = Terraria.Map(tile_importance, 0, 0)
+        map.load_map(io.BytesIO(data), 0, 4, 20, tile_importance)
+
+        self.assertIsNone(map.source)
+        self.assertIsNone(map.map.dirty)
+        self.assertEqual(map.generate_bytestring(), dirt.generate_bytestring(19, tile_importance) * 4)
+
+        world = Terraria.World()
+        world.header.x_tiles = 4
+        world.header.y_tiles = 20
+        world.map = map
+        f = io.BytesIO()
+        world.save_world(f)
+
+        for keep_source in [False, True]:
+            loaded = Terraria.World()
+            loaded.load_world(io.BytesIO(f.getvalue()), keep_source=keep_source)
+            self.assertEqual(loaded.map.source is not None, keep_source)
+            self.assertEqual(loaded.map.map.dirty is not None, keep_source)
+
+    def test_column_index(self):
+        """
+        Test decoding a range of columns through a column index and its sidecar file
+        :return:
+        """
+        world = Terraria.World()
+        world.header.x_tiles = 40
+        world.header.y_tiles = 50
+        world.map = Terraria.Map(world.tile_importance, 40, 50)
+        for x in range(0, 40):
+            for y in range(x, 50):
+                world.map.map[x][y].active = True
+                world.map.map[x][y].tile_type = x % 3
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.wld')
+            with open(path, 'wb') as f:
+                world.save_world(f)
+
+            column_index = Terraria.ColumnIndex.for_world_file(path)
+            self.assertEqual(column_index.x_tiles, 40)
+            self.assertTrue(os.path.exists(path + '.colidx'))
+            self.assertEqual(Terraria.ColumnIndex.load(path + '.colidx').offsets.tolist(),
+                             column_index.offsets.tolist())
+
+            with open(path, 'rb') as f:
+                lazy = Terraria.World()
+                lazy.load_world(f, lazy=True)
+                region = lazy.load_map_region(10, 15, column_index)
+
+            self.assertEqual(region.x_tiles, 5)
+            self.assertEqual(region.x_offset, 10)
+            for x in range(0, 5):
+                for y in range(0, 50):
+                    self.assertEqual(region.map[x][y], world.map.map[x + 10][y])
+
+            #A changed world file rebuilds its sidecar
+            world.map.map[0][0].active = True
+            world.map.map[0][0].tile_type = 1
+            with open(path, 'wb') as f:
+                world.save_world(f)
+
+            rebuilt = Terraria.ColumnIndex.for_world_file(path)
+            self.assertNotEqual(rebuilt.fingerprint, column_index.fingerprint)
+            self.assertEqual(Terraria.ColumnIndex.load(path + '.colidx').fingerprint, rebuilt.fingerprint)
+
+            #Verifying checks the sha1 of the whole file and records it
+            verified = Terraria.ColumnIndex.for_world_file(path, verify=True)
+            self.assertEqual(verified.file_hash, Terraria.ColumnIndex.hash_file(path))
+            self.assertEqual(Terraria.ColumnIndex.for_world_file(path, verify=True).file_hash, verified.file_hash)
+
     def test_world_generation(self):
         """
         Test the World generation script
@@ -148,5 +789,311 @@ class TSculpt_Tests(unittest.TestCase):
         test_x = random.randint(0, 4200)
         self.assertTrue(world.map.map[test_x][test_y].tile_type == 0)
 
+        #The underworld is the bottom rows of worlds of every size
+        self.assertEqual(worldgen.underworld_level(), 1000)
+        world.header.y_tiles = 2400
+        self.assertEqual(worldgen.underworld_level(), 2200)
+
+    def test_stencils(self):
+        """
+        Test that structures are stamped from cached stencils and clipped to the map
+        :return:
+        """
+        world = Terraria.World()
+        world.header.x_tiles = 50
+        world.header.y_tiles = 40
+        world.map = Terraria.Map(world.tile_importance, 50, 40)
+        worldgen = WorldGen.WorldGenerator(world)
+
+        self.assertIs(WorldGen.frame_stencil(21, 612, 0), WorldGen.frame_stencil(21, 612, 0))
+        self.assertRaises(ValueError, WorldGen.frame_stencil(21, 612, 0).ids.fill, 0)
+
+        worldgen.add_chest(10, 20)
+        self.assertEqual(world.map.map[10][20], Terraria.TileState(active=True, tile_type=21, u=612, v=0))
+        self.assertEqual(world.map.map[11][20], Terraria.TileState(active=True, tile_type=21, u=630, v=0))
+        self.assertEqual(world.map.map[10][21], Terraria.TileState(active=True, tile_type=21, u=612, v=18))
+        self.assertEqual(world.map.map[11][21], Terraria.TileState(active=True, tile_type=21, u=630, v=18))
+        self.assertEqual(world.chests.total_chests, 1)
+
+        sign = worldgen.add_sign(49, 39, 'Edge', 85)
+        self.assertEqual(sign.text, 'Edge')
+        self.assertEqual(world.map.map[49][39], Terraria.TileState(active=True, tile_type=85, u=180, v=0))
+        self.assertEqual(world.signs.total_signs, 1)
+
+        stone = Terraria.TileState(active=True, tile_type=1)
+        worldgen.stamp(WorldGen.Stencil([stone], numpy.zeros((3, 3)), numpy.eye(3)), -1, -1)
+        self.assertEqual(world.map.map[0][0], stone)
+        self.assertEqual(world.map.map[1][1], stone)
+        self.assertEqual(world.map.map[0][1], Terraria.Tile())
+        self.assertEqual(world.map.map[2][2], Terraria.Tile())
+
+    def test_spawn_ore(self):
+        """
+        Test that ore spawning is reproducible from the seed and keeps to the ore band
+        :return:
+        """
+        maps = []
+        for seed in [1, 1, 2]:
+            world = Terraria.World()
+            world.header.x_tiles = 200
+            world.map = Terraria.Map(world.tile_importance, 200, 1200)
+
+            WorldGen.WorldGenerator(world, seed).spawn_ore(7, 1)
+            maps.append(world.map)
+
+        self.assertEqual(maps[0].generate_bytestring(), maps[1].generate_bytestring())
+        self.assertNotEqual(maps[0].generate_bytestring(), maps[2].generate_bytestring())
+
+        ore = maps[0].map.fields['tile_type'] == 7
+        self.assertEqual(maps[0].tile_type_counts().tolist(), [0] * 7 + [ore.sum()])
+        self.assertFalse(ore[:, :250].any())
+        self.assertFalse(ore[:, 1060:].any())
+
+        #Deeper rows start more clusters, as with ore_spawn_chance
+        self.assertGreater(ore[:, 800:1000].sum(), ore[:, 300:500].sum())
+        self.assertEqual(WorldGen.WorldGenerator.ore_spawn_chance(numpy.array([0, 375, 750]), 1, 750).tolist(),
+                         [0, 0.005, 0.01])
+        self.assertFalse(WorldGen.WorldGenerator.should_spawn_ore(0, 1, 750))
+        self.assertTrue(WorldGen.WorldGenerator.should_spawn_ore(750, 100, 750, numpy.random.default_rng(1)))
+
+        #Any split of the columns between calls spawns the same ore
+        world = Terraria.World()
+        world.header.x_tiles = 600
+        world.map = Terraria.Map(world.tile_importance, 600, 1200)
+        worldgen = WorldGen.WorldGenerator(world, 1)
+        worldgen.spawn_ore(7, 1, 0, 200)
+        worldgen.spawn_ore(7, 1, 450, 600)
+        worldgen.spawn_ore(7, 1, 200, 450)
+
+        whole = Terraria.World()
+        whole.header.x_tiles = 600
+        whole.map = Terraria.Map(whole.tile_importance, 600, 1200)
+        WorldGen.WorldGenerator(whole, 1).spawn_ore(7, 1)
+
+        self.assertEqual(world.map.generate_bytestring(), whole.map.generate_bytestring())
+
+        #Streams only depend on the seed, pass and strip
+        self.assertEqual(worldgen.stream('caves', 3).random(),
+                         WorldGen.WorldGenerator(world, 1).stream('caves', 3).random())
+        self.assertNotEqual(worldgen.stream('caves', 3).random(), worldgen.stream('caves', 4).random())
+        self.assertNotEqual(worldgen.stream('caves', 3).random(), worldgen.stream('ore', 3).random())
+
+        #Clusters are laid out like add_ore_cluster, over a run of rows below the cluster position
+        world = Terraria.World()
+        mask, left, top = WorldGen.WorldGenerator(world, 3).ore_cluster_mask(numpy.array([100]), numpy.array([500]),
+                                                                              numpy.array([40]))
+        self.assertTrue(500 <= top and top + mask.shape[1] <= 540)
+        self.assertTrue(0 < mask.sum() <= 40 * 40)
+        self.assertTrue(mask.any(axis=0).all())
+
+        #Single clusters share the cached layout and give the same tiles
+        self.assertIs(WorldGen.ore_cluster_rows(15, 25), WorldGen.ore_cluster_rows(15, 25))
+        self.assertRaises(ValueError, WorldGen.ore_cluster_rows(15, 25)[1].fill, 0)
+
+        world.header.x_tiles = 200
+        world.header.y_tiles = 600
+        world.map = Terraria.Map(world.tile_importance, 200, 600)
+        WorldGen.WorldGenerator(world, 3).add_ore_cluster(100, 500, 40, Terraria.TileState(active=True, tile_type=7))
+        ore = world.map.map.fields['tile_type'] == 7
+        self.assertEqual(ore[left:left + mask.shape[0], top:top + mask.shape[1]].tolist(), mask.tolist())
+        self.assertEqual(ore.sum(), mask.sum())
+
+    def test_surface_terrain(self):
+        """
+        Test that the terrain pass layers air, dirt and stone under a noisy surface
+        :return:
+        """
+        noise = WorldGen.value_noise(numpy.arange(0, 5000), 9, 256, 5)
+        self.assertTrue((noise >= -1).all() and (noise <= 1).all())
+        self.assertEqual(noise[1000:1100].tolist(), WorldGen.value_noise(numpy.arange(1000, 1100), 9, 256, 5).tolist())
+        self.assertGreater(noise.std(), 0.05)
+
+        maps = []
+        for strips in [[(0, 700)], [(0, 123), (123, 700)]]:
+            world = Terraria.World()
+            world.header.x_tiles = 700
+            world.map = Terraria.Map(world.tile_importance, 700, 1200)
+            worldgen = WorldGen.WorldGenerator(world, 8)
+            worldgen.fill_dirt()
+
+            surface = numpy.concatenate([worldgen.surface_terrain(x_start=x_start, x_end=x_end)
+                                         for x_start, x_end in strips])
+            maps.append(world.map.generate_bytestring())
+
+        self.assertEqual(maps[0], maps[1])
+        self.assertTrue((abs(surface - 300) <= 40).all())
+        self.assertGreater(len(set(surface.tolist())), 1)
+
+        for x in [0, 350, 699]:
+            self.assertEqual(world.map.map[x][int(surface[x]) - 1], Terraria.Tile())
+            self.assertEqual(world.map.map[x][int(surface[x])].tile_type, 0)
+            self.assertEqual(world.map.map[x][999].tile_type, 1)
+            self.assertEqual(world.map.map[x][1000], Terraria.Tile())
+
+    def test_carve_caves(self):
+        """
+        Test that the cave pass carves smoothed caves into the rock layer
+        :return:
+        """
+        maps = []
+        for strips in [[(0, 600)], [(0, 300), (300, 301), (301, 600)]]:
+            world = Terraria.World()
+            world.header.x_tiles = 600
+            world.map = Terraria.Map(world.tile_importance, 600, 1200)
+            worldgen = WorldGen.WorldGenerator(world, 2)
+            worldgen.fill_dirt()
+
+            caves = numpy.concatenate([worldgen.carve_caves(x_start=x_start, x_end=x_end)
+                                       for x_start, x_end in strips])
+            maps.append(world.map.generate_bytestring())
+
+        self.assertEqual(maps[0], maps[1])
+        self.assertEqual(caves.shape, (600, 550))
+        self.assertTrue(0.1 < caves.mean() < 0.5)
+
+        active = world.map.map.fields['active']
+        self.assertEqual(active[:, 450:1000].tolist(), (~caves).tolist())
+        self.assertTrue(active[:, 300:450].all())
+
+        #Smoothing leaves few lone open tiles
+        padded = numpy.pad(caves, 1)
+        neighbours = sum(numpy.roll(numpy.roll(padded, i, 0), j, 1) for i in [-1, 0, 1] for j in [-1, 0, 1]) - padded
+        self.assertLess((caves & (neighbours[1:-1, 1:-1] == 0)).sum(), caves.sum() / 100)
+
+    def test_liquids(self):
+        """
+        Test that liquid falls to the bottom of a basin and levels out, and that the pass pours it into the caves
+        :return:
+        """
+        open_tiles = numpy.zeros((12, 8), dtype=bool)
+        open_tiles[1:11, 0:7] = True
+        amount = numpy.zeros((12, 8), dtype=numpy.int16)
+        amount[2, 0:3] = 255
+
+        self.assertEqual(WorldGen.settle_liquid(amount.copy(), open_tiles, max_iterations=3), 3)
+        iterations = WorldGen.settle_liquid(amount, open_tiles, threshold=3)
+        self.assertLess(iterations, 1000)
+        self.assertEqual(amount.sum(), 3 * 255)
+        self.assertFalse(amount[:, 0:6].any())
+        self.assertLess(numpy.abs(numpy.diff(amount[1:11, 6])).max(), 3)
+        self.assertEqual(WorldGen.settle_liquid(amount, open_tiles), 1)
+
+        maps = []
+        for max_iterations in [1000, 1000, 0]:
+            world = Terraria.World()
+            world.header.x_tiles = 300
+            world.map = Terraria.Map(world.tile_importance, 300, 1200)
+            worldgen = WorldGen.WorldGenerator(world, 5)
+            worldgen.fill_dirt()
+            caves = worldgen.carve_caves()
+
+            self.assertLess(worldgen.pour_liquids(16, max_iterations=max_iterations), 1000)
+            maps.append(world.map.generate_bytestring())
+
+        self.assertEqual(maps[0], maps[1])
+        self.assertNotEqual(maps[0], maps[2])
+
+        liquid = world.map.map.fields['liquid_amount'][:, 450:1000]
+        self.assertTrue(((liquid > 0) <= caves).all())
+        self.assertTrue((liquid[liquid > 0] == 255).all())
+        self.assertTrue((world.map.map.fields['liquid_type'][:, 450:1000][liquid > 0] == 16).all())
+
+    def test_generation_pipeline(self):
+        """
+        Test that the pipeline generates the same world in worker processes as in one process
+        :return:
+        """
+        maps = []
+        for processes in [None, 2]:
+            world = Terraria.World()
+            world.header.x_tiles = 900
+            world.map = Terraria.Map(world.tile_importance, 900, 1200)
+
+            pipeline = WorldGen.GenerationPipeline(WorldGen.WorldGenerator(world, 4), processes)
+            pipeline.add_stage('fill_dirt')
+            ore = pipeline.add_stage('spawn_ore', 7, 1)
+            self.assertRaises(TypeError, pipeline.add_stage, 'fill_dirt', width=3)
+            pipeline.run()
+
+            maps.append(world.map.generate_bytestring())
+
+        self.assertEqual(maps[0], maps[1])
+
+        #Strips that run at the same time are more than two margins apart
+        even, odd = pipeline.strips(ore)
+        self.assertEqual(even, [(0, 256), (512, 768)])
+        self.assertEqual(odd, [(256, 512), (768, 900)])
+
+        ore.margin = 200
+        self.assertEqual(pipeline.strips(ore), ([(0, 512)], [(512, 900)]))
+
+        #Stages take the margin their pass declares unless given one
+        self.assertEqual(WorldGen.Stage('spawn_ore').margin, WorldGen.WorldGenerator.ore_margin)
+        self.assertEqual(WorldGen.Stage('fill_dirt').margin, 0)
+        self.assertIsNone(WorldGen.Stage('pour_liquids').margin)
+        self.assertIsNone(WorldGen.Stage('add_chest').margin)
+        self.assertEqual(WorldGen.Stage('spawn_ore', margin=0).margin, 0)
+
+    def test_benchmarks(self):
+        """
+        Test that the benchmark suite times every operation and reports as JSON
+        :return:
+        """
+        report = Benchmarks.run_benchmarks({'tiny': (300, 1200)}, repeat=2, label='test')
+        report = json.loads(json.dumps(report))
+
+        operations = [result['operation'] for result in report['results']]
+        self.assertEqual(operations, ['fill_dirt', 'surface_terrain', 'carve_caves', 'spawn_ore', 'pour_liquids',
+                                      'save_world', 'load_world', 'validate'])
+        self.assertEqual(report['label'], 'test')
+
+        for result in report['results']:
+            self.assertEqual(len(result['samples']), 2)
+            self.assertEqual(result['seconds'], min(result['samples']))
+            self.assertGreater(result['peak_memory'], 0)
+
+        save = report['results'][5]
+        self.assertGreater(save['bytes'], 0)
+        self.assertAlmostEqual(save['megabytes_per_second'], save['bytes'] / save['seconds'] / 1e6)
+        self.assertAlmostEqual(save['tiles_per_second'], 300 * 1200 / save['seconds'])
+
+    def test_microbenchmarks(self):
+        """
+        Test the codec microbenchmarks and the comparison of two reports
+        :return:
+        """
+        tile_importance = Terraria.World().tile_importance
+        flags = Terraria.pack_tile_importance(tile_importance)
+        self.assertEqual(len(flags), 43)
+        self.assertEqual(Terraria.unpack_tile_importance(flags, 340), tile_importance)
+
+        report = Microbenchmarks.run_microbenchmarks(['baseline', 'Tile.clone'], repeat=3, warmup=0)
+        self.assertEqual([result['operation'] for result in report['results']], ['baseline', 'Tile.clone'])
+        self.assertEqual(len(report['results'][1]['samples']), 3)
+
+        #The warmup runs before autorange, which takes at least 0.2 s of its own
+        start = time.perf_counter()
+        Microbenchmarks.calibrate(lambda: None, warmup=0.1)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.3)
+
+        self.assertLess(Benchmarks.mann_whitney_u(list(range(0, 10)), list(range(20, 30))), 0.001)
+        self.assertEqual(Benchmarks.mann_whitney_u([1, 1, 1], [1, 1, 1]), 1.0)
+
+        #The same times on a machine twice as slow are no regression once normalized
+        old = {'results': [{'operation': 'baseline', 'samples': [1.0 + i / 100 for i in range(0, 20)]},
+                           {'operation': 'codec', 'samples': [2.0 + i / 100 for i in range(0, 20)]},
+                           {'operation': 'string', 'samples': [3.0 + i / 100 for i in range(0, 20)]}]}
+        new = {'results': [{'operation': 'baseline', 'samples': [2.0 + i / 50 for i in range(0, 20)]},
+                           {'operation': 'codec', 'samples': [4.0 + i / 50 for i in range(0, 20)]},
+                           {'operation': 'string', 'samples': [9.0 + i / 50 for i in range(0, 20)]}]}
+
+        comparisons = Benchmarks.compare_reports(old, new)
+        self.assertEqual([comparison['regression'] for comparison in comparisons], [True, True, True])
+
+        comparisons = Benchmarks.compare_reports(old, new, baseline='baseline')
+        self.assertEqual([comparison['operation'] for comparison in comparisons], ['codec', 'string'])
+        self.assertEqual([comparison['regression'] for comparison in comparisons], [False, True])
+        self.assertAlmostEqual(comparisons[1]['change'], 0.5, 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
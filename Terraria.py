@@ -1,6 +1,41 @@
 __author__ = 'James Dozier'
 
 from struct import *
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import bisect
+import collections
+import contextlib
+import hashlib
+import numpy
+import os
+import sys
+import time
+import tracemalloc
+import weakref
+
+# Columnar layout of a Tile. Each field is stored as a fixed-width array of (dtype) with (default) for new tiles.
+# Fields that may be None on a Tile are stored as -1. A tile's stored values in this order make up its row.
+TILE_FIELDS = (
+    ('active', numpy.bool_, False),
+    ('tile_type', numpy.int16, -1),
+    ('u', numpy.int16, -1),
+    ('v', numpy.int16, -1),
+    ('color', numpy.int16, -1),
+    ('wall', numpy.int16, -1),
+    ('wall_color', numpy.int16, -1),
+    ('liquid_type', numpy.uint8, 0),
+    ('liquid_amount', numpy.int16, -1),
+    ('wire_red', numpy.bool_, False),
+    ('wire_blue', numpy.bool_, False),
+    ('wire_green', numpy.bool_, False),
+    ('brick_style', numpy.uint8, 0),
+    ('actuator', numpy.bool_, False),
+    ('actuator_inactive', numpy.bool_, False),
+)
+TILE_FIELD_NAMES = tuple(field[0] for field in TILE_FIELDS)
+BOOL_TILE_FIELDS = frozenset(field[0] for field in TILE_FIELDS if field[1] is numpy.bool_)
+NULLABLE_TILE_FIELDS = frozenset(('tile_type', 'color', 'wall', 'wall_color', 'liquid_amount'))
 
 
 def get_pstring(f):
@@ -30,12 +65,649 @@ def store_pstring(string):
     return length_byte + string_bytes
 
 
+_int16 = Struct('<h')
+
+
+def unpack_tile_importance(data, count):
+    """
+    Returns the first (count) tile importance flags packed in (data), eight to a byte, lowest bit first.
+    :param data:
+    :param count:
+    :return: list of flags
+    """
+    tile_importance = []
+    mask = 0x80
+    flags = 0
+    byte = 0
+    for i in range(0, count):
+        if mask == 0x80:
+            mask = 0x01
+            flags = data[byte]
+            byte += 1
+        else:
+            mask <<= 1
+
+        if flags & mask != 0:
+            tile_importance.append(True)
+        else:
+            tile_importance.append(False)
+
+    return tile_importance
+
+
+def pack_tile_importance(tile_importance):
+    """
+    Returns the flags of (tile_importance) packed eight to a byte, lowest bit first, as save_world writes them. The
+    last byte is always written, even when it is empty.
+    :param tile_importance:
+    :return:
+    """
+    mask = 0x01
+    byte = 0
+    byte_list = []
+    for tile in tile_importance:
+        if tile:
+            byte |= mask
+
+        if mask == 0x80:
+            byte_list.append(pack('<B', byte))
+            mask = 0x01
+            byte = 0
+            continue
+        mask <<= 1
+
+    byte_list.append(pack('<B', byte))
+
+    return b''.join(byte_list)
+
+
+def decode_tile_runs(data, offset, x_tiles, y_tiles, tile_importance, column_offsets=None):
+    """
+    Decodes (x_tiles) columns of (y_tiles) RLE tile records from (data) starting at (offset). Every distinct tile
+    record is parsed once, repeats are only counted. The result is a list of distinct TileStates, a state id and
+    length for every run, and the offset after the last column. The offset of every column is appended to the list
+    (column_offsets) if given.
+    :param data:
+    :param offset:
+    :param x_tiles:
+    :param y_tiles:
+    :param tile_importance:
+    :param column_offsets:
+    :return: states, run_ids, run_lengths, offset
+    """
+
+    states = []
+    state_ids = {}
+    records = {}
+    run_ids = []
+    run_lengths = []
+
+    # Local names for the per-run hot loop.
+    find_record = records.get
+    add_run_id = run_ids.append
+    add_run_length = run_lengths.append
+    unpack_int16 = _int16.unpack_from
+
+    try:
+        for x in range(0, x_tiles):
+            if column_offsets is not None:
+                column_offsets.append(offset)
+
+            y = 0
+            while y < y_tiles:
+                start = offset
+                header_1 = data[offset]
+                header_3 = 0
+                offset += 1
+
+                if header_1 & 1:
+                    header_2 = data[offset]
+                    offset += 1
+
+                    if header_2 & 1:
+                        header_3 = data[offset]
+                        offset += 1
+
+                if header_1 & 2:
+                    if header_1 & 32:
+                        tile_type = data[offset] | (data[offset + 1] << 8)
+                        offset += 2
+                    else:
+                        tile_type = data[offset]
+                        offset += 1
+
+                    if tile_importance[tile_type]:
+                        offset += 4
+
+                    if header_3 & 8:
+                        offset += 1
+
+                if header_1 & 4:
+                    offset += 1
+
+                    if header_3 & 16:
+                        offset += 1
+
+                if header_1 & 24:
+                    offset += 1
+
+                record = data[start:offset]
+                state_id = find_record(record)
+                if state_id is None:
+                    state = TileState.from_row(parse_tile_record(record, tile_importance))
+                    state_id = state_ids.get(state)
+                    if state_id is None:
+                        state_id = len(states)
+                        state_ids[state] = state_id
+                        states.append(state)
+                    records[record] = state_id
+
+                if header_1 < 64:
+                    length = 1
+                elif header_1 < 128:
+                    length = data[offset] + 1
+                    offset += 1
+                else:
+                    length = unpack_int16(data, offset)[0] + 1
+                    offset += 2
+
+                    if length < 1:
+                        length = 1
+
+                if length > y_tiles - y:
+                    length = y_tiles - y
+
+                add_run_id(state_id)
+                add_run_length(length)
+                y += length
+    except (IndexError, error):
+        raise WorldFormatException('Map data ended early or holds an unknown tile type at offset %i.' % offset)
+
+    return states, run_ids, run_lengths, offset
+
+
+def scan_tile_columns(data, offset, x_tiles, y_tiles, tile_importance):
+    """
+    Walks only the headers and RLE counts of (x_tiles) columns of tile records in (data) starting at (offset),
+    without decoding any tile. Returns the offset of every column in (data) followed by the offset after the last one.
+    :param data:
+    :param offset:
+    :param x_tiles:
+    :param y_tiles:
+    :param tile_importance:
+    :return: column offsets
+    :return type: numpy.ndarray
+    """
+
+    offsets = numpy.empty(x_tiles + 1, dtype=numpy.int64)
+    unpack_int16 = _int16.unpack_from
+
+    try:
+        for x in range(0, x_tiles):
+            offsets[x] = offset
+            y = 0
+            while y < y_tiles:
+                header_1 = data[offset]
+                header_3 = 0
+                offset += 1
+
+                if header_1 & 1:
+                    header_2 = data[offset]
+                    offset += 1
+
+                    if header_2 & 1:
+                        header_3 = data[offset]
+                        offset += 1
+
+                if header_1 & 2:
+                    if header_1 & 32:
+                        tile_type = data[offset] | (data[offset + 1] << 8)
+                        offset += 2
+                    else:
+                        tile_type = data[offset]
+                        offset += 1
+
+                    if tile_importance[tile_type]:
+                        offset += 4
+
+                    if header_3 & 8:
+                        offset += 1
+
+                if header_1 & 4:
+                    offset += 1
+
+                    if header_3 & 16:
+                        offset += 1
+
+                if header_1 & 24:
+                    offset += 1
+
+                if header_1 < 64:
+                    y += 1
+                elif header_1 < 128:
+                    y += data[offset] + 1
+                    offset += 1
+                else:
+                    y += max(unpack_int16(data, offset)[0], 0) + 1
+                    offset += 2
+    except (IndexError, error):
+        raise WorldFormatException('Map data ended early or holds an unknown tile type at offset %i.' % offset)
+
+    if offset > len(data):
+        raise WorldFormatException('Map data ended early at offset %i.' % offset)
+
+    offsets[x_tiles] = offset
+
+    return offsets
+
+
+def parse_tile_record(record, tile_importance):
+    """
+    Parses a single tile record (without its RLE count) into a row, one value per TILE_FIELDS entry with None stored
+    as -1.
+    :param record:
+    :param tile_importance:
+    :return: row
+    :return type: tuple
+    """
+
+    header_1 = record[0]
+    header_2 = 0
+    header_3 = 0
+    index = 1
+
+    if header_1 & 1 == 1:
+        header_2 = record[index]
+        index += 1
+
+        if header_2 & 1 == 1:
+            header_3 = record[index]
+            index += 1
+
+    active = False
+    tile_type = -1
+    u = -1
+    v = -1
+    color = -1
+    wall = -1
+    wall_color = -1
+    liquid_amount = -1
+
+    if header_1 & 2 == 2:
+        active = True
+
+        if (header_1 & 32) != 32:
+            tile_type = record[index]
+            index += 1
+        else:
+            tile_type = (record[index + 1] << 8) | record[index]
+            index += 2
+
+        if tile_importance[tile_type]:
+            u, v = unpack_from('<hh', record, index)
+            index += 4
+
+        if header_3 & 8 == 8:
+            color = record[index]
+            index += 1
+
+    if header_1 & 4 == 4:
+        wall = record[index]
+        index += 1
+
+        if header_3 & 16 == 16:
+            wall_color = record[index]
+            index += 1
+
+    liquid_type = header_1 & 24
+
+    if liquid_type != 0:
+        liquid_amount = record[index]
+
+    return (
+        active,
+        tile_type,
+        u,
+        v,
+        color,
+        wall,
+        wall_color,
+        liquid_type,
+        liquid_amount,
+        header_2 & 2 == 2,
+        header_2 & 8 == 8,
+        header_2 & 4 == 4,
+        (header_2 & 112) >> 4,
+        header_3 & 2 == 2,
+        header_3 & 4 == 4
+    )
+
+
+def unique_states(rows):
+    """
+    Groups (rows), an array with one tile row per line, into distinct TileStates. Rows are grouped by a 64 bit hash
+    and every row is checked against its group, so a hash collision falls back to exact grouping.
+    :param rows:
+    :return: states, state id of every row
+    """
+
+    keys = numpy.zeros(len(rows), dtype=numpy.uint64)
+    for i in range(0, rows.shape[1]):
+        keys *= numpy.uint64(1000003)
+        keys += rows[:, i].astype(numpy.uint64)
+
+    unique_keys, first, state_ids = numpy.unique(keys, return_index=True, return_inverse=True)
+    palette = rows[first]
+
+    if not numpy.array_equal(palette[state_ids], rows):
+        ids = {}
+        state_ids = numpy.array([ids.setdefault(row, len(ids)) for row in map(tuple, rows.tolist())],
+                                dtype=numpy.intp)
+        return [TileState.from_row(row) for row in ids], state_ids
+
+    return [TileState.from_row(tuple(row)) for row in palette.tolist()], state_ids
+
+
+def object_size(value, seen=None):
+    """
+    Returns the bytes used by (value) and everything it refers to through containers and attributes, counting every
+    object once across calls with the same (seen) set. TileStates are interned and shared by every Map, so they are
+    left out.
+    :param value:
+    :param seen: ids of the objects counted so far
+    :return:
+    """
+
+    if seen is None:
+        seen = set()
+
+    size = 0
+    pending = [value]
+    while pending:
+        value = pending.pop()
+        if id(value) in seen or isinstance(value, TileState):
+            continue
+        seen.add(id(value))
+
+        size += sys.getsizeof(value)
+
+        if isinstance(value, (list, tuple, set, frozenset)):
+            pending.extend(value)
+        elif isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif hasattr(value, '__dict__') and not isinstance(value, type):
+            pending.append(value.__dict__)
+
+    return size
+
+
+def section_memory(section):
+    """
+    Returns the bytes used by (section), a Header, Chests, Signs, NPCs or Footer, by kind of object: strings,
+    numbers, lists (like the item lists of chests) and other objects.
+    :param section:
+    :return: bytes by kind
+    """
+
+    usage = {'strings': 0, 'numbers': 0, 'lists': 0, 'objects': 0}
+    seen = set()
+
+    pending = [section]
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+
+        if isinstance(value, (str, bytes)):
+            kind = 'strings'
+        elif isinstance(value, (bool, int, float)) or value is None:
+            kind = 'numbers'
+        elif isinstance(value, (list, tuple)):
+            kind = 'lists'
+            pending.extend(value)
+        elif isinstance(value, dict):
+            kind = 'objects'
+            pending.extend(value.values())
+        else:
+            kind = 'objects'
+            if hasattr(value, '__dict__'):
+                pending.append(value.__dict__)
+
+        usage[kind] += sys.getsizeof(value)
+
+    return usage
+
+
+class TileEncoder():
+    """
+    Encodes runs of tile states into RLE tile records. The header and fields of every distinct state are laid out
+    once, the records of a whole chunk of columns are then assembled with array operations.
+    """
+
+    def __init__(self, tile_importance):
+        """
+        Initializes the Object
+        :param tile_importance:
+        :return:
+        """
+
+        self.tile_importance = tile_importance
+        self.encodings = {}
+
+    def encode_state(self, state):
+        """
+        Returns the record for TileState (state) without RLE. States are interned, so the cache lookup hashes by
+        identity.
+        :param state:
+        :return:
+        """
+
+        encoding = self.encodings.get(state)
+
+        if encoding is None:
+            encoding = state.generate_bytestring(0, self.tile_importance)
+            self.encodings[state] = encoding
+
+        return encoding
+
+    def encode_runs(self, states, run_ids, run_lengths, run_counts):
+        """
+        Yields the encoded bytes of each column, as returned by TileStore.runs: the distinct states, the
+        state id and length of every run and the number of runs in every column.
+        :param states:
+        :param run_ids:
+        :param run_lengths:
+        :param run_counts:
+        :return:
+        """
+
+        if len(run_ids) == 0:
+            for run_count in run_counts:
+                yield b''
+            return
+
+        records = [self.encode_state(state) for state in states]
+        layout = numpy.frombuffer(b''.join(records), dtype=numpy.uint8)
+        record_sizes = numpy.array([len(record) for record in records], dtype=numpy.intp)
+        record_offsets = numpy.cumsum(record_sizes) - record_sizes
+
+        run_ids = numpy.asarray(run_ids, dtype=numpy.intp)
+        rle = numpy.asarray(run_lengths, dtype=numpy.intp) - 1
+        short = (rle > 0) & (rle <= 255)
+        long = rle > 255
+
+        # Every run is its state's record followed by 0, 1 or 2 bytes of RLE count.
+        sizes = record_sizes[run_ids]
+        run_sizes = sizes + short + 2 * long
+        run_ends = numpy.cumsum(run_sizes)
+        run_starts = run_ends - run_sizes
+
+        data = numpy.empty(run_ends[-1], dtype=numpy.uint8)
+
+        position = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        data[numpy.repeat(run_starts, sizes) + position] = layout[numpy.repeat(record_offsets[run_ids], sizes) +
+                                                                  position]
+
+        data[run_starts[short]] |= 64
+        data[run_starts[long]] |= 128
+        counts = run_starts + sizes
+        data[counts[short]] = rle[short]
+        data[counts[long]] = rle[long] & 0xFF
+        data[counts[long] + 1] = rle[long] >> 8
+
+        column_ends = run_ends[numpy.cumsum(run_counts) - 1].tolist()
+        start = 0
+        for end in column_ends:
+            yield data[start:end].tobytes()
+            start = end
+
+
+class Instrumentation():
+    """
+    Records what every section of a load or save, and every generation pass, costs. Pass it to World.load_world,
+    World.save_world or WorldGen.WorldGenerator, the records are kept in self.records in the order they finish. Each
+    record has the kind ('load', 'save' or 'generate') and name of what ran, its wall time in seconds, the change in
+    allocated memory blocks, the bytes read or written if any, and counts like tiles and runs. While tracemalloc is
+    tracing, the change in traced memory is recorded as well. Leaving it out costs nothing, see measure_section.
+
+    With (snapshots) every record also takes tracemalloc snapshots before and after, tracing just for the record if
+    tracemalloc is not running already, and keeps the (top) source lines whose allocations grew the most, and the
+    traced peak when it did the tracing. Tracing slows everything down, so the times of those records run long.
+    """
+
+    def __init__(self, snapshots=False, top=10):
+        """
+        Initializes the Object
+        :param snapshots:
+        :param top:
+        :return:
+        """
+
+        self.records = []
+        self.snapshots = snapshots
+        self.top = top
+
+    @contextlib.contextmanager
+    def record(self, kind, name):
+        """
+        Context that records the block it runs as (kind) (name). It yields the record, so the block can fill in bytes
+        and counts.
+        :param kind:
+        :param name:
+        :return:
+        """
+
+        record = {'kind': kind, 'name': name, 'seconds': None, 'bytes': None, 'allocated_blocks': None,
+                  'traced_bytes': None, 'counts': {}}
+
+        started = self.snapshots and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+
+        tracing = tracemalloc.is_tracing()
+        before = tracemalloc.take_snapshot() if self.snapshots else None
+        traced = tracemalloc.get_traced_memory()[0] if tracing else 0
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['allocated_blocks'] = sys.getallocatedblocks() - blocks
+            if tracing and tracemalloc.is_tracing():
+                record['traced_bytes'] = tracemalloc.get_traced_memory()[0] - traced
+                if started:
+                    record['traced_peak'] = tracemalloc.get_traced_memory()[1] - traced
+
+                if before is not None:
+                    record['allocations'] = self.allocations(before, tracemalloc.take_snapshot())
+
+            if started:
+                tracemalloc.stop()
+
+            self.records.append(record)
+
+    def allocations(self, before, after):
+        """
+        Returns the (top) source lines whose traced memory grew the most from snapshot (before) to (after), as their
+        file, line, growth in bytes and growth in the number of blocks.
+        :param before:
+        :param after:
+        :return:
+        """
+
+        # Leaves out the snapshot taken before, which is traced too.
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        differences = after.filter_traces(ignored).compare_to(before.filter_traces(ignored), 'lineno')
+
+        return [{'file': difference.traceback[0].filename, 'line': difference.traceback[0].lineno,
+                 'bytes': difference.size_diff, 'blocks': difference.count_diff}
+                for difference in differences[:self.top]]
+
+    def report(self):
+        """
+        Returns the records and the totals of every kind, ready for json.
+        :return: report
+        """
+
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['kind'], {'seconds': 0.0, 'bytes': 0, 'allocated_blocks': 0})
+            total['seconds'] += record['seconds']
+            total['bytes'] += record['bytes'] or 0
+            total['allocated_blocks'] += record['allocated_blocks']
+
+        return {'records': self.records, 'totals': totals}
+
+
+# Reusable context that records nothing, what measure_section returns without an Instrumentation.
+_not_measured = contextlib.nullcontext()
+
+
+def measure_section(instrumentation, kind, name):
+    """
+    Returns the context recording (kind) (name) in (instrumentation), or one that records nothing and yields None if
+    (instrumentation) is None.
+    :param instrumentation:
+    :param kind:
+    :param name:
+    :return:
+    """
+
+    if instrumentation is None:
+        return _not_measured
+
+    return instrumentation.record(kind, name)
+
+
 class WorldFormatException(Exception):
     def __init__(self, msg):
         self.message = msg
         Exception.__init__(self, 'WorldFormatException: %s' % msg)
 
 
+class _LazySection():
+    """
+    World attribute for a section that is created by World.load_section on first access. The section is then stored
+    on the instance, which takes precedence over this descriptor, so later accesses are plain attribute lookups.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, world, owner):
+        if world is None:
+            return self
+
+        section = world.load_section(self.name)
+        world.__dict__[self.name] = section
+
+        return section
+
+
 class World:
     """
     World Object for Terraria.
@@ -43,6 +715,17 @@ class World:
 
     min_version = 102  # Minimum world version this application is designed to handle.
 
+    # Sections in file order, they line up with the first six section pointers.
+    sections = ('header', 'map', 'chests', 'signs', 'npcs', 'footer')
+    section_titles = ('Header', 'Map', 'Chest', 'Sign', 'NPC', 'Footer')
+
+    header = _LazySection('header')
+    map = _LazySection('map')
+    chests = _LazySection('chests')
+    signs = _LazySection('signs')
+    npcs = _LazySection('npcs')
+    footer = _LazySection('footer')
+
     def __init__(self):
         """
         Initializes the World Object.
@@ -78,17 +761,27 @@ class World:
             True, False, False, False, False, False, False, False, False, False, True, True, False, True, True, True
         ]
 
-        self.header = Header()
-        self.map = Map(self.tile_importance)
-        self.chests = Chests()
-        self.signs = Signs()
-        self.npcs = NPCs()
-        self.footer = Footer()
+        # Sections are created, or decoded from self.source, on first access. See _LazySection.
+        self.source = None
+        self.processes = None
+        self.store_type = None  # TileStore subclass for the map, see Map.
+        self.instrumentation = None  # Instrumentation that records the sections being decoded.
+        self.keep_source = False  # Whether the map keeps its encoded bytes, see Map.keep_source.
 
-    def load_world(self, f):
+    def load_world(self, f, lazy=False, processes=None, instrumentation=None, keep_source=False):
         """
-        Loads the World from file (f).
+        Loads the World from file (f). With (lazy) only the version, section pointers and tile importance are read and
+        each section is decoded from (f) on first access, so (f) has to stay open until then or until load_all is
+        called. (f) can be any seekable binary file object, including an mmap.mmap. With more than one (processes)
+        large maps are decoded by a process pool, see Map.load_map. (instrumentation), an Instrumentation, records
+        the decoding of every section, also when a lazy load decodes it later. With (keep_source) the map keeps its
+        encoded bytes, so saving only encodes the columns written to since, at the cost of holding the map section in
+        memory twice, encoded and decoded. Use it for worlds that are loaded to be edited and saved.
         :param f:
+        :param lazy:
+        :param processes:
+        :param instrumentation:
+        :param keep_source:
         :return:
         """
 
@@ -102,50 +795,160 @@ class World:
         self.section_pointers = unpack('i' * self.section_count, f.read(self.section_count * 4))
         self.tile_type_count = unpack('<h', f.read(2))[0]
 
-        self.tile_importance = []
-        mask = 0x80
-        flags = 0
-        for i in range(0, self.tile_type_count):
-            if mask == 0x80:
-                mask = 0x01
-                flags = unpack('<B', f.read(1))[0]
-            else:
-                mask <<= 1
+        self.tile_importance = unpack_tile_importance(f.read((self.tile_type_count + 7) // 8), self.tile_type_count)
+
+        self.source = f
+        self.processes = processes
+        self.instrumentation = instrumentation
+        self.keep_source = keep_source
+        for name in World.sections:
+            self.__dict__.pop(name, None)
+
+        if lazy:
+            return
+
+        for i, name in enumerate(World.sections):
+            if f.tell() != self.section_pointers[i]:
+                raise WorldFormatException('%s location off from section pointer.' % World.section_titles[i])
+
+            getattr(self, name)
+
+        self.source = None
+
+    def load_section(self, name):
+        """
+        Returns section (name) decoded from self.source, or a new empty section if no file is being loaded.
+        :param name:
+        :return: section
+        """
+
+        if self.source is None or self.instrumentation is None:
+            return self.decode_section(name)
+
+        with self.instrumentation.record('load', name) as record:
+            section = self.decode_section(name)
+            record['bytes'] = self.source.tell() - self.section_pointers[World.sections.index(name)]
+
+        record['counts'] = self.section_counts(name, section)
+
+        return section
+
+    def section_counts(self, name, section):
+        """
+        Returns what (section), the section (name), holds for an Instrumentation record: the tiles and runs of the map
+        and the number of chests, signs and NPCs.
+        :param name:
+        :param section:
+        :return: counts
+        """
+
+        if name == 'map':
+            return {'tiles': section.x_tiles * section.y_tiles, 'runs': section.count_runs()}
+        elif name in ('chests', 'signs', 'npcs'):
+            return {name: len(getattr(section, name))}
+
+        return {}
+
+    def decode_section(self, name):
+        """
+        Returns section (name) decoded from self.source, or a new empty section if no file is being loaded.
+        :param name:
+        :return: section
+        """
 
-            if flags & mask != 0:
-                self.tile_importance.append(True)
+        f = self.source
+
+        if name == 'header':
+            section = Header()
+            if f is not None:
+                section.load_header(f, self.section_pointers[0])
+        elif name == 'map':
+            if f is not None:
+                section = Map(self.tile_importance, 0, 0, self.store_type)
+                section.keep_source = self.keep_source
+                section.load_map(f, self.section_pointers[1], self.header.x_tiles, self.header.y_tiles,
+                                 self.tile_importance, self.section_pointers[2] - self.section_pointers[1],
+                                 self.processes)
             else:
-                self.tile_importance.append(False)
+                section = Map(self.tile_importance, store_type=self.store_type)
+        elif name == 'chests':
+            section = Chests()
+            if f is not None:
+                section.load_chests(f, self.section_pointers[2])
+        elif name == 'signs':
+            section = Signs()
+            if f is not None:
+                section.load_signs(f, self.section_pointers[3])
+        elif name == 'npcs':
+            section = NPCs()
+            if f is not None:
+                section.load_npcs(f, self.section_pointers[4])
+        elif name == 'footer':
+            section = Footer()
+            if f is not None:
+                section.load_footer(f, self.section_pointers[5])
+        else:
+            raise KeyError('Unknown section: %s' % name)
+
+        return section
+
+    def load_all(self):
+        """
+        Decodes every section that has not been accessed yet after a lazy load_world, then lets go of the file.
+        :return:
+        """
 
-        if f.tell() != self.section_pointers[0]:
-            raise WorldFormatException('Header location off from section pointer.')
+        for name in World.sections:
+            getattr(self, name)
 
-        self.header.load_header(f, self.section_pointers[0])
+        self.source = None
 
-        if f.tell() != self.section_pointers[1]:
-            raise WorldFormatException('Map location off from section pointer.')
+    def load_map_region(self, x_start, x_end, column_index=None):
+        """
+        Returns a Map of only columns (x_start) to (x_end) of a lazily loaded world, without decoding the rest of the
+        map. Builds a column index from the file if (column_index) is not given.
+        :param x_start:
+        :param x_end:
+        :param column_index:
+        :return: map
+        :return type: Map
+        """
 
-        self.map.load_map(f, self.section_pointers[1], self.header.x_tiles, self.header.y_tiles, self.tile_importance)
+        if self.source is None:
+            raise WorldFormatException('Map regions can only be loaded from a lazily loaded world.')
 
-        if f.tell() != self.section_pointers[2]:
-            raise WorldFormatException('Chest location off from section pointer.')
+        if column_index is None:
+            column_index = ColumnIndex.build(self.source, self.section_pointers[1], self.header.x_tiles,
+                                             self.header.y_tiles, self.tile_importance,
+                                             self.section_pointers[2] - self.section_pointers[1])
 
-        self.chests.load_chests(f, self.section_pointers[2])
+        region = Map(self.tile_importance, 0, 0, self.store_type)
+        region.load_columns(self.source, column_index, x_start, x_end, self.tile_importance)
 
-        if f.tell() != self.section_pointers[3]:
-            raise WorldFormatException('Sign location off from section pointer.')
+        return region
 
-        self.signs.load_signs(f, self.section_pointers[3])
+    def memory_report(self):
+        """
+        Returns how many bytes every decoded section uses, by part: the store, palette and kept source bytes of the
+        map (see Map.memory_usage) and the strings, numbers, lists and other objects of the other sections (see
+        section_memory). Sections a lazy load has not decoded yet are left out. Ready for json.
+        :return: report
+        """
 
-        if f.tell() != self.section_pointers[4]:
-            raise WorldFormatException('NPC location off from section pointer')
+        sections = {}
+        for name in World.sections:
+            if name not in self.__dict__:
+                continue
 
-        self.npcs.load_npcs(f, self.section_pointers[4])
+            section = self.__dict__[name]
+            if name == 'map':
+                sections[name] = section.memory_usage()
+            else:
+                sections[name] = section_memory(section)
 
-        if f.tell() != self.section_pointers[5]:
-            raise WorldFormatException('Footer location off from section pointer.')
+        totals = dict((name, sum(usage.values())) for name, usage in sections.items())
 
-        self.footer.load_footer(f, self.section_pointers[5])
+        return {'sections': sections, 'totals': totals, 'total': sum(totals.values())}
 
     def validate(self):
         """
@@ -177,78 +980,51 @@ class World:
 
         return True
 
-    def save_world(self, file):
+    def save_world(self, file, processes=None, instrumentation=None):
         """
-        Saves the World File
+        Saves the World File. Sections are written to (file) as they are encoded and the section pointers are filled in
+        at the end, so (file) has to be seekable. With more than one (processes) the map is encoded by a process pool,
+        see Map.encode_columns. (instrumentation), an Instrumentation, records the encoding of every section.
+        :param file:
+        :param processes:
+        :param instrumentation:
         :return:
         """
         version_bytes = pack('<i', 102)
         section_count_bytes = pack('<h', 10)
         tile_type_count_bytes = pack('<h', 340)
 
-        mask = 0x01
-        byte = 0
-        byte_list = []
-        for tile in self.tile_importance:
-            if tile:
-                byte |= mask
-
-            if mask == 0x80:
-                byte_list.append(pack('<B', byte))
-                mask = 0x01
-                byte = 0
-                continue
-            mask <<= 1
+        tile_imprt_bytes = pack_tile_importance(self.tile_importance)
 
-        byte_list.append(pack('<B', byte))
-
-        tile_imprt_bytes = b''.join(byte_list)
-
-        header_bytes = self.header.generate_bytestring()
-        map_bytes = self.map.generate_bytestring()
-        chest_bytes = self.chests.generate_bytestring()
-        sign_bytes = self.signs.generate_bytestring()
-        npc_bytes = self.npcs.generate_bytestring()
-        footer_bytes = self.footer.generate_bytestring()
-
-        pointer = len(version_bytes)
-        pointer += len(section_count_bytes)
-        pointer += len(tile_type_count_bytes)
-        pointer += len(tile_imprt_bytes)
-        pointer += 40
-
-        pointers = []
-        pointers.append(pointer)
-        pointer += len(header_bytes)
-        pointers.append(pointer)
-        pointer += len(map_bytes)
-        pointers.append(pointer)
-        pointer += len(chest_bytes)
-        pointers.append(pointer)
-        pointer += len(sign_bytes)
-        pointers.append(pointer)
-        pointer += len(npc_bytes)
-        pointers.append(pointer)
-        pointers.append(0)
-        pointers.append(0)
-        pointers.append(0)
-        pointers.append(0)
-
-        pointer_bytes = b''
-        for p in pointers:
-            pointer_bytes += pack('<i', p)
+        start = file.tell()
 
         file.write(version_bytes)
         file.write(section_count_bytes)
-        file.write(pointer_bytes)
+        pointer_table = file.tell()
+        file.write(b'\x00' * 40)
         file.write(tile_type_count_bytes)
         file.write(tile_imprt_bytes)
-        file.write(header_bytes)
-        file.write(map_bytes)
-        file.write(chest_bytes)
-        file.write(sign_bytes)
-        file.write(npc_bytes)
-        file.write(footer_bytes)
+
+        pointers = [0] * 10
+
+        for i, name in enumerate(World.sections):
+            section = getattr(self, name)
+            pointers[i] = file.tell() - start
+
+            with measure_section(instrumentation, 'save', name) as record:
+                if name == 'map':
+                    section.write_map(file, processes)
+                else:
+                    file.write(section.generate_bytestring())
+
+            if record is not None:
+                record['bytes'] = file.tell() - start - pointers[i]
+                record['counts'] = self.section_counts(name, section)
+
+        end = file.tell()
+        file.seek(pointer_table)
+        file.write(pack('<10i', *pointers))
+        file.seek(end)
 
     def change_name(self, name):
         """
@@ -265,9 +1041,7 @@ class World:
         """
         self.header.reset()
 
-        for x in range(0, self.map.x_tiles):
-            for y in range(0, self.map.y_tiles):
-                self.map.map[x][y] = Tile()
+        self.map.map.clear()
 
         self.chests.clear_chests()
         self.signs.clear_signs()
@@ -606,84 +1380,84 @@ class Header:
         Generates a bytestring to eventually save.
         :return:
         """
-        bstring = b''
-
-        bstring += store_pstring(self.world_name)
-        bstring += pack('<i', self.world_id)
-        bstring += pack('<i', self.x)
-        bstring += pack('<i', self.w)
-        bstring += pack('<i', self.y)
-        bstring += pack('<i', self.h)
-        bstring += pack('<i', self.y_tiles)
-        bstring += pack('<i', self.x_tiles)
-        bstring += pack('<B', self.moon_type)
-        bstring += pack('<iii', *self.tree_x)
-        bstring += pack('<iiii', *self.tree_style)
-        bstring += pack('<iii', *self.cave_back_x)
-        bstring += pack('<iiii', *self.cave_back_style)
-        bstring += pack('<i', self.ice_back_style)
-        bstring += pack('<i', self.jungle_back_style)
-        bstring += pack('<i', self.hell_back_style)
-        bstring += pack('<i', self.spawn_x)
-        bstring += pack('<i', self.spawn_y)
-        bstring += pack('<d', self.surface_level)
-        bstring += pack('<d', self.rock_layer)
-        bstring += pack('<d', self.temp_time)
-        bstring += pack('<?', self.is_day)
-        bstring += pack('<i', self.moon_phase)
-        bstring += pack('<?', self.is_blood_moon)
-        bstring += pack('<?', self.is_eclipse)
-        bstring += pack('<i', self.dungeon_x)
-        bstring += pack('<i', self.dungeon_y)
-        bstring += pack('<?', self.is_crimson)
-        bstring += pack('<?', self.is_boss_1_dead)
-        bstring += pack('<?', self.is_boss_2_dead)
-        bstring += pack('<?', self.is_boss_3_dead)
-        bstring += pack('<?', self.is_queen_bee_dead)
-        bstring += pack('<?', self.is_mech_1_dead)
-        bstring += pack('<?', self.is_mech_2_dead)
-        bstring += pack('<?', self.is_mech_3_dead)
-        bstring += pack('<?', self.is_any_mech_dead)
-        bstring += pack('<?', self.is_plant_dead)
-        bstring += pack('<?', self.is_golem_dead)
-        bstring += pack('<?', self.is_goblin_saved)
-        bstring += pack('<?', self.is_wizard_saved)
-        bstring += pack('<?', self.is_mechanic_saved)
-        bstring += pack('<?', self.is_goblins_beat)
-        bstring += pack('<?', self.is_clown_beat)
-        bstring += pack('<?', self.is_frost_beat)
-        bstring += pack('<?', self.is_pirates_beat)
-        bstring += pack('<?', self.is_orb_smashed)
-        bstring += pack('<?', self.is_meteor_spawned)
-        bstring += pack('<B', self.orb_smash_count)
-        bstring += pack('<i', self.altar_count)
-        bstring += pack('<?', self.is_hard_mode)
-        bstring += pack('<i', self.invasion_delay)
-        bstring += pack('<i', self.invasion_size)
-        bstring += pack('<i', self.invasion_type)
-        bstring += pack('<d', self.invasion_x)
-        bstring += pack('<?', self.is_temp_raining)
-        bstring += pack('<i', self.temp_rain_time)
-        bstring += pack('<f', self.temp_max_rain)
-        bstring += pack('<i', self.ore_tier_1)
-        bstring += pack('<i', self.ore_tier_2)
-        bstring += pack('<i', self.ore_tier_3)
-        bstring += pack('<B', self.bg_tree)
-        bstring += pack('<B', self.bg_corruption)
-        bstring += pack('<B', self.bg_jungle)
-        bstring += pack('<B', self.bg_snow)
-        bstring += pack('<B', self.bg_hallow)
-        bstring += pack('<B', self.bg_crimson)
-        bstring += pack('<B', self.bg_desert)
-        bstring += pack('<B', self.bg_ocean)
-        bstring += pack('<i', self.cloud_bg_active)
-        bstring += pack('<h', self.num_clouds)
-        bstring += pack('<f', self.wind_speed_set)
-        bstring += pack('<i', self.num_anglers)
-        bstring += pack('<?', self.is_angler_saved)
-        bstring += pack('<i', self.angler_quest)
-
-        return bstring
+        bstring = []
+
+        bstring.append(store_pstring(self.world_name))
+        bstring.append(pack('<i', self.world_id))
+        bstring.append(pack('<i', self.x))
+        bstring.append(pack('<i', self.w))
+        bstring.append(pack('<i', self.y))
+        bstring.append(pack('<i', self.h))
+        bstring.append(pack('<i', self.y_tiles))
+        bstring.append(pack('<i', self.x_tiles))
+        bstring.append(pack('<B', self.moon_type))
+        bstring.append(pack('<iii', *self.tree_x))
+        bstring.append(pack('<iiii', *self.tree_style))
+        bstring.append(pack('<iii', *self.cave_back_x))
+        bstring.append(pack('<iiii', *self.cave_back_style))
+        bstring.append(pack('<i', self.ice_back_style))
+        bstring.append(pack('<i', self.jungle_back_style))
+        bstring.append(pack('<i', self.hell_back_style))
+        bstring.append(pack('<i', self.spawn_x))
+        bstring.append(pack('<i', self.spawn_y))
+        bstring.append(pack('<d', self.surface_level))
+        bstring.append(pack('<d', self.rock_layer))
+        bstring.append(pack('<d', self.temp_time))
+        bstring.append(pack('<?', self.is_day))
+        bstring.append(pack('<i', self.moon_phase))
+        bstring.append(pack('<?', self.is_blood_moon))
+        bstring.append(pack('<?', self.is_eclipse))
+        bstring.append(pack('<i', self.dungeon_x))
+        bstring.append(pack('<i', self.dungeon_y))
+        bstring.append(pack('<?', self.is_crimson))
+        bstring.append(pack('<?', self.is_boss_1_dead))
+        bstring.append(pack('<?', self.is_boss_2_dead))
+        bstring.append(pack('<?', self.is_boss_3_dead))
+        bstring.append(pack('<?', self.is_queen_bee_dead))
+        bstring.append(pack('<?', self.is_mech_1_dead))
+        bstring.append(pack('<?', self.is_mech_2_dead))
+        bstring.append(pack('<?', self.is_mech_3_dead))
+        bstring.append(pack('<?', self.is_any_mech_dead))
+        bstring.append(pack('<?', self.is_plant_dead))
+        bstring.append(pack('<?', self.is_golem_dead))
+        bstring.append(pack('<?', self.is_goblin_saved))
+        bstring.append(pack('<?', self.is_wizard_saved))
+        bstring.append(pack('<?', self.is_mechanic_saved))
+        bstring.append(pack('<?', self.is_goblins_beat))
+        bstring.append(pack('<?', self.is_clown_beat))
+        bstring.append(pack('<?', self.is_frost_beat))
+        bstring.append(pack('<?', self.is_pirates_beat))
+        bstring.append(pack('<?', self.is_orb_smashed))
+        bstring.append(pack('<?', self.is_meteor_spawned))
+        bstring.append(pack('<B', self.orb_smash_count))
+        bstring.append(pack('<i', self.altar_count))
+        bstring.append(pack('<?', self.is_hard_mode))
+        bstring.append(pack('<i', self.invasion_delay))
+        bstring.append(pack('<i', self.invasion_size))
+        bstring.append(pack('<i', self.invasion_type))
+        bstring.append(pack('<d', self.invasion_x))
+        bstring.append(pack('<?', self.is_temp_raining))
+        bstring.append(pack('<i', self.temp_rain_time))
+        bstring.append(pack('<f', self.temp_max_rain))
+        bstring.append(pack('<i', self.ore_tier_1))
+        bstring.append(pack('<i', self.ore_tier_2))
+        bstring.append(pack('<i', self.ore_tier_3))
+        bstring.append(pack('<B', self.bg_tree))
+        bstring.append(pack('<B', self.bg_corruption))
+        bstring.append(pack('<B', self.bg_jungle))
+        bstring.append(pack('<B', self.bg_snow))
+        bstring.append(pack('<B', self.bg_hallow))
+        bstring.append(pack('<B', self.bg_crimson))
+        bstring.append(pack('<B', self.bg_desert))
+        bstring.append(pack('<B', self.bg_ocean))
+        bstring.append(pack('<i', self.cloud_bg_active))
+        bstring.append(pack('<h', self.num_clouds))
+        bstring.append(pack('<f', self.wind_speed_set))
+        bstring.append(pack('<i', self.num_anglers))
+        bstring.append(pack('<?', self.is_angler_saved))
+        bstring.append(pack('<i', self.angler_quest))
+
+        return b''.join(bstring)
 
     def reset(self):
         """
@@ -724,29 +1498,51 @@ class Map():
     Object representing a map in Terraria
     """
 
-    def __init__(self, tile_importance):
+    def __init__(self, tile_importance, x_tiles=4200, y_tiles=1200, store_type=None):
         """
-        Initializes the Map Object
+        Initializes the Map Object. The tiles are kept in a (store_type), a TileStore subclass, ColumnarTileStore by
+        default.
+        :param tile_importance:
+        :param x_tiles:
+        :param y_tiles:
+        :param store_type:
         :return:
         """
 
-        self.x_tiles = 4200
-        self.y_tiles = 1200
-        self.map = []
-        for x in range(0, self.x_tiles):
-            self.map.append([])
-            for y in range(0, self.y_tiles):
-                self.map[x].append(Tile())
+        self.x_tiles = x_tiles
+        self.y_tiles = y_tiles
+        self.x_offset = 0  # World column of map column 0, only non zero for maps made with load_columns.
+        self.store_type = store_type or ColumnarTileStore
+        self.map = self.store_type(self.x_tiles, self.y_tiles)
         self.tile_importance = tile_importance
 
-    def load_map(self, f, index, x_tiles, y_tiles, tile_importance):
+        # Encoded bytes the map was loaded from and the offset of every column in them, see encode_columns.
+        self.source = None
+        self.source_offsets = None
+
+    # Maps with fewer tiles than this are always decoded serially, process startup would dominate.
+    parallel_threshold = 2000000
+
+    # Whether loaded maps keep their encoded bytes, so columns that are not written to are saved without encoding.
+    # The bytes are held on top of the decoded tiles, so it is off unless set on a Map or passed to World.load_world
+    # for worlds that are loaded to be edited and saved again.
+    keep_source = False
+
+    def load_map(self, f, index, x_tiles, y_tiles, tile_importance, length=None, processes=None, column_index=None):
         """
-        Loads the Map from file (f) starting at (index)
+        Loads the Map from file (f) starting at (index). The whole section is read in one go, (length) bytes if given,
+        otherwise up to the end of the file, and kept along with the column offsets if keep_source is set. With more
+        than one (processes), maps of at least parallel_threshold
+        tiles in a ColumnarTileStore are decoded in two phases: a header only scan finds the column boundaries, or
+        they are taken from (column_index), then a process pool decodes ranges of columns into a shared memory store.
         :param f:
         :param index:
         :param x_tiles:
         :param y_tiles:
         :param tile_importance:
+        :param length:
+        :param processes:
+        :param column_index:
         :return:
         """
 
@@ -755,378 +1551,2541 @@ class Map():
         self.tile_importance = tile_importance
 
         f.seek(index)
-        for x in range(0, self.x_tiles):
-            self.map.append([])
+        if length is None:
+            data = f.read()
+        else:
+            data = f.read(length)
 
-            rle = 0
+        self.x_offset = 0
 
-            tile = None
+        if processes is not None and processes > 1 and x_tiles * y_tiles >= Map.parallel_threshold and \
+                self.store_type is ColumnarTileStore:
+            if column_index is not None:
+                offsets = column_index.offsets - index
+            else:
+                offsets = scan_tile_columns(data, 0, x_tiles, y_tiles, tile_importance)
+            offsets = offsets.tolist()
 
-            for y in range(0, self.y_tiles):
+            self.map = ColumnarTileStore(self.x_tiles, self.y_tiles, shared=True)
+            name = self.map.shared_memory.name
 
-                if rle > 0:
-                    self.map[x].append(tile.clone())
-                    rle -= 1
-                    continue
+            bounds = numpy.linspace(0, x_tiles, min(processes * 4, x_tiles) + 1).astype(int).tolist()
+            count = len(bounds) - 1
+            chunks = [data[offsets[start]:offsets[end]] for start, end in zip(bounds[:-1], bounds[1:])]
 
-                tile = Tile()
+            with ProcessPoolExecutor(processes) as pool:
+                for result in pool.map(_decode_shared_columns, [name] * count, [x_tiles] * count, [y_tiles] * count,
+                                       [tile_importance] * count, bounds[:-1], bounds[1:], chunks):
+                    pass  # The workers write into the shared store, this only surfaces their exceptions.
 
-                header_1 = unpack('<B', f.read(1))[0]
-                header_2 = 0
-                header_3 = 0
+            end = offsets[x_tiles]
+        else:
+            offsets = []
+            states, run_ids, run_lengths, end = decode_tile_runs(data, 0, x_tiles, y_tiles, tile_importance, offsets)
+            offsets.append(end)
 
-                if header_1 & 1 == 1:
-                    header_2 = unpack('<B', f.read(1))[0]
+            self.map = self.store_type(self.x_tiles, self.y_tiles)
+            self.map.write_runs(0, self.x_tiles, states, run_ids, run_lengths)
 
-                    if header_2 & 1 == 1:
-                        header_3 = unpack('<B', f.read(1))[0]
+        self.keep_columns(data, offsets)
 
-                if header_1 & 2 == 2:
-                    tile.active = True
+        f.seek(index + end)
 
-                    if (header_1 & 32) != 32:
-                        tile.tile_type = unpack('<B', f.read(1))[0]
-                    else:
-                        lower_byte = unpack('<B', f.read(1))[0]
-                        upper_byte = unpack('<B', f.read(1))[0]
-                        tile.tile_type = (upper_byte << 8) | lower_byte
+    def load_columns(self, f, column_index, x_start, x_end, tile_importance):
+        """
+        Loads only world columns (x_start) to (x_end) from file (f), using (column_index) to find them. The Map then
+        holds just those columns, self.x_offset records the world column of the first one.
+        :param f:
+        :param column_index:
+        :param x_start:
+        :param x_end:
+        :param tile_importance:
+        :return:
+        """
 
-                    if not tile_importance[tile.tile_type]:
-                        tile.u = -1
-                        tile.v = -1
-                    else:
-                        tile.u = unpack('<h', f.read(2))[0]
-                        tile.v = unpack('<h', f.read(2))[0]
+        if x_start < 0 or x_end > column_index.x_tiles or x_start > x_end:
+            raise IndexError('Columns %i to %i out of range.' % (x_start, x_end))
 
-                    if header_3 & 8 == 8:
-                        tile.color = unpack('<B', f.read(1))[0]
+        start = int(column_index.offsets[x_start])
+        end = int(column_index.offsets[x_end])
 
-                if header_1 & 4 == 4:
-                    tile.wall = unpack('<B', f.read(1))[0]
+        f.seek(start)
+        data = f.read(end - start)
 
-                    if header_3 & 16 == 16:
-                        tile.wall_color = unpack('<B', f.read(1))[0]
+        states, run_ids, run_lengths, end = decode_tile_runs(data, 0, x_end - x_start, column_index.y_tiles,
+                                                             tile_importance)
 
-                tile.liquid_type = header_1 & 24
+        self.x_tiles = x_end - x_start
+        self.y_tiles = column_index.y_tiles
+        self.x_offset = x_start
+        self.tile_importance = tile_importance
+        self.map = self.store_type(self.x_tiles, self.y_tiles)
+        self.map.write_runs(0, self.x_tiles, states, run_ids, run_lengths)
 
-                if tile.liquid_type != 0:
+        self.keep_columns(data, column_index.offsets[x_start:x_end + 1] - start)
 
-                    tile.liquid_amount = unpack('<B', f.read(1))[0]
+    def keep_columns(self, data, offsets):
+        """
+        Keeps the encoded bytes (data) of the map just loaded, with (offsets) the offset of every column in them and
+        the offset after the last one, and starts tracking which columns are written to. Does nothing unless
+        keep_source is set.
+        :param data:
+        :param offsets:
+        :return:
+        """
 
-                if header_2 > 0:
-                    if header_2 & 2 == 2:
-                        tile.wire_red = True
-                    if header_2 & 4 == 4:
-                        tile.wire_green = True
-                    if header_2 & 8 == 8:
-                        tile.wire_blue = True
+        if not self.keep_source:
+            self.source = None
+            self.source_offsets = None
+            return
 
-                    tile.brick_style = (header_2 & 112) >> 4
+        self.source = data
+        self.source_offsets = [int(offset) for offset in offsets]
+        self.map.track_changes()
 
-                if header_3 > 0:
-                    if header_3 & 2 == 2:
-                        tile.actuator = True
-                    if header_3 & 4 == 4:
-                        tile.act_inactive = True
+    def tile_type_counts(self):
+        """
+        Counts the active tiles of every tile type.
+        :return: array of counts indexed by tile type
+        """
 
-                rle_type = (header_1 & 192) >> 6
+        return self.map.tile_type_counts()
 
-                if rle_type == 0:
-                    rle = 0
-                elif rle_type != 1:
-                    rle = unpack('<h', f.read(2))[0]
-                else:
-                    rle = unpack('<B', f.read(1))[0]
+    def count_runs(self, chunk_size=256):
+        """
+        Counts the runs of equal tiles in the columns of the Map, the tile records it encodes to. Runs are found
+        (chunk_size) columns at a time.
+        :param chunk_size:
+        :return:
+        """
 
-                self.map[x].append(tile)
+        runs = 0
+        for chunk_start in range(0, self.x_tiles, chunk_size):
+            runs += len(self.map.runs(chunk_start, min(chunk_start + chunk_size, self.x_tiles))[1])
 
-    def validate(self):
+        return runs
+
+    def memory_usage(self):
         """
-        Validates that the Map is good and ready to save
+        Returns the bytes used by each part of the Map, by name: those of its store and the kept encoded bytes and
+        column offsets of a loaded map, see keep_columns.
         :return:
         """
 
-        if self.x_tiles == 0:
-            return False
-        if self.y_tiles == 0:
+        usage = self.map.memory_usage()
+        if self.source is not None:
+            usage['source'] = len(self.source)
+            usage['source offsets'] = object_size(self.source_offsets)
+
+        return usage
+
+    def clip_region(self, x_start, x_end, y_start, y_end):
+        """
+        Returns columns (x_start) to (x_end) and rows (y_start) to (y_end) cut to the edges of the Map. Regions that
+        miss the Map come back empty, with start equal to end.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :return: x_start, x_end, y_start, y_end
+        """
+
+        x_start = min(max(x_start, 0), self.x_tiles)
+        x_end = min(max(x_end, x_start), self.x_tiles)
+        y_start = min(max(y_start, 0), self.y_tiles)
+        y_end = min(max(y_end, y_start), self.y_tiles)
+
+        return x_start, x_end, y_start, y_end
+
+    def fill_rect(self, x_start, x_end, y_start, y_end, tile):
+        """
+        Sets every tile in columns (x_start) to (x_end) and rows (y_start) to (y_end) to (tile), a Tile or TileState.
+        The rectangle is clipped to the Map.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param tile:
+        :return:
+        """
+
+        x_start, x_end, y_start, y_end = self.clip_region(x_start, x_end, y_start, y_end)
+
+        if x_start < x_end and y_start < y_end:
+            self.map.fill(x_start, x_end, y_start, y_end, tile.freeze())
+
+    def apply_mask(self, mask, x, y, tile):
+        """
+        Sets the tiles where (mask), a 2D boolean array indexed [x, y], is set to (tile), a Tile or TileState, with the
+        corner of (mask) at (x, y). The parts of (mask) that fall outside the Map are ignored.
+        :param mask:
+        :param x:
+        :param y:
+        :param tile:
+        :return:
+        """
+
+        mask = numpy.asarray(mask, dtype=numpy.bool_)
+        x_start, x_end, y_start, y_end = self.clip_region(x, x + mask.shape[0], y, y + mask.shape[1])
+
+        if x_start < x_end and y_start < y_end:
+            self.map.fill(x_start, x_end, y_start, y_end, tile.freeze(),
+                          mask[x_start - x:x_end - x, y_start - y:y_end - y])
+
+    def paste(self, states, ids, x, y, mask=None):
+        """
+        Sets the tiles of a region with its corner at (x, y) to (states), indexed by (ids), a 2D array of state ids
+        indexed [x, y], or only the tiles where (mask) is set. The parts of the region that fall outside the Map are
+        ignored.
+        :param states:
+        :param ids:
+        :param x:
+        :param y:
+        :param mask:
+        :return:
+        """
+
+        x_start, x_end, y_start, y_end = self.clip_region(x, x + ids.shape[0], y, y + ids.shape[1])
+
+        if x_start < x_end and y_start < y_end:
+            region = (slice(x_start - x, x_end - x), slice(y_start - y, y_end - y))
+            self.map.set_region(x_start, y_start, states, ids[region], None if mask is None else mask[region])
+
+    def replace_type(self, x_start, x_end, y_start, y_end, old_type, new_type):
+        """
+        Changes every active tile of type (old_type) in columns (x_start) to (x_end) and rows (y_start) to (y_end) to
+        (new_type), keeping their other fields. The rectangle is clipped to the Map.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param old_type:
+        :param new_type:
+        :return:
+        """
+
+        x_start, x_end, y_start, y_end = self.clip_region(x_start, x_end, y_start, y_end)
+
+        if x_start < x_end and y_start < y_end:
+            self.map.replace_type(x_start, x_end, y_start, y_end, old_type, new_type)
+
+    def copy_region(self, x_start, x_end, y_start, y_end, x, y, source=None):
+        """
+        Copies the tiles in columns (x_start) to (x_end) and rows (y_start) to (y_end) of Map (source), this Map if not
+        given, so their corner lands at (x, y). Overlapping regions of the same Map are copied as they were before the
+        copy. Tiles that would come from or land outside either Map are skipped.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param x:
+        :param y:
+        :param source:
+        :return:
+        """
+
+        if source is None:
+            source = self
+
+        x_shift = x - x_start
+        y_shift = y - y_start
+        x_start, x_end, y_start, y_end = source.clip_region(x_start, x_end, y_start, y_end)
+
+        x_start, x_end, y_start, y_end = self.clip_region(x_start + x_shift, x_end + x_shift, y_start + y_shift,
+                                                          y_end + y_shift)
+
+        if x_start < x_end and y_start < y_end:
+            states, ids = source.map.get_region(x_start - x_shift, x_end - x_shift, y_start - y_shift,
+                                                y_end - y_shift)
+            self.map.set_region(x_start, y_start, states, ids)
+
+    def validate(self):
+        """
+        Validates that the Map is good and ready to save
+        :return:
+        """
+
+        if self.x_tiles == 0:
+            return False
+        if self.y_tiles == 0:
             return False
         if len(self.map) == 0:
             return False
         if len(self.map) != self.x_tiles:
             return False
-        for x in range(0, self.x_tiles):
-            if len(self.map[x]) != self.y_tiles:
+        if self.map.y_tiles != self.y_tiles:
+            return False
+        if not self.map.validate():
+            return False
+
+        return True
+
+    def generate_bytestring(self, processes=None):
+        """
+        Generate a bytestring for eventual saving.
+        :param processes: see encode_columns
+        :return:
+        """
+
+        return b''.join(self.encode_columns(0, self.x_tiles, processes=processes))
+
+    def write_map(self, f, processes=None):
+        """
+        Writes the encoded map to file (f) as it is encoded, without building the whole section in memory.
+        :param f:
+        :param processes: see encode_columns
+        :return:
+        """
+
+        for column in self.encode_columns(0, self.x_tiles, processes=processes):
+            f.write(column)
+
+    def encode_columns(self, x_start, x_end, chunk_size=64, processes=None):
+        """
+        Yields the encoded bytes of columns (x_start) to (x_end) in order. For a loaded map whose store still tracks
+        changes, only the columns written to since loading are encoded, every stretch of other columns is yielded in one
+        piece as a memoryview of self.source, so it goes to the file without being copied. See encode_tiles for
+        (chunk_size) and (processes), which are only used for stretches of written columns with at least
+        parallel_threshold tiles.
+        :param x_start:
+        :param x_end:
+        :param chunk_size:
+        :param processes:
+        :return:
+        """
+
+        if self.source is None or self.map.dirty is None or len(self.source_offsets) != self.x_tiles + 1:
+            for data in self.encode_tiles(x_start, x_end, chunk_size, processes):
+                yield data
+            return
+
+        if x_start >= x_end:
+            return
+
+        source = memoryview(self.source)
+        dirty = self.map.dirty[x_start:x_end]
+        bounds = [x_start] + (numpy.flatnonzero(dirty[1:] != dirty[:-1]) + x_start + 1).tolist() + [x_end]
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if not self.map.dirty[start]:
+                yield source[self.source_offsets[start]:self.source_offsets[end]]
+            elif (end - start) * self.y_tiles >= Map.parallel_threshold:
+                for data in self.encode_tiles(start, end, chunk_size, processes):
+                    yield data
+            else:
+                for data in self.encode_tiles(start, end, chunk_size):
+                    yield data
+
+    def encode_tiles(self, x_start, x_end, chunk_size=64, processes=None):
+        """
+        Encodes and yields columns (x_start) to (x_end) in order. Run boundaries are found (chunk_size) columns at a
+        time. With more than one (processes) and a ColumnarTileStore the range is split between a pool of worker
+        processes that attach to the tiles through shared memory (see ColumnarTileStore.share), and every yield is a
+        whole range.
+        :param x_start:
+        :param x_end:
+        :param chunk_size:
+        :param processes:
+        :return:
+        """
+
+        if processes is not None and processes > 1 and isinstance(self.map, ColumnarTileStore):
+            name = self.map.share()
+
+            # A few ranges per process keeps the pool busy when some ranges have many more runs than others.
+            bounds = numpy.linspace(x_start, x_end, min(processes * 4, x_end - x_start) + 1).astype(int).tolist()
+            count = len(bounds) - 1
+
+            with ProcessPoolExecutor(processes) as pool:
+                for data in pool.map(_encode_shared_columns, [name] * count, [self.x_tiles] * count,
+                                     [self.y_tiles] * count, [self.tile_importance] * count, bounds[:-1],
+                                     bounds[1:]):
+                    yield data
+            return
+
+        encoder = TileEncoder(self.tile_importance)
+
+        for chunk_start in range(x_start, x_end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, x_end)
+            states, run_ids, run_lengths, run_counts = self.map.runs(chunk_start, chunk_end)
+
+            for column in encoder.encode_runs(states, run_ids, run_lengths, run_counts):
+                yield column
+
+
+class ColumnIndex():
+    """
+    File offsets of every map column of a world file, so any range of columns can be decoded on its own. Tile runs
+    restart at every column, which makes each column independently decodable.
+    """
+
+    magic = b'TSCI'
+    version = 2
+
+    # Bytes at the start of a world file that go into its fingerprint, enough for the version, section pointers and
+    # the start of the header.
+    fingerprint_size = 4096
+
+    def __init__(self, offsets, y_tiles, file_hash=b'', fingerprint=b''):
+        """
+        Initializes the Object
+        :param offsets: file offset of every column followed by the end of the map section
+        :param y_tiles:
+        :param file_hash: sha1 digest of the world file the index belongs to
+        :param fingerprint: fingerprint_file digest of the world file the index belongs to
+        :return:
+        """
+
+        self.offsets = offsets
+        self.x_tiles = len(offsets) - 1
+        self.y_tiles = y_tiles
+        self.file_hash = file_hash
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def build(f, index, x_tiles, y_tiles, tile_importance, length=None):
+        """
+        Builds the index for the map section starting at (index) in file (f) with a header only scan.
+        :param f:
+        :param index:
+        :param x_tiles:
+        :param y_tiles:
+        :param tile_importance:
+        :param length:
+        :return: column index
+        :return type: ColumnIndex
+        """
+
+        f.seek(index)
+        if length is None:
+            data = f.read()
+        else:
+            data = f.read(length)
+
+        offsets = scan_tile_columns(data, 0, x_tiles, y_tiles, tile_importance) + index
+
+        return ColumnIndex(offsets, y_tiles)
+
+    @staticmethod
+    def hash_file(path):
+        """
+        Returns the sha1 digest of the file at (path).
+        :param path:
+        :return:
+        """
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+
+        return digest.digest()
+
+    @staticmethod
+    def fingerprint_file(path):
+        """
+        Returns a sha1 digest of the size and modification time of the file at (path) and its first fingerprint_size
+        bytes, which hold the section pointers. Unlike hash_file it does not read the whole file, so it can be checked
+        every time a world is opened.
+        :param path:
+        :return:
+        """
+
+        stat = os.stat(path)
+
+        digest = hashlib.sha1(pack('<qq', stat.st_size, stat.st_mtime_ns))
+        with open(path, 'rb') as f:
+            digest.update(f.read(ColumnIndex.fingerprint_size))
+
+        return digest.digest()
+
+    def save(self, path):
+        """
+        Saves the index as a sidecar file at (path).
+        :param path:
+        :return:
+        """
+
+        with open(path, 'wb') as f:
+            f.write(ColumnIndex.magic)
+            f.write(pack('<i', ColumnIndex.version))
+            f.write(pack('<20s', self.file_hash))
+            f.write(pack('<20s', self.fingerprint))
+            f.write(pack('<ii', self.x_tiles, self.y_tiles))
+            f.write(self.offsets.astype('<i8').tobytes())
+
+    @staticmethod
+    def load(path):
+        """
+        Loads an index saved with save from (path).
+        :param path:
+        :return: column index
+        :return type: ColumnIndex
+        """
+
+        with open(path, 'rb') as f:
+            if f.read(4) != ColumnIndex.magic:
+                raise WorldFormatException('%s is not a column index.' % path)
+
+            version = unpack('<i', f.read(4))[0]
+            if version != ColumnIndex.version:
+                raise WorldFormatException('Column index version %i is not supported.' % version)
+
+            file_hash = unpack('<20s', f.read(20))[0]
+            fingerprint = unpack('<20s', f.read(20))[0]
+            x_tiles, y_tiles = unpack('<ii', f.read(8))
+            offsets = numpy.frombuffer(f.read(8 * (x_tiles + 1)), dtype='<i8').astype(numpy.int64)
+
+        if len(offsets) != x_tiles + 1:
+            raise WorldFormatException('Column index %s is truncated.' % path)
+
+        return ColumnIndex(offsets, y_tiles, file_hash, fingerprint)
+
+    @staticmethod
+    def for_world_file(path, index_path=None, verify=False):
+        """
+        Returns the index of the world file at (path). The sidecar at (index_path), by default (path).colidx, is used
+        when it was built from a file with the same fingerprint, see fingerprint_file, otherwise the index is rebuilt
+        and the sidecar rewritten. With (verify) the sidecar must also match the sha1 of the whole file, which reads
+        all of it, and a rebuilt sidecar records that sha1.
+        :param path:
+        :param index_path:
+        :param verify:
+        :return: column index
+        :return type: ColumnIndex
+        """
+
+        if index_path is None:
+            index_path = path + '.colidx'
+
+        fingerprint = ColumnIndex.fingerprint_file(path)
+
+        try:
+            column_index = ColumnIndex.load(index_path)
+            if column_index.fingerprint == fingerprint and \
+                    (not verify or column_index.file_hash == ColumnIndex.hash_file(path)):
+                return column_index
+        except (OSError, WorldFormatException):
+            pass
+
+        with open(path, 'rb') as f:
+            world = World()
+            world.load_world(f, lazy=True)
+            column_index = ColumnIndex.build(f, world.section_pointers[1], world.header.x_tiles, world.header.y_tiles,
+                                             world.tile_importance,
+                                             world.section_pointers[2] - world.section_pointers[1])
+
+        if verify:
+            column_index.file_hash = ColumnIndex.hash_file(path)
+        column_index.fingerprint = fingerprint
+        column_index.save(index_path)
+
+        return column_index
+
+
+class Tile():
+    """
+    Object representing a single Tile in Terraria
+    """
+
+    def __init__(self):
+        """
+        Initializes the Tile Object
+        :return:
+        """
+
+        self.active = False
+        self.tile_type = None
+        self.u = -1
+        self.v = -1
+        self.color = None
+        self.wall = None
+        self.wall_color = None
+        self.liquid_type = 0
+        self.liquid_amount = None
+        self.wire_red = False
+        self.wire_blue = False
+        self.wire_green = False
+        self.brick_style = 0
+        self.actuator = False
+        self.actuator_inactive = False
+
+    def __eq__(self, other):
+        """
+        Tests if two Tiles are equal to one another.
+        :param other:
+        :return:
+        """
+
+        if isinstance(other, (Tile, TileState)):
+            return (
+                self.active == other.active and
+                self.tile_type == other.tile_type and
+                self.u == other.u and
+                self.v == other.v and
+                self.color == other.color and
+                self.wall == other.wall and
+                self.wall_color == other.wall_color and
+                self.liquid_type == other.liquid_type and
+                self.liquid_amount == other.liquid_amount and
+                self.wire_red == other.wire_red and
+                self.wire_blue == other.wire_blue and
+                self.wire_green == other.wire_green and
+                self.brick_style == other.brick_style and
+                self.actuator == other.actuator and
+                self.actuator_inactive == other.actuator_inactive
+            )
+        else:
+            return NotImplemented
+
+    def clone(self):
+        """
+        Returns a copy of self tile object.
+        :return: tile
+        :return type: Tile
+        """
+
+        tile = Tile()
+
+        tile.active = self.active
+        tile.tile_type = self.tile_type
+        tile.u = self.u
+        tile.v = self.v
+        tile.color = self.color
+        tile.wall = self.wall
+        tile.wall_color = self.wall_color
+        tile.liquid_type = self.liquid_type
+        tile.liquid_amount = self.liquid_amount
+        tile.wire_red = self.wire_red
+        tile.wire_blue = self.wire_blue
+        tile.wire_green = self.wire_green
+        tile.brick_style = self.brick_style
+        tile.actuator = self.actuator
+        tile.actuator_inactive = self.actuator_inactive
+
+        return tile
+
+    def freeze(self):
+        """
+        Returns the interned, immutable TileState with the same fields as this tile.
+        :return: state
+        :return type: TileState
+        """
+
+        return TileState(**{name: getattr(self, name) for name in TILE_FIELD_NAMES})
+
+    def validate(self):
+        """
+        Validates the Tile
+        :return:
+        """
+        if self.active is False:
+            return True
+        else:
+            if self.tile_type is None:
                 return False
-            for y in range(0, self.y_tiles):
-                if not self.map[x][y].validate():
-                    return False
-                pass
 
         return True
 
-    def generate_bytestring(self):
+    def generate_bytestring(self, rle, tile_importance):
+        """
+        Generate a byte array for the tile to eventually save.
+        :return:
+        """
+
+        bstring = b''
+
+        header_1 = 0
+        header_2 = 0
+        header_3 = 0
+
+        if rle == 0:
+            pass
+        elif rle > 255:
+            header_1 |= 128
+        else:
+            header_1 |= 64
+
+        if self.active:
+            header_1 |= 2
+
+        if self.wall is not None:
+            header_1 |= 4
+
+        if self.tile_type is not None and self.tile_type > 255:
+            header_1 |= 32
+
+        if self.wire_red:
+            header_2 |= 2
+        if self.wire_green:
+            header_2 |= 4
+        if self.wire_blue:
+            header_2 |= 8
+
+        if self.brick_style != 0:
+            header_2 |= (self.brick_style << 4)
+
+        if self.actuator:
+            header_3 |= 2
+        if self.actuator_inactive:
+            header_3 |= 4
+        if self.color is not None:
+            header_3 |= 8
+        if self.wall_color is not None:
+            header_3 |= 16
+
+        if header_3 > 0:
+            header_2 |= 1
+        if header_2 > 0:
+            header_1 |= 1
+
+        header_1 |= self.liquid_type
+
+        bstring += pack('<B', header_1)
+        if header_1 & 1 == 1:
+            bstring += pack('<B', header_2)
+        if header_2 & 1 == 1:
+            bstring += pack('<B', header_3)
+
+        if self.tile_type is not None:
+            if self.tile_type <= 255:
+                bstring += pack('<B', self.tile_type)
+            else:
+                bstring += pack('<h', self.tile_type)
+
+            if tile_importance[self.tile_type]:
+                bstring += pack('<h', self.u)
+                bstring += pack('<h', self.v)
+
+        if self.color is not None:
+            bstring += pack('<B', self.color)
+
+        if self.wall is not None:
+            bstring += pack('<B', self.wall)
+
+        if self.wall_color is not None:
+            bstring += pack('<B', self.wall_color)
+
+        if self.liquid_amount is not None and self.liquid_amount > 0:
+            bstring += pack('<B', self.liquid_amount)
+
+        if rle > 255:
+            bstring += pack('<h', rle)
+        elif rle > 0:
+            bstring += pack('<B', rle)
+
+        return bstring
+
+    def desc(self):
+        """
+        Describes and returns the current tile.
+        :return:
+        """
+
+        desc = '''
+        Active Status: %s
+        Tile Type: %s
+        U: %s
+        V: %s
+        Color: %s
+        Wall: %s
+        Wall Color: %s
+        Liquid Type: %s
+        Liquid Amount: %s
+        Red Wire: %s
+        Green Wire: %s
+        Blue Wire: %s
+        Brick Style: %s
+        Actuator: %s
+        Actuator Inactive: %s
+        ''' % (
+            self.active,
+            self.tile_type,
+            self.u,
+            self.v,
+            self.color,
+            self.wall,
+            self.wall_color,
+            self.liquid_type,
+            self.liquid_amount,
+            self.wire_red,
+            self.wire_blue,
+            self.wire_green,
+            self.brick_style,
+            self.actuator,
+            self.actuator_inactive
+        )
+
+        return desc
+
+
+class TileState():
+    """
+    Immutable, interned tile state. Every distinct combination of Tile fields exists once, so equal states are the
+    same object, compare by identity and hash by id. Maps hold few distinct states, which makes them cheap to share
+    between any number of cells. To change a state use replace, which returns the state with the changes, or thaw for
+    a mutable Tile. TileViews write straight through to their store.
+
+    The intern table only holds weak references, a state lives as long as a Map, palette or other object refers to it,
+    or while it is among the last recent_size states created, and is dropped from the table after that. Creating it
+    again then gives a new object, which is still the only one with its fields.
+    """
+
+    __slots__ = TILE_FIELD_NAMES + ('row', '__weakref__')
+
+    # Every state alive, by row.
+    interned = weakref.WeakValueDictionary()
+
+    # The states created last, kept alive so reading tiles one at a time does not create their states over and over.
+    recent_size = 1024
+    recent = collections.deque(maxlen=recent_size)
+
+    def __new__(cls, **fields):
+        """
+        Returns the state with (fields), missing fields default to those of an empty Tile.
+        :param fields:
+        :return: state
+        :return type: TileState
+        """
+
+        row = []
+        for name, dtype, default in TILE_FIELDS:
+            value = fields.pop(name, default)
+            row.append(-1 if value is None else value)
+
+        if fields:
+            raise TypeError('Unknown tile fields: %s' % ', '.join(sorted(fields)))
+
+        return TileState.from_row(tuple(row))
+
+    @staticmethod
+    def from_row(row):
+        """
+        Returns the state for (row), one stored value per TILE_FIELDS entry with None stored as -1.
+        :param row:
+        :return: state
+        :return type: TileState
+        """
+
+        state = TileState.interned.get(row)
+
+        if state is None:
+            row = tuple(bool(value) if name in BOOL_TILE_FIELDS else int(value)
+                        for name, value in zip(TILE_FIELD_NAMES, row))
+
+            state = object.__new__(TileState)
+            for name, value in zip(TILE_FIELD_NAMES, row):
+                if value == -1 and name in NULLABLE_TILE_FIELDS:
+                    value = None
+                object.__setattr__(state, name, value)
+            object.__setattr__(state, 'row', row)
+
+            TileState.interned[row] = state
+            TileState.recent.append(state)
+
+        return state
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TileState is immutable, use replace or thaw.')
+
+    def __delattr__(self, name):
+        raise AttributeError('TileState is immutable, use replace or thaw.')
+
+    def __eq__(self, other):
+        """
+        Tests if two states are equal, which for states means they are the same object.
+        :param other:
+        :return:
+        """
+
+        if isinstance(other, TileState):
+            return self is other
+        elif isinstance(other, Tile):
+            return other == self
+        else:
+            return NotImplemented
+
+    def __hash__(self):
+        return id(self)
+
+    def __reduce__(self):
+        return TileState.from_row, (self.row,)
+
+    def replace(self, **changes):
+        """
+        Returns the state with (changes) applied to this one.
+        :param changes:
+        :return: state
+        :return type: TileState
+        """
+
+        fields = {name: getattr(self, name) for name in TILE_FIELD_NAMES}
+        fields.update(changes)
+
+        return TileState(**fields)
+
+    def thaw(self):
+        """
+        Returns a mutable Tile with the same fields.
+        :return: tile
+        :return type: Tile
+        """
+
+        tile = Tile()
+        for name in TILE_FIELD_NAMES:
+            setattr(tile, name, getattr(self, name))
+
+        return tile
+
+    def clone(self):
+        """
+        States are immutable, so a clone is the state itself.
+        :return: self
+        """
+
+        return self
+
+    def freeze(self):
+        """
+        Returns the state itself.
+        :return: self
+        """
+
+        return self
+
+    validate = Tile.validate
+    generate_bytestring = Tile.generate_bytestring
+    desc = Tile.desc
+
+
+class TileStore():
+    """
+    Base class for the tile storage of a Map. Indexing a store as store[x][y] goes through TileColumn and TileView, so
+    every store behaves like the old nested list of Tiles. Subclasses implement get_state, set_state, runs,
+    write_runs, tile_type_counts, clear and validate, the rest is written in terms of those.
+
+    Once track_changes is called, every write marks its columns in self.dirty. Writing to the arrays of a store
+    directly bypasses this, call mark_dirty afterwards.
+    """
+
+    dirty = None
+
+    def track_changes(self):
+        """
+        Starts marking the columns that are written to, with every column clean.
+        :return:
+        """
+
+        self.dirty = numpy.zeros(self.x_tiles, dtype=numpy.bool_)
+
+    def mark_dirty(self, x_start, x_end=None):
+        """
+        Marks columns (x_start) to (x_end), or only column (x_start), as written to if changes are tracked.
+        :param x_start:
+        :param x_end:
+        :return:
+        """
+
+        if self.dirty is not None:
+            if x_end is None:
+                x_end = x_start + 1
+            self.dirty[x_start:x_end] = True
+
+    def __len__(self):
+        return self.x_tiles
+
+    def __getitem__(self, x):
+        """
+        Returns the column at (x).
+        :param x:
+        :return: column
+        :return type: TileColumn
+        """
+
+        if x < 0:
+            x += self.x_tiles
+        if x < 0 or x >= self.x_tiles:
+            raise IndexError('Column %s out of range.' % x)
+
+        return TileColumn(self, x)
+
+    def __iter__(self):
+        for x in range(0, self.x_tiles):
+            yield TileColumn(self, x)
+
+    def get_field(self, x, y, name):
+        """
+        Returns the value of field (name) of the tile at (x, y) as it would be on a Tile.
+        :param x:
+        :param y:
+        :param name:
+        :return:
+        """
+
+        return getattr(self.get_state(x, y), name)
+
+    def set_field(self, x, y, name, value):
+        """
+        Sets field (name) of the tile at (x, y) to (value).
+        :param x:
+        :param y:
+        :param name:
+        :param value:
+        :return:
+        """
+
+        self.set_state(x, y, self.get_state(x, y).replace(**{name: value}))
+
+    def get_tile(self, x, y):
+        """
+        Returns a detached copy of the tile at (x, y).
+        :param x:
+        :param y:
+        :return: tile
+        :return type: Tile
+        """
+
+        return self.get_state(x, y).thaw()
+
+    def get_state(self, x, y):
+        raise NotImplementedError
+
+    def set_state(self, x, y, state):
+        raise NotImplementedError
+
+    def set_tile(self, x, y, tile):
+        """
+        Stores (tile), a Tile or TileState, at (x, y).
+        :param x:
+        :param y:
+        :param tile:
+        :return:
+        """
+
+        self.set_state(x, y, tile.freeze())
+
+    def write_runs(self, x_start, x_end, states, run_ids, run_lengths):
+        raise NotImplementedError
+
+    def runs(self, x_start, x_end):
+        raise NotImplementedError
+
+    def get_region(self, x_start, x_end, y_start, y_end):
+        raise NotImplementedError
+
+    def set_region(self, x_start, y_start, states, ids, mask=None):
+        raise NotImplementedError
+
+    def fill(self, x_start, x_end, y_start, y_end, state, mask=None):
+        """
+        Stores (state) in every tile of columns (x_start) to (x_end) and rows (y_start) to (y_end), or only where
+        (mask), a boolean array the size of the region, is set.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param state:
+        :param mask:
+        :return:
+        """
+
+        ids = numpy.zeros((x_end - x_start, y_end - y_start), dtype=numpy.intp)
+        self.set_region(x_start, y_start, [state], ids, mask)
+
+    def replace_type(self, x_start, x_end, y_start, y_end, old_type, new_type):
+        """
+        Changes the tile type of every active tile of type (old_type) in columns (x_start) to (x_end) and rows
+        (y_start) to (y_end) to (new_type). Every other field is kept.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param old_type:
+        :param new_type:
+        :return:
+        """
+
+        states, ids = self.get_region(x_start, x_end, y_start, y_end)
+
+        changed = numpy.array([state.active and state.tile_type == old_type for state in states], dtype=numpy.bool_)
+        if not changed.any():
+            return
+
+        states = [state.replace(tile_type=new_type) if replace else state for state, replace in zip(states, changed)]
+        self.set_region(x_start, y_start, states, ids, changed[ids])
+
+    def tile_type_counts(self):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def validate(self):
+        raise NotImplementedError
+
+    def memory_usage(self):
+        """
+        Returns the bytes used by each part of the store, by name. Subclasses add their tiles to the change tracking
+        counted here.
+        :return:
+        """
+
+        usage = {}
+        if self.dirty is not None:
+            usage['dirty columns'] = self.dirty.nbytes
+
+        return usage
+
+
+class ColumnarTileStore(TileStore):
+    """
+    Columnar storage for the tiles of a Map. Every Tile field lives in its own fixed-width 2D array indexed [x, y].
+    """
+
+    def __init__(self, x_tiles, y_tiles, shared=False, attach=None):
+        """
+        Initializes the store with (x_tiles) by (y_tiles) empty tiles, in shared memory if (shared), or with the tiles
+        of the shared store named (attach), see share.
+        :param x_tiles:
+        :param y_tiles:
+        :param shared:
+        :param attach:
+        :return:
+        """
+
+        self.x_tiles = x_tiles
+        self.y_tiles = y_tiles
+        self.shared_memory = None
+
+        if attach is not None:
+            self.shared_memory = SharedMemory(attach)
+            self.fields = self.shared_fields(self.shared_memory)
+            weakref.finalize(self, _release_shared_memory, self.shared_memory, False)
+            return
+
+        if shared:
+            size = sum(x_tiles * y_tiles * numpy.dtype(dtype).itemsize for name, dtype, default in TILE_FIELDS)
+            self.shared_memory = SharedMemory(create=True, size=max(size, 1))
+            self.fields = self.shared_fields(self.shared_memory)
+            weakref.finalize(self, _release_shared_memory, self.shared_memory, True)
+            self.clear()
+            return
+
+        self.fields = {}
+        for name, dtype, default in TILE_FIELDS:
+            self.fields[name] = numpy.full((x_tiles, y_tiles), default, dtype=dtype)
+
+    def shared_fields(self, shared_memory):
+        """
+        Returns field arrays laid out one after another in (shared_memory).
+        :param shared_memory:
+        :return:
+        """
+
+        fields = {}
+        offset = 0
+        for name, dtype, default in TILE_FIELDS:
+            fields[name] = numpy.ndarray((self.x_tiles, self.y_tiles), dtype=dtype, buffer=shared_memory.buf,
+                                         offset=offset)
+            offset += fields[name].nbytes
+
+        return fields
+
+    def share(self):
+        """
+        Moves the field arrays into a single shared memory block, so worker processes can attach to the store by name
+        instead of having the tiles pickled. The block is unlinked once this store is garbage collected.
+        :return: name of the shared memory block
+        """
+
+        if self.shared_memory is None:
+            size = sum(array.nbytes for array in self.fields.values())
+            shared_memory = SharedMemory(create=True, size=max(size, 1))
+
+            fields = self.shared_fields(shared_memory)
+            for name in TILE_FIELD_NAMES:
+                fields[name][...] = self.fields[name]
+
+            self.fields = fields
+            self.shared_memory = shared_memory
+            weakref.finalize(self, _release_shared_memory, shared_memory, True)
+
+        return self.shared_memory.name
+
+    def get_field(self, x, y, name):
+        """
+        Returns the value of field (name) of the tile at (x, y) as it would be on a Tile.
+        :param x:
+        :param y:
+        :param name:
+        :return:
+        """
+
+        value = self.fields[name][x, y]
+
+        if name in BOOL_TILE_FIELDS:
+            return bool(value)
+
+        value = int(value)
+        if value == -1 and name in NULLABLE_TILE_FIELDS:
+            return None
+
+        return value
+
+    def set_field(self, x, y, name, value):
+        """
+        Sets field (name) of the tile at (x, y) to (value).
+        :param x:
+        :param y:
+        :param name:
+        :param value:
+        :return:
+        """
+
+        if value is None:
+            value = -1
+
+        self.fields[name][x, y] = value
+        self.mark_dirty(x)
+
+    def get_state(self, x, y):
+        """
+        Returns the interned TileState of the tile at (x, y).
+        :param x:
+        :param y:
+        :return: state
+        :return type: TileState
+        """
+
+        return TileState.from_row(tuple(self.fields[name][x, y].item() for name in TILE_FIELD_NAMES))
+
+    def set_state(self, x, y, state):
+        """
+        Copies the fields of (state) into the store at (x, y).
+        :param x:
+        :param y:
+        :param state:
+        :return:
+        """
+
+        for name, value in zip(TILE_FIELD_NAMES, state.row):
+            self.fields[name][x, y] = value
+        self.mark_dirty(x)
+
+    def set_tile(self, x, y, tile):
+        """
+        Copies every field of (tile), a Tile or TileState, into the store at (x, y).
+        :param x:
+        :param y:
+        :param tile:
+        :return:
+        """
+
+        if isinstance(tile, TileState):
+            self.set_state(x, y, tile)
+            return
+
+        for name in TILE_FIELD_NAMES:
+            value = getattr(tile, name)
+            if value is None:
+                value = -1
+            self.fields[name][x, y] = value
+        self.mark_dirty(x)
+
+    def write_runs(self, x_start, x_end, states, run_ids, run_lengths):
+        """
+        Expands runs from decode_tile_runs into columns (x_start) to (x_end) with one bulk assignment per field.
+        :param x_start:
+        :param x_end:
+        :param states:
+        :param run_ids:
+        :param run_lengths:
+        :return:
+        """
+
+        run_lengths = numpy.asarray(run_lengths, dtype=numpy.intp)
+
+        if run_lengths.sum() != (x_end - x_start) * self.y_tiles:
+            raise WorldFormatException('Tile runs cover %i tiles instead of %i.' %
+                                       (run_lengths.sum(), (x_end - x_start) * self.y_tiles))
+
+        self.mark_dirty(x_start, x_end)
+
+        run_ids = numpy.asarray(run_ids, dtype=numpy.intp)
+        palette = numpy.array([state.row for state in states], dtype=numpy.int32).reshape(len(states),
+                                                                                           len(TILE_FIELDS))
+
+        for i, (name, dtype, default) in enumerate(TILE_FIELDS):
+            values = palette[:, i].astype(dtype)
+            target = self.fields[name][x_start:x_end]
+
+            # Fields that are the same in every state (wires, actuators, ...) do not need to be expanded per tile.
+            if len(values) == 0 or (values == values[0]).all():
+                target.fill(values[0] if len(values) else default)
+                continue
+
+            target.reshape(-1)[:] = numpy.repeat(values[run_ids], run_lengths)
+
+    def runs(self, x_start, x_end):
+        """
+        Finds the runs of identical tiles in columns (x_start) to (x_end) by comparing every field with its neighbour
+        above. Runs never cross columns.
+        :param x_start:
+        :param x_end:
+        :return: distinct states, state id and length of every run, number of runs per column
+        """
+
+        width = x_end - x_start
+
+        changed = numpy.zeros((width, self.y_tiles), dtype=numpy.bool_)
+        changed[:, 0] = True
+        different = numpy.empty((width, self.y_tiles - 1), dtype=numpy.bool_)
+
+        for name in TILE_FIELD_NAMES:
+            values = self.fields[name][x_start:x_end]
+            numpy.not_equal(values[:, 1:], values[:, :-1], out=different)
+            changed[:, 1:] |= different
+
+        starts = numpy.flatnonzero(changed)
+        run_lengths = numpy.diff(starts, append=width * self.y_tiles)
+        run_counts = numpy.count_nonzero(changed, axis=1)
+
+        rows = numpy.empty((len(starts), len(TILE_FIELDS)), dtype=numpy.int32)
+        for i, name in enumerate(TILE_FIELD_NAMES):
+            rows[:, i] = self.fields[name][x_start:x_end].reshape(-1)[starts]
+
+        states, run_ids = unique_states(rows)
+
+        return states, run_ids, run_lengths, run_counts
+
+    def get_region(self, x_start, x_end, y_start, y_end):
+        """
+        Returns the tiles of columns (x_start) to (x_end) and rows (y_start) to (y_end) as distinct states and the
+        state id of every tile.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :return: states, array of state ids indexed [x, y] from the corner of the region
+        """
+
+        rows = numpy.empty(((x_end - x_start) * (y_end - y_start), len(TILE_FIELDS)), dtype=numpy.int32)
+        for i, name in enumerate(TILE_FIELD_NAMES):
+            rows[:, i] = self.fields[name][x_start:x_end, y_start:y_end].reshape(-1)
+
+        states, ids = unique_states(rows)
+
+        return states, ids.reshape(x_end - x_start, y_end - y_start)
+
+    def set_region(self, x_start, y_start, states, ids, mask=None):
+        """
+        Stores (states), indexed by (ids), an array of state ids for a region with its corner at (x_start, y_start),
+        or only the tiles where (mask) is set.
+        :param x_start:
+        :param y_start:
+        :param states:
+        :param ids:
+        :param mask:
+        :return:
+        """
+
+        width, height = ids.shape
+        palette = numpy.array([state.row for state in states], dtype=numpy.int32).reshape(len(states),
+                                                                                           len(TILE_FIELDS))
+
+        for i, (name, dtype, default) in enumerate(TILE_FIELDS):
+            values = palette[:, i].astype(dtype)
+            target = self.fields[name][x_start:x_start + width, y_start:y_start + height]
+
+            # Fields that are the same in every state only need a fill, as in write_runs.
+            if len(values) and (values == values[0]).all():
+                values = values[0]
+            else:
+                values = values[ids]
+                if mask is not None:
+                    values = values[mask]
+
+            if mask is None:
+                target[...] = values
+            else:
+                target[mask] = values
+
+        self.mark_dirty(x_start, x_start + width)
+
+    def fill(self, x_start, x_end, y_start, y_end, state, mask=None):
+        """
+        Stores (state) in every tile of columns (x_start) to (x_end) and rows (y_start) to (y_end), or only where
+        (mask) is set, with one slice assignment per field.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param state:
+        :param mask:
+        :return:
+        """
+
+        for name, value in zip(TILE_FIELD_NAMES, state.row):
+            target = self.fields[name][x_start:x_end, y_start:y_end]
+            if mask is None:
+                target[...] = value
+            else:
+                target[mask] = value
+
+        self.mark_dirty(x_start, x_end)
+
+    def replace_type(self, x_start, x_end, y_start, y_end, old_type, new_type):
+        """
+        Changes the tile type of every active tile of type (old_type) in columns (x_start) to (x_end) and rows
+        (y_start) to (y_end) to (new_type). Every other field is kept.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param old_type:
+        :param new_type:
+        :return:
+        """
+
+        tile_types = self.fields['tile_type'][x_start:x_end, y_start:y_end]
+        tile_types[self.fields['active'][x_start:x_end, y_start:y_end] & (tile_types == old_type)] = new_type
+
+        self.mark_dirty(x_start, x_end)
+
+    def tile_type_counts(self):
+        """
+        Counts the active tiles of every tile type.
+        :return: array of counts indexed by tile type
+        """
+
+        types = self.fields['tile_type'][self.fields['active'] & (self.fields['tile_type'] >= 0)]
+
+        return numpy.bincount(types, minlength=1)
+
+    def clear(self):
+        """
+        Resets every tile to an empty Tile.
+        :return:
+        """
+
+        for name, dtype, default in TILE_FIELDS:
+            self.fields[name].fill(default)
+        self.mark_dirty(0, self.x_tiles)
+
+    def validate(self):
+        """
+        Validates every tile in the store at once. Mirrors Tile.validate.
+        :return:
+        """
+
+        return not numpy.any(self.fields['active'] & (self.fields['tile_type'] == -1))
+
+    def memory_usage(self):
+        """
+        Returns the bytes used by each part of the store, by name. Fields in shared memory are counted too, though
+        every process attached to them shares them.
+        :return:
+        """
+
+        usage = TileStore.memory_usage(self)
+        usage['tile fields'] = sum(field.nbytes for field in self.fields.values())
+
+        return usage
+
+
+class PaletteTileStore(TileStore):
+    """
+    Palette storage for the tiles of a Map. Every cell is a 16 bit index into a palette of the distinct TileStates
+    written to the store, so a tile costs 2 bytes and comparing tiles, finding runs or counting tile types are integer
+    array operations. The palette grows as new states are written.
+    """
+
+    max_palette = 65536
+
+    def __init__(self, x_tiles, y_tiles):
+        """
+        Initializes the store with (x_tiles) by (y_tiles) empty tiles.
+        :param x_tiles:
+        :param y_tiles:
+        :return:
+        """
+
+        self.x_tiles = x_tiles
+        self.y_tiles = y_tiles
+        self.ids = numpy.zeros((x_tiles, y_tiles), dtype=numpy.uint16)
+        self.palette = [TileState()]
+        self.palette_ids = {TileState(): 0}
+
+    def state_id(self, state):
+        """
+        Returns the palette id of (state), adding it to the palette if it is new. A full palette is compacted before
+        giving up.
+        :param state:
+        :return:
+        """
+
+        palette_id = self.palette_ids.get(state)
+        if palette_id is not None:
+            return palette_id
+
+        if len(self.palette) == PaletteTileStore.max_palette:
+            self.compact()
+            if len(self.palette) == PaletteTileStore.max_palette:
+                raise WorldFormatException('Map has more than %i distinct tiles.' % PaletteTileStore.max_palette)
+
+        palette_id = len(self.palette)
+        self.palette.append(state)
+        self.palette_ids[state] = palette_id
+
+        return palette_id
+
+    def state_ids(self, states):
+        """
+        Returns the palette ids of (states), adding the new ones to the palette. A palette too full for all of them is
+        compacted once before any of them gets an id, since compacting renumbers the ids and drops the states no cell
+        refers to yet.
+        :param states:
+        :return: array of palette ids
+        """
+
+        new_states = set(state for state in states if state not in self.palette_ids)
+        if len(self.palette) + len(new_states) > PaletteTileStore.max_palette:
+            self.compact()
+
+            new_states = set(state for state in states if state not in self.palette_ids)
+            if len(self.palette) + len(new_states) > PaletteTileStore.max_palette:
+                raise WorldFormatException('Map has more than %i distinct tiles.' % PaletteTileStore.max_palette)
+
+        return numpy.array([self.state_id(state) for state in states], dtype=numpy.uint16)
+
+    def compact(self):
+        """
+        Drops the palette entries no cell refers to any more and renumbers the rest.
+        :return:
+        """
+
+        used = numpy.flatnonzero(self.palette_counts())
+
+        mapping = numpy.zeros(len(self.palette), dtype=numpy.uint16)
+        mapping[used] = numpy.arange(len(used))
+        self.renumber(mapping)
+
+        self.palette = [self.palette[palette_id] for palette_id in used.tolist()]
+        self.palette_ids = dict((state, palette_id) for palette_id, state in enumerate(self.palette))
+
+    def palette_counts(self):
+        """
+        Counts the cells that refer to each palette entry.
+        :return: array of counts indexed by palette id
+        """
+
+        return numpy.bincount(self.ids.reshape(-1), minlength=len(self.palette))
+
+    def renumber(self, mapping):
+        """
+        Replaces every palette id in the store by its entry in (mapping).
+        :param mapping:
+        :return:
+        """
+
+        self.ids = mapping[self.ids]
+
+    def get_state(self, x, y):
+        """
+        Returns the interned TileState of the tile at (x, y).
+        :param x:
+        :param y:
+        :return: state
+        :return type: TileState
+        """
+
+        return self.palette[self.ids[x, y]]
+
+    def set_state(self, x, y, state):
+        """
+        Stores (state) at (x, y).
+        :param x:
+        :param y:
+        :param state:
+        :return:
+        """
+
+        self.ids[x, y] = self.state_id(state)
+        self.mark_dirty(x)
+
+    def write_runs(self, x_start, x_end, states, run_ids, run_lengths):
+        """
+        Expands runs from decode_tile_runs into columns (x_start) to (x_end) as palette ids.
+        :param x_start:
+        :param x_end:
+        :param states:
+        :param run_ids:
+        :param run_lengths:
+        :return:
+        """
+
+        run_lengths = numpy.asarray(run_lengths, dtype=numpy.intp)
+
+        if run_lengths.sum() != (x_end - x_start) * self.y_tiles:
+            raise WorldFormatException('Tile runs cover %i tiles instead of %i.' %
+                                       (run_lengths.sum(), (x_end - x_start) * self.y_tiles))
+
+        palette_ids = self.state_ids(states)
+        run_ids = numpy.asarray(run_ids, dtype=numpy.intp)
+
+        self.ids[x_start:x_end].reshape(-1)[:] = numpy.repeat(palette_ids[run_ids], run_lengths)
+        self.mark_dirty(x_start, x_end)
+
+    def get_region(self, x_start, x_end, y_start, y_end):
+        """
+        Returns the tiles of columns (x_start) to (x_end) and rows (y_start) to (y_end) as the palette and the palette
+        id of every tile.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :return: states, array of state ids indexed [x, y] from the corner of the region
+        """
+
+        return list(self.palette), self.ids[x_start:x_end, y_start:y_end].copy()
+
+    def set_region(self, x_start, y_start, states, ids, mask=None):
+        """
+        Stores (states), indexed by (ids), an array of state ids for a region with its corner at (x_start, y_start),
+        or only the tiles where (mask) is set.
+        :param x_start:
+        :param y_start:
+        :param states:
+        :param ids:
+        :param mask:
+        :return:
+        """
+
+        width, height = ids.shape
+        values = self.state_ids(states)[ids]
+
+        target = self.ids[x_start:x_start + width, y_start:y_start + height]
+        if mask is None:
+            target[...] = values
+        else:
+            target[mask] = values[mask]
+
+        self.mark_dirty(x_start, x_start + width)
+
+    def runs(self, x_start, x_end):
+        """
+        Finds the runs of identical tiles in columns (x_start) to (x_end) by comparing palette ids. Runs never cross
+        columns.
+        :param x_start:
+        :param x_end:
+        :return: distinct states, state id and length of every run, number of runs per column
+        """
+
+        ids = self.ids[x_start:x_end]
+
+        changed = numpy.empty(ids.shape, dtype=numpy.bool_)
+        changed[:, 0] = True
+        numpy.not_equal(ids[:, 1:], ids[:, :-1], out=changed[:, 1:])
+
+        starts = numpy.flatnonzero(changed)
+        run_lengths = numpy.diff(starts, append=ids.size)
+        run_counts = numpy.count_nonzero(changed, axis=1)
+
+        used, run_ids = numpy.unique(ids.reshape(-1)[starts], return_inverse=True)
+        states = [self.palette[palette_id] for palette_id in used.tolist()]
+
+        return states, run_ids, run_lengths, run_counts
+
+    def tile_type_counts(self):
+        """
+        Counts the active tiles of every tile type.
+        :return: array of counts indexed by tile type
+        """
+
+        cells = self.palette_counts()
+        types = numpy.array([state.tile_type if state.active and state.tile_type is not None else -1
+                             for state in self.palette], dtype=numpy.int64)
+        counted = types >= 0
+
+        return numpy.bincount(types[counted], weights=cells[counted], minlength=1).astype(numpy.int64)
+
+    def clear(self):
+        """
+        Resets every tile to an empty Tile.
+        :return:
+        """
+
+        self.ids.fill(0)
+        self.palette = [TileState()]
+        self.palette_ids = {TileState(): 0}
+        self.mark_dirty(0, self.x_tiles)
+
+    def validate(self):
+        """
+        Validates every tile in the store by validating each palette entry that is in use. Mirrors Tile.validate.
+        :return:
+        """
+
+        invalid = [palette_id for palette_id, state in enumerate(self.palette) if not state.validate()]
+
+        return not self.palette_counts()[invalid].any()
+
+    def memory_usage(self):
+        """
+        Returns the bytes used by each part of the store, by name. The palette counts its list and index, the states
+        in it are shared by every store.
+        :return:
+        """
+
+        usage = TileStore.memory_usage(self)
+        usage['tile ids'] = self.ids.nbytes
+        usage['palette'] = object_size([self.palette, self.palette_ids])
+
+        return usage
+
+
+class ChunkedTileStore(PaletteTileStore):
+    """
+    Sparse storage for the tiles of a Map in square chunks of chunk_size tiles. A chunk that holds a single tile state
+    is stored as just its palette id, and only gets a dense array of palette ids once something different is written
+    into it. Large stretches of air, dirt or stone cost next to nothing, and are turned into runs without looking at
+    their tiles.
+    """
+
+    chunk_size = 64
+
+    def __init__(self, x_tiles, y_tiles):
+        """
+        Initializes the store with (x_tiles) by (y_tiles) empty tiles, all in uniform chunks.
+        :param x_tiles:
+        :param y_tiles:
+        :return:
+        """
+
+        size = ChunkedTileStore.chunk_size
+
+        self.x_tiles = x_tiles
+        self.y_tiles = y_tiles
+        self.palette = [TileState()]
+        self.palette_ids = {TileState(): 0}
+
+        # Palette id of every uniform chunk, -1 for chunks kept in self.dense, keyed by chunk position.
+        self.uniform = numpy.zeros(((x_tiles + size - 1) // size, (y_tiles + size - 1) // size), dtype=numpy.int32)
+        self.dense = {}
+
+    def chunk_shape(self, chunk_x, chunk_y):
+        """
+        Returns the number of columns and rows in chunk (chunk_x, chunk_y), smaller than chunk_size along the edges.
+        :param chunk_x:
+        :param chunk_y:
+        :return:
+        """
+
+        size = ChunkedTileStore.chunk_size
+
+        return min(size, self.x_tiles - chunk_x * size), min(size, self.y_tiles - chunk_y * size)
+
+    def dense_chunk(self, chunk_x, chunk_y):
+        """
+        Returns the dense palette ids of chunk (chunk_x, chunk_y), expanding it first if it is uniform.
+        :param chunk_x:
+        :param chunk_y:
+        :return:
+        """
+
+        palette_id = self.uniform[chunk_x, chunk_y]
+        if palette_id >= 0:
+            self.dense[chunk_x, chunk_y] = numpy.full(self.chunk_shape(chunk_x, chunk_y), palette_id,
+                                                      dtype=numpy.uint16)
+            self.uniform[chunk_x, chunk_y] = -1
+
+        return self.dense[chunk_x, chunk_y]
+
+    def store_chunk(self, chunk_x, chunk_y, ids):
+        """
+        Stores (ids) as chunk (chunk_x, chunk_y), as a uniform chunk if every id is the same.
+        :param chunk_x:
+        :param chunk_y:
+        :param ids:
+        :return:
+        """
+
+        first = ids[0, 0]
+        if (ids == first).all():
+            self.dense.pop((chunk_x, chunk_y), None)
+            self.uniform[chunk_x, chunk_y] = first
+        else:
+            self.dense[chunk_x, chunk_y] = numpy.array(ids, dtype=numpy.uint16)
+            self.uniform[chunk_x, chunk_y] = -1
+
+    def collapse(self):
+        """
+        Turns dense chunks that only hold one tile state again back into uniform chunks.
+        :return:
+        """
+
+        for chunk_x, chunk_y in list(self.dense):
+            self.store_chunk(chunk_x, chunk_y, self.dense[chunk_x, chunk_y])
+
+    def get_state(self, x, y):
+        """
+        Returns the interned TileState of the tile at (x, y).
+        :param x:
+        :param y:
+        :return: state
+        :return type: TileState
+        """
+
+        size = ChunkedTileStore.chunk_size
+        chunk_x, chunk_y = x // size, y // size
+
+        palette_id = self.uniform[chunk_x, chunk_y]
+        if palette_id < 0:
+            palette_id = self.dense[chunk_x, chunk_y][x - chunk_x * size, y - chunk_y * size]
+
+        return self.palette[palette_id]
+
+    def set_state(self, x, y, state):
+        """
+        Stores (state) at (x, y). Writing the state a uniform chunk already holds leaves it uniform.
+        :param x:
+        :param y:
+        :param state:
+        :return:
+        """
+
+        size = ChunkedTileStore.chunk_size
+        chunk_x, chunk_y = x // size, y // size
+        palette_id = self.state_id(state)
+
+        if self.uniform[chunk_x, chunk_y] == palette_id:
+            return
+
+        self.dense_chunk(chunk_x, chunk_y)[x - chunk_x * size, y - chunk_y * size] = palette_id
+        self.mark_dirty(x)
+
+    def write_runs(self, x_start, x_end, states, run_ids, run_lengths):
+        """
+        Expands runs from decode_tile_runs into columns (x_start) to (x_end), one band of chunk columns at a time.
+        Chunks that end up holding a single tile state are stored uniform.
+        :param x_start:
+        :param x_end:
+        :param states:
+        :param run_ids:
+        :param run_lengths:
+        :return:
+        """
+
+        size = ChunkedTileStore.chunk_size
+
+        run_lengths = numpy.asarray(run_lengths, dtype=numpy.intp)
+
+        if run_lengths.sum() != (x_end - x_start) * self.y_tiles:
+            raise WorldFormatException('Tile runs cover %i tiles instead of %i.' %
+                                       (run_lengths.sum(), (x_end - x_start) * self.y_tiles))
+
+        palette_ids = self.state_ids(states)
+        run_ids = numpy.asarray(run_ids, dtype=numpy.intp)
+        run_ends = numpy.cumsum(run_lengths)
+        run_starts = run_ends - run_lengths
+
+        band_start = x_start
+        while band_start < x_end:
+            chunk_x = band_start // size
+            band_end = min((chunk_x + 1) * size, x_end)
+
+            # Only the runs overlapping this band of columns, cut to the band.
+            low = (band_start - x_start) * self.y_tiles
+            high = (band_end - x_start) * self.y_tiles
+            first = numpy.searchsorted(run_ends, low, 'right')
+            last = numpy.searchsorted(run_starts, high, 'left')
+            lengths = numpy.minimum(run_ends[first:last], high) - numpy.maximum(run_starts[first:last], low)
+
+            ids = numpy.repeat(palette_ids[run_ids[first:last]], lengths).reshape(band_end - band_start,
+                                                                                 self.y_tiles)
+
+            for chunk_y in range(0, self.uniform.shape[1]):
+                block = ids[:, chunk_y * size:(chunk_y + 1) * size]
+                if band_end - band_start == self.chunk_shape(chunk_x, chunk_y)[0]:
+                    self.store_chunk(chunk_x, chunk_y, block)
+                else:
+                    chunk = self.dense_chunk(chunk_x, chunk_y)
+                    chunk[band_start - chunk_x * size:band_end - chunk_x * size] = block
+                    self.store_chunk(chunk_x, chunk_y, chunk)
+
+            band_start = band_end
+
+        self.mark_dirty(x_start, x_end)
+
+    def chunks(self, x_start, x_end, y_start, y_end):
+        """
+        Yields every chunk that overlaps columns (x_start) to (x_end) and rows (y_start) to (y_end), as the chunk
+        position, the overlap relative to the chunk and the overlap relative to the region.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :return:
+        """
+
+        size = ChunkedTileStore.chunk_size
+
+        for chunk_x in range(x_start // size, (x_end + size - 1) // size):
+            low_x = max(x_start, chunk_x * size)
+            high_x = min(x_end, (chunk_x + 1) * size)
+
+            for chunk_y in range(y_start // size, (y_end + size - 1) // size):
+                low_y = max(y_start, chunk_y * size)
+                high_y = min(y_end, (chunk_y + 1) * size)
+
+                yield (chunk_x, chunk_y,
+                       (slice(low_x - chunk_x * size, high_x - chunk_x * size),
+                        slice(low_y - chunk_y * size, high_y - chunk_y * size)),
+                       (slice(low_x - x_start, high_x - x_start), slice(low_y - y_start, high_y - y_start)))
+
+    def get_region(self, x_start, x_end, y_start, y_end):
+        """
+        Returns the tiles of columns (x_start) to (x_end) and rows (y_start) to (y_end) as the palette and the palette
+        id of every tile.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :return: states, array of state ids indexed [x, y] from the corner of the region
+        """
+
+        ids = numpy.empty((x_end - x_start, y_end - y_start), dtype=numpy.uint16)
+
+        for chunk_x, chunk_y, inside, region in self.chunks(x_start, x_end, y_start, y_end):
+            palette_id = self.uniform[chunk_x, chunk_y]
+            if palette_id >= 0:
+                ids[region] = palette_id
+            else:
+                ids[region] = self.dense[chunk_x, chunk_y][inside]
+
+        return list(self.palette), ids
+
+    def set_region(self, x_start, y_start, states, ids, mask=None):
+        """
+        Stores (states), indexed by (ids), an array of state ids for a region with its corner at (x_start, y_start),
+        or only the tiles where (mask) is set. Chunks that end up holding a single tile state are stored uniform.
+        :param x_start:
+        :param y_start:
+        :param states:
+        :param ids:
+        :param mask:
+        :return:
+        """
+
+        width, height = ids.shape
+        values = self.state_ids(states)[ids]
+
+        for chunk_x, chunk_y, inside, region in self.chunks(x_start, x_start + width, y_start, y_start + height):
+            block = values[region]
+            if mask is None and block.shape == self.chunk_shape(chunk_x, chunk_y):
+                self.store_chunk(chunk_x, chunk_y, block)
+                continue
+
+            chunk = self.dense_chunk(chunk_x, chunk_y)
+            if mask is None:
+                chunk[inside] = block
+            else:
+                chunk[inside][mask[region]] = block[mask[region]]
+            self.store_chunk(chunk_x, chunk_y, chunk)
+
+        self.mark_dirty(x_start, x_start + width)
+
+    def fill(self, x_start, x_end, y_start, y_end, state, mask=None):
+        """
+        Stores (state) in every tile of columns (x_start) to (x_end) and rows (y_start) to (y_end), or only where
+        (mask) is set. Chunks covered by the whole region become uniform without being expanded.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :param state:
+        :param mask:
+        :return:
+        """
+
+        palette_id = self.state_id(state)
+
+        for chunk_x, chunk_y, inside, region in self.chunks(x_start, x_end, y_start, y_end):
+            if self.uniform[chunk_x, chunk_y] == palette_id:
+                continue
+
+            covered = mask is None or mask[region].all()
+            if covered and (region[0].stop - region[0].start, region[1].stop - region[1].start) == \
+                    self.chunk_shape(chunk_x, chunk_y):
+                self.dense.pop((chunk_x, chunk_y), None)
+                self.uniform[chunk_x, chunk_y] = palette_id
+                continue
+
+            chunk = self.dense_chunk(chunk_x, chunk_y)
+            if mask is None:
+                chunk[inside] = palette_id
+            else:
+                chunk[inside][mask[region]] = palette_id
+            self.store_chunk(chunk_x, chunk_y, chunk)
+
+        self.mark_dirty(x_start, x_end)
+
+    def runs(self, x_start, x_end):
+        """
+        Finds the runs of identical tiles in columns (x_start) to (x_end). A uniform chunk adds a single run per column
+        before neighbouring runs are merged, only dense chunks are compared tile by tile. Runs never cross columns.
+        :param x_start:
+        :param x_end:
+        :return: distinct states, state id and length of every run, number of runs per column
+        """
+
+        size = ChunkedTileStore.chunk_size
+
+        run_values = []
+        run_lengths = []
+        run_counts = []
+
+        band_start = x_start
+        while band_start < x_end:
+            chunk_x = band_start // size
+            band_end = min((chunk_x + 1) * size, x_end)
+            width = band_end - band_start
+            columns = slice(band_start - chunk_x * size, band_end - chunk_x * size)
+
+            # Every column of the band as a row of (value, length) segments, one per tile of a dense chunk and one per
+            # uniform chunk.
+            values = []
+            lengths = []
+            for chunk_y in range(0, self.uniform.shape[1]):
+                palette_id = self.uniform[chunk_x, chunk_y]
+                if palette_id >= 0:
+                    values.append(numpy.full((width, 1), palette_id, dtype=numpy.uint16))
+                    lengths.append(numpy.full((width, 1), self.chunk_shape(chunk_x, chunk_y)[1], dtype=numpy.intp))
+                else:
+                    chunk = self.dense[chunk_x, chunk_y][columns]
+                    values.append(chunk)
+                    lengths.append(numpy.ones(chunk.shape, dtype=numpy.intp))
+
+            values = numpy.hstack(values)
+            lengths = numpy.hstack(lengths)
+
+            changed = numpy.empty(values.shape, dtype=numpy.bool_)
+            changed[:, 0] = True
+            numpy.not_equal(values[:, 1:], values[:, :-1], out=changed[:, 1:])
+
+            starts = numpy.flatnonzero(changed)
+            run_values.append(values.reshape(-1)[starts])
+            run_lengths.append(numpy.add.reduceat(lengths.reshape(-1), starts))
+            run_counts.append(numpy.count_nonzero(changed, axis=1))
+
+            band_start = band_end
+
+        if not run_values:
+            return [], numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=int)
+
+        used, run_ids = numpy.unique(numpy.concatenate(run_values), return_inverse=True)
+        states = [self.palette[palette_id] for palette_id in used.tolist()]
+
+        return states, run_ids, numpy.concatenate(run_lengths), numpy.concatenate(run_counts)
+
+    def palette_counts(self):
+        """
+        Counts the cells that refer to each palette entry.
+        :return: array of counts indexed by palette id
+        """
+
+        size = ChunkedTileStore.chunk_size
+        areas = numpy.minimum(size, self.x_tiles - numpy.arange(self.uniform.shape[0]) * size)[:, None] * \
+            numpy.minimum(size, self.y_tiles - numpy.arange(self.uniform.shape[1]) * size)[None, :]
+
+        uniform = self.uniform >= 0
+        counts = numpy.bincount(self.uniform[uniform], weights=areas[uniform], minlength=len(self.palette))
+        counts = counts.astype(numpy.int64)
+        for chunk in self.dense.values():
+            counts += numpy.bincount(chunk.reshape(-1), minlength=len(self.palette))
+
+        return counts
+
+    def renumber(self, mapping):
+        """
+        Replaces every palette id in the store by its entry in (mapping).
+        :param mapping:
+        :return:
+        """
+
+        uniform = self.uniform >= 0
+        self.uniform[uniform] = mapping[self.uniform[uniform]]
+        for key, chunk in self.dense.items():
+            self.dense[key] = mapping[chunk]
+
+    def clear(self):
+        """
+        Resets every tile to an empty Tile.
+        :return:
+        """
+
+        self.uniform.fill(0)
+        self.dense = {}
+        self.palette = [TileState()]
+        self.palette_ids = {TileState(): 0}
+        self.mark_dirty(0, self.x_tiles)
+
+    def memory_usage(self):
+        """
+        Returns the bytes used by each part of the store, by name. The palette counts its list and index, the states
+        in it are shared by every store.
+        :return:
+        """
+
+        usage = TileStore.memory_usage(self)
+        usage['uniform chunks'] = self.uniform.nbytes
+        usage['dense chunks'] = sys.getsizeof(self.dense) + sum(chunk.nbytes for chunk in self.dense.values())
+        usage['palette'] = object_size([self.palette, self.palette_ids])
+
+        return usage
+
+
+class RunLengthTileStore(TileStore):
+    """
+    Run-length storage for the tiles of a Map, the in-memory counterpart of the file format. Every column is a sorted
+    list of run starts and a list of the TileState of each run, a run lasts until the next start or the bottom of the
+    column. Neighbouring runs never hold the same state. Reads are binary searches, writes split and merge runs, and
+    loading or saving costs about as much as the number of runs.
+    """
+
+    def __init__(self, x_tiles, y_tiles):
+        """
+        Initializes the store with (x_tiles) by (y_tiles) empty tiles, a single run per column.
+        :param x_tiles:
+        :param y_tiles:
+        :return:
+        """
+
+        self.x_tiles = x_tiles
+        self.y_tiles = y_tiles
+        self.starts = [[0] for x in range(0, x_tiles)]
+        self.states = [[TileState()] for x in range(0, x_tiles)]
+
+    def get_state(self, x, y):
+        """
+        Returns the interned TileState of the tile at (x, y).
+        :param x:
+        :param y:
+        :return: state
+        :return type: TileState
+        """
+
+        return self.states[x][bisect.bisect_right(self.starts[x], y) - 1]
+
+    def set_state(self, x, y, state):
+        """
+        Stores (state) at (x, y), splitting the run it lands in and merging it with equal neighbours.
+        :param x:
+        :param y:
+        :param state:
+        :return:
+        """
+
+        starts = self.starts[x]
+        states = self.states[x]
+
+        i = bisect.bisect_right(starts, y) - 1
+        old = states[i]
+        if old is state:
+            return
+
+        start = starts[i]
+        end = starts[i + 1] if i + 1 < len(starts) else self.y_tiles
+
+        new_starts = []
+        new_states = []
+        if y > start:
+            new_starts.append(start)
+            new_states.append(old)
+        new_starts.append(y)
+        new_states.append(state)
+        if y + 1 < end:
+            new_starts.append(y + 1)
+            new_states.append(old)
+
+        starts[i:i + 1] = new_starts
+        states[i:i + 1] = new_states
+        self.mark_dirty(x)
+        if y > start:
+            i += 1
+
+        # The run at (y) is now i, merge it into the runs around it where they hold the same state.
+        if i + 1 < len(states) and states[i + 1] is state:
+            del starts[i + 1]
+            del states[i + 1]
+        if i > 0 and states[i - 1] is state:
+            del starts[i]
+            del states[i]
+
+    def write_runs(self, x_start, x_end, states, run_ids, run_lengths):
         """
-        Generate a bytestring for eventual saving.
+        Replaces columns (x_start) to (x_end) by runs from decode_tile_runs, cut at column boundaries and with
+        neighbouring runs of the same state merged.
+        :param x_start:
+        :param x_end:
+        :param states:
+        :param run_ids:
+        :param run_lengths:
         :return:
         """
 
-        blist = []
+        run_lengths = numpy.asarray(run_lengths, dtype=numpy.intp)
+        total = (x_end - x_start) * self.y_tiles
 
-        prev_tile = None
-        rle = 0
+        if run_lengths.sum() != total:
+            raise WorldFormatException('Tile runs cover %i tiles instead of %i.' % (run_lengths.sum(), total))
 
-        for x in range(0, self.x_tiles):
-            for y in range(0, self.y_tiles):
+        run_ids = numpy.asarray(run_ids, dtype=numpy.intp)
+        run_ends = numpy.cumsum(run_lengths)
 
-                tile = self.map[x][y]
+        # Every run start and column start, with the run covering it.
+        starts = numpy.union1d(run_ends - run_lengths, numpy.arange(0, total, self.y_tiles))
+        ids = run_ids[numpy.searchsorted(run_ends, starts, 'right')]
+        columns = starts // self.y_tiles
 
-                if prev_tile is None:
-                    prev_tile = tile
-                    rle = 0
-                elif tile == prev_tile:
-                    rle += 1
-                else:
-                    blist.append([prev_tile.generate_bytestring(rle, self.tile_importance), prev_tile.tile_type, rle])
-                    rle = 0
-                    prev_tile = tile
+        keep = numpy.ones(len(starts), dtype=numpy.bool_)
+        keep[1:] = (ids[1:] != ids[:-1]) | (columns[1:] != columns[:-1])
+        starts = (starts[keep] % self.y_tiles).tolist()
+        ids = ids[keep].tolist()
+        bounds = numpy.searchsorted(columns[keep], numpy.arange(0, x_end - x_start + 1)).tolist()
 
-            if prev_tile is not None:
-                blist.append([prev_tile.generate_bytestring(rle, self.tile_importance), prev_tile.tile_type, rle])
-                prev_tile = None
-                rle = 0
+        for x in range(x_start, x_end):
+            first = bounds[x - x_start]
+            last = bounds[x - x_start + 1]
+            self.starts[x] = starts[first:last]
+            self.states[x] = [states[i] for i in ids[first:last]]
 
-        bstring = b''.join(b[0] for b in blist)
+        self.mark_dirty(x_start, x_end)
 
-        return bstring
+    def column_ids(self, x, state_ids):
+        """
+        Returns the state of every tile of column (x) as an id in (state_ids), a dict of ids keyed by state that new
+        states are added to.
+        :param x:
+        :param state_ids:
+        :return:
+        """
 
+        starts = self.starts[x]
+        ids = [state_ids.setdefault(state, len(state_ids)) for state in self.states[x]]
 
-class Tile():
-    """
-    Object representing a single Tile in Terraria
-    """
+        return numpy.repeat(ids, numpy.diff(starts + [self.y_tiles]))
 
-    def __init__(self):
+    def store_column(self, x, states, ids):
         """
-        Initializes the Tile Object
+        Replaces column (x) by the runs of (ids), the id in (states) of every tile.
+        :param x:
+        :param states:
+        :param ids:
         :return:
         """
 
-        self.active = False
-        self.tile_type = None
-        self.u = -1
-        self.v = -1
-        self.color = None
-        self.wall = None
-        self.wall_color = None
-        self.liquid_type = 0
-        self.liquid_amount = None
-        self.wire_red = False
-        self.wire_blue = False
-        self.wire_green = False
-        self.brick_style = 0
-        self.actuator = False
-        self.actuator_inactive = False
+        starts = numpy.flatnonzero(numpy.concatenate(([True], ids[1:] != ids[:-1])))
 
-    def __eq__(self, other):
+        self.starts[x] = starts.tolist()
+        self.states[x] = [states[i] for i in ids[starts].tolist()]
+
+    def get_region(self, x_start, x_end, y_start, y_end):
         """
-        Tests if two Tiles are equal to one another.
-        :param other:
+        Returns the tiles of columns (x_start) to (x_end) and rows (y_start) to (y_end) as distinct states and the
+        state id of every tile.
+        :param x_start:
+        :param x_end:
+        :param y_start:
+        :param y_end:
+        :return: states, array of state ids indexed [x, y] from the corner of the region
+        """
+
+        state_ids = {}
+        ids = numpy.empty((x_end - x_start, y_end - y_start), dtype=numpy.intp)
+
+        for x in range(x_start, x_end):
+            ids[x - x_start] = self.column_ids(x, state_ids)[y_start:y_end]
+
+        return list(state_ids), ids
+
+    def set_region(self, x_start, y_start, states, ids, mask=None):
+        """
+        Stores (states), indexed by (ids), an array of state ids for a region with its corner at (x_start, y_start),
+        or only the tiles where (mask) is set. Every column of the region is run-length encoded again.
+        :param x_start:
+        :param y_start:
+        :param states:
+        :param ids:
+        :param mask:
         :return:
         """
 
-        if isinstance(other, Tile):
-            return (
-                self.active == other.active and
-                self.tile_type == other.tile_type and
-                self.u == other.u and
-                self.v == other.v and
-                self.color == other.color and
-                self.wall == other.wall and
-                self.wall_color == other.wall_color and
-                self.liquid_type == other.liquid_type and
-                self.liquid_amount == other.liquid_amount and
-                self.wire_red == other.wire_red and
-                self.wire_blue == other.wire_blue and
-                self.wire_green == other.wire_green and
-                self.brick_style == other.brick_style and
-                self.actuator == other.actuator and
-                self.actuator_inactive == other.actuator_inactive
-            )
-        else:
-            return NotImplemented
+        width, height = ids.shape
 
-    def clone(self):
+        for x in range(x_start, x_start + width):
+            state_ids = {}
+            column = self.column_ids(x, state_ids)
+
+            # Ids of the column come first, then those of (states). The same state can be in both, or twice in
+            # (states), so every id is mapped to the first one of its state before looking for runs.
+            column_states = list(state_ids) + list(states)
+            canonical = {}
+            first = numpy.array([canonical.setdefault(state, i) for i, state in enumerate(column_states)],
+                                dtype=numpy.intp)
+
+            region = ids[x - x_start] + len(state_ids)
+            if mask is None:
+                column[y_start:y_start + height] = region
+            else:
+                rows = mask[x - x_start]
+                column[y_start:y_start + height][rows] = region[rows]
+
+            self.store_column(x, column_states, first[column])
+
+        self.mark_dirty(x_start, x_start + width)
+
+    def runs(self, x_start, x_end):
         """
-        Returns a copy of self tile object.
-        :return: tile
-        :return type: Tile
+        Returns the runs of columns (x_start) to (x_end) as they are stored.
+        :param x_start:
+        :param x_end:
+        :return: distinct states, state id and length of every run, number of runs per column
         """
 
-        tile = Tile()
+        state_ids = {}
+        run_ids = []
+        run_lengths = []
+        run_counts = []
 
-        tile.active = self.active
-        tile.tile_type = self.tile_type
-        tile.u = self.u
-        tile.v = self.v
-        tile.color = self.color
-        tile.wall = self.wall
-        tile.wall_color = self.wall_color
-        tile.liquid_type = self.liquid_type
-        tile.liquid_amount = self.liquid_amount
-        tile.wire_red = self.wire_red
-        tile.wire_blue = self.wire_blue
-        tile.wire_green = self.wire_green
-        tile.brick_style = self.brick_style
-        tile.actuator = self.actuator
-        tile.actuator_inactive = self.actuator_inactive
+        for x in range(x_start, x_end):
+            starts = self.starts[x]
+            run_counts.append(len(starts))
+            run_lengths.extend(end - start for start, end in zip(starts, starts[1:] + [self.y_tiles]))
+            run_ids.extend(state_ids.setdefault(state, len(state_ids)) for state in self.states[x])
 
-        return tile
+        return list(state_ids), run_ids, run_lengths, run_counts
+
+    def state_counts(self):
+        """
+        Counts the tiles of every state in the store.
+        :return: dict of tile counts keyed by state
+        """
+
+        states, run_ids, run_lengths, run_counts = self.runs(0, self.x_tiles)
+        counts = numpy.bincount(numpy.asarray(run_ids, dtype=numpy.intp), weights=run_lengths,
+                                minlength=len(states))
+
+        return dict(zip(states, counts.astype(numpy.int64).tolist()))
+
+    def tile_type_counts(self):
+        """
+        Counts the active tiles of every tile type.
+        :return: array of counts indexed by tile type
+        """
+
+        counts = numpy.zeros(1, dtype=numpy.int64)
+        for state, count in self.state_counts().items():
+            if state.active and state.tile_type is not None:
+                if state.tile_type >= len(counts):
+                    counts = numpy.concatenate([counts, numpy.zeros(state.tile_type + 1 - len(counts), numpy.int64)])
+                counts[state.tile_type] += count
+
+        return counts
+
+    def clear(self):
+        """
+        Resets every tile to an empty Tile.
+        :return:
+        """
+
+        self.starts = [[0] for x in range(0, self.x_tiles)]
+        self.states = [[TileState()] for x in range(0, self.x_tiles)]
+        self.mark_dirty(0, self.x_tiles)
 
     def validate(self):
         """
-        Validates the Tile
+        Validates every tile in the store by validating each state in use. Mirrors Tile.validate.
         :return:
         """
-        if self.active is False:
-            return True
-        else:
-            if self.tile_type is None:
-                return False
 
-        return True
+        return all(state.validate() for states in self.states for state in set(states))
 
-    def generate_bytestring(self, rle, tile_importance):
+    def memory_usage(self):
         """
-        Generate a byte array for the tile to eventually save.
+        Returns the bytes used by each part of the store, by name. The states of the runs are shared by every store,
+        only the lists that refer to them are counted.
         :return:
         """
 
-        bstring = b''
+        usage = TileStore.memory_usage(self)
+        usage['run starts'] = object_size(self.starts)
+        usage['run states'] = object_size(self.states)
 
-        header_1 = 0
-        header_2 = 0
-        header_3 = 0
+        return usage
 
-        if rle == 0:
-            pass
-        elif rle > 255:
-            header_1 |= 128
-        else:
-            header_1 |= 64
 
-        if self.active:
-            header_1 |= 2
+def _release_shared_memory(shared_memory, unlink):
+    """
+    Closes (shared_memory) and unlinks it if (unlink). Used as finalizer of shared ColumnarTileStores.
+    :param shared_memory:
+    :param unlink:
+    :return:
+    """
 
-        if self.wall is not None:
-            header_1 |= 4
+    try:
+        shared_memory.close()
+    except BufferError:
+        pass  # Some field array outlived its store, the mapping goes away with it.
 
-        if self.tile_type is not None and self.tile_type > 255:
-            header_1 |= 32
+    if unlink:
+        shared_memory.unlink()
 
-        if self.wire_red:
-            header_2 |= 2
-        if self.wire_green:
-            header_2 |= 4
-        if self.wire_blue:
-            header_2 |= 8
 
-        if self.brick_style != 0:
-            header_2 |= (self.brick_style << 4)
+def _decode_shared_columns(name, x_tiles, y_tiles, tile_importance, x_start, x_end, data):
+    """
+    Worker process side of Map.load_map with processes. Decodes (data), the records of columns (x_start) to (x_end),
+    into the shared store named (name).
+    :param name:
+    :param x_tiles:
+    :param y_tiles:
+    :param tile_importance:
+    :param x_start:
+    :param x_end:
+    :param data:
+    :return:
+    """
 
-        if self.actuator:
-            header_3 |= 2
-        if self.actuator_inactive:
-            header_3 |= 4
-        if self.color is not None:
-            header_3 |= 8
-        if self.wall_color is not None:
-            header_3 |= 16
+    states, run_ids, run_lengths, end = decode_tile_runs(data, 0, x_end - x_start, y_tiles, tile_importance)
 
-        if header_3 > 0:
-            header_2 |= 1
-        if header_2 > 0:
-            header_1 |= 1
+    if end != len(data):
+        raise WorldFormatException('Columns %i to %i do not end at their column offset.' % (x_start, x_end))
 
-        header_1 |= self.liquid_type
+    store = ColumnarTileStore(x_tiles, y_tiles, attach=name)
+    store.write_runs(x_start, x_end, states, run_ids, run_lengths)
 
-        bstring += pack('<B', header_1)
-        if header_1 & 1 == 1:
-            bstring += pack('<B', header_2)
-        if header_2 & 1 == 1:
-            bstring += pack('<B', header_3)
 
-        if self.tile_type is not None:
-            if self.tile_type < 255:
-                bstring += pack('<B', self.tile_type)
-            else:
-                bstring += pack('<h', self.tile_type)
+def _encode_shared_columns(name, x_tiles, y_tiles, tile_importance, x_start, x_end):
+    """
+    Worker process side of Map.encode_tiles with processes. Encodes columns (x_start) to (x_end) of the shared
+    store named (name).
+    :param name:
+    :param x_tiles:
+    :param y_tiles:
+    :param tile_importance:
+    :param x_start:
+    :param x_end:
+    :return:
+    """
 
-            if tile_importance[self.tile_type]:
-                bstring += pack('<h', self.u)
-                bstring += pack('<h', self.v)
+    map = Map(tile_importance, 0, 0)
+    map.x_tiles = x_tiles
+    map.y_tiles = y_tiles
+    map.map = ColumnarTileStore(x_tiles, y_tiles, attach=name)
 
-        if self.color is not None:
-            bstring += pack('<B', self.color)
+    return b''.join(map.encode_tiles(x_start, x_end))
 
-        if self.wall is not None:
-            bstring += pack('<B', self.wall)
 
-        if self.wall_color is not None:
-            bstring += pack('<B', self.wall_color)
+class TileColumn():
+    """
+    A single x column of a TileStore, indexed by y.
+    """
 
-        if self.liquid_amount is not None and self.liquid_amount > 0:
-            bstring += pack('<B', self.liquid_amount)
+    def __init__(self, store, x):
+        """
+        Initializes the Object
+        :param store:
+        :param x:
+        :return:
+        """
 
-        if rle > 255:
-            bstring += pack('<h', rle)
-        elif rle > 0:
-            bstring += pack('<B', rle)
+        self.store = store
+        self.x = x
 
-        return bstring
+    def __len__(self):
+        return self.store.y_tiles
 
-    def desc(self):
+    def __getitem__(self, y):
         """
-        Describes and returns the current tile.
+        Returns a TileView of the tile at (y) in this column.
+        :param y:
+        :return: tile
+        :return type: TileView
+        """
+
+        if y < 0:
+            y += self.store.y_tiles
+        if y < 0 or y >= self.store.y_tiles:
+            raise IndexError('Tile %s out of range.' % y)
+
+        return TileView(self.store, self.x, y)
+
+    def __setitem__(self, y, tile):
+        """
+        Copies (tile) into this column at (y).
+        :param y:
+        :param tile:
         :return:
         """
 
-        desc = '''
-        Active Status: %s
-        Tile Type: %s
-        U: %s
-        V: %s
-        Color: %s
-        Wall: %s
-        Wall Color: %s
-        Liquid Type: %s
-        Liquid Amount: %s
-        Red Wire: %s
-        Green Wire: %s
-        Blue Wire: %s
-        Brick Style: %s
-        Actuator: %s
-        Actuator Inactive: %s
-        ''' % (
-            self.active,
-            self.tile_type,
-            self.u,
-            self.v,
-            self.color,
-            self.wall,
-            self.wall_color,
-            self.liquid_type,
-            self.liquid_amount,
-            self.wire_red,
-            self.wire_blue,
-            self.wire_green,
-            self.brick_style,
-            self.actuator,
-            self.actuator_inactive
-        )
+        if y < 0:
+            y += self.store.y_tiles
+        if y < 0 or y >= self.store.y_tiles:
+            raise IndexError('Tile %s out of range.' % y)
 
-        return desc
+        self.store.set_tile(self.x, y, tile)
+
+    def __iter__(self):
+        for y in range(0, self.store.y_tiles):
+            yield TileView(self.store, self.x, y)
+
+
+class TileView(Tile):
+    """
+    A Tile whose fields read and write through to a position in a TileStore.
+    """
+
+    def __init__(self, store, x, y):
+        """
+        Initializes the Object. Does not call Tile.__init__, the fields live in (store).
+        :param store:
+        :param x:
+        :param y:
+        :return:
+        """
+
+        self.store = store
+        self.x = x
+        self.y = y
+
+    def freeze(self):
+        """
+        Returns the interned TileState of the tile this view points at.
+        :return: state
+        :return type: TileState
+        """
+
+        return self.store.get_state(self.x, self.y)
+
+
+def _tile_view_property(name):
+    """
+    Returns a property that proxies Tile field (name) to the store of a TileView.
+    :param name:
+    :return:
+    """
 
+    def getter(self):
+        return self.store.get_field(self.x, self.y, name)
 
+    def setter(self, value):
+        self.store.set_field(self.x, self.y, name, value)
+
+    return property(getter, setter)
+
+
+for _name in TILE_FIELD_NAMES:
+    setattr(TileView, _name, _tile_view_property(_name))
 
 
 class Chests():
@@ -1202,26 +4161,26 @@ class Chests():
         :return:
         """
 
-        bstring = b''
+        bstring = []
 
         self.total_chests = len(self.chests)
 
-        bstring += pack('<h', self.total_chests)
-        bstring += pack('<h', self.max_items)
+        bstring.append(pack('<h', self.total_chests))
+        bstring.append(pack('<h', self.max_items))
 
         for chest in self.chests:
-            bstring += pack('<i', chest.x)
-            bstring += pack('<i', chest.y)
+            bstring.append(pack('<i', chest.x))
+            bstring.append(pack('<i', chest.y))
             string = store_pstring(chest.name)
-            bstring += string
+            bstring.append(string)
 
             for item in chest.items:
-                bstring += pack('<h', item[0])
+                bstring.append(pack('<h', item[0]))
                 if item[0] > 0:
-                    bstring += pack('<i', item[1])
-                    bstring += pack('<B', item[2])
+                    bstring.append(pack('<i', item[1]))
+                    bstring.append(pack('<B', item[2]))
 
-        return bstring
+        return b''.join(bstring)
 
     def clear_chests(self):
         """
@@ -1325,16 +4284,16 @@ class Signs():
         :return:
         """
 
-        bstring = b''
+        bstring = []
 
-        bstring += pack('<h', len(self.signs))
+        bstring.append(pack('<h', len(self.signs)))
 
         for sign in self.signs:
-            bstring += store_pstring(sign.text)
-            bstring += pack('<i', sign.x)
-            bstring += pack('<i', sign.y)
+            bstring.append(store_pstring(sign.text))
+            bstring.append(pack('<i', sign.x))
+            bstring.append(pack('<i', sign.y))
 
-        return bstring
+        return b''.join(bstring)
 
     def clear_signs(self):
         """
@@ -1432,21 +4391,21 @@ class NPCs():
         :return:
         """
 
-        bytestring = b''
+        bytestring = []
 
         for npc in self.npcs:
-            bytestring += pack('<?', True)
-            bytestring += store_pstring(npc.name)
-            bytestring += store_pstring(npc.display_name)
-            bytestring += pack('<f', npc.x)
-            bytestring += pack('<f', npc.y)
-            bytestring += pack('<?', npc.is_homeless)
-            bytestring += pack('<i', npc.home_x)
-            bytestring += pack('<i', npc.home_y)
+            bytestring.append(pack('<?', True))
+            bytestring.append(store_pstring(npc.name))
+            bytestring.append(store_pstring(npc.display_name))
+            bytestring.append(pack('<f', npc.x))
+            bytestring.append(pack('<f', npc.y))
+            bytestring.append(pack('<?', npc.is_homeless))
+            bytestring.append(pack('<i', npc.home_x))
+            bytestring.append(pack('<i', npc.home_y))
 
-        bytestring += pack('<?', False)
+        bytestring.append(pack('<?', False))
 
-        return bytestring
+        return b''.join(bytestring)
 
     def clear_npcs(self):
         """
@@ -1554,10 +4513,10 @@ class Footer():
         :return:
         """
 
-        bstring = b''
+        bstring = []
 
-        bstring += pack('<?', self.valid)
-        bstring += store_pstring(self.title)
-        bstring += pack('<i', self.world_id)
+        bstring.append(pack('<?', self.valid))
+        bstring.append(store_pstring(self.title))
+        bstring.append(pack('<i', self.world_id))
 
-        return bstring
\ No newline at end of file
+        return b''.join(bstring)
\ No newline at end of file
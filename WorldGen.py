@@ -1,7 +1,11 @@
 __author__ = 'James Dozier'
 
+from concurrent.futures import ProcessPoolExecutor
 import Terraria
-import random
+import functools
+import inspect
+import numpy
+import zlib
 
 
 class WorldGenerationException(Exception):
@@ -10,124 +14,631 @@ class WorldGenerationException(Exception):
         Exception.__init__(self, 'WorldGenerationException: %s' % msg)
 
 
+class Stencil():
+    """
+    A precomputed block of tiles that can be stamped into a map: (states), Tiles or TileStates, indexed by (ids), a 2D
+    array of state ids indexed [x, y], and the tiles it covers in (mask), all of them if None. Stencils come out of the
+    caches below and are shared, so their arrays are read only.
+    """
+
+    def __init__(self, states, ids, mask=None):
+        """
+        Initializes the Stencil
+        :param states:
+        :param ids:
+        :param mask:
+        :return:
+        """
+        self.states = tuple(state.freeze() for state in states)
+        self.ids = numpy.asarray(ids, dtype=numpy.intp)
+        self.mask = None if mask is None else numpy.asarray(mask, dtype=bool)
+
+        self.ids.flags.writeable = False
+        if self.mask is not None:
+            self.mask.flags.writeable = False
+
+    @property
+    def width(self):
+        return self.ids.shape[0]
+
+    @property
+    def height(self):
+        return self.ids.shape[1]
+
+
+# Upper bound on the entries of each stencil cache, least recently used ones are dropped first.
+STENCIL_CACHE_SIZE = 512
+
+
+@functools.lru_cache(maxsize=STENCIL_CACHE_SIZE)
+def ore_cluster_rows(size_x, size_y):
+    """
+    Returns the parabola shaped row layout of an ore cluster (size_x) wide and (size_y) high before any wiggle: the
+    row, the number of tiles left out on its left and the number of tiles of every row that has tiles. A wiggle is a
+    shift of every row, added to its offset. The arrays are shared, so they are read only.
+    :param size_x:
+    :param size_y:
+    :return: rows, offsets, counts
+    """
+    center = size_y // 2
+    rows = numpy.arange(0, size_y)  # rows stand for y
+    counts = size_x - (rows - center) ** 2 // 5
+
+    rows = rows[counts > 0]
+    counts = counts[counts > 0]
+    offsets = (size_x - counts) // 2
+
+    for array in (rows, offsets, counts):
+        array.flags.writeable = False
+
+    return rows, offsets, counts
+
+
+@functools.lru_cache(maxsize=STENCIL_CACHE_SIZE)
+def frame_stencil(tile_type, u, v, width=2, height=2):
+    """
+    Returns the Stencil of a (width) by (height) multi-tile object of (tile_type) whose top left frame is at (u, v).
+    Frames are 18 pixels apart.
+    :param tile_type:
+    :param u:
+    :param v:
+    :param width:
+    :param height:
+    :return: stencil
+    :return type: Stencil
+    """
+    states = []
+    for i in range(0, width):
+        for j in range(0, height):
+            states.append(Terraria.TileState(active=True, tile_type=tile_type, u=u + 18 * i, v=v + 18 * j))
+
+    return Stencil(states, numpy.arange(0, width * height).reshape(width, height))
+
+
+def lattice_values(seed, octave, points):
+    """
+    Returns a value in [-1, 1) for every integer lattice point in (points), from a hash of (seed), (octave) and the
+    point, so the value of a point never depends on which other points are asked for.
+    :param seed:
+    :param octave:
+    :param points:
+    :return:
+    """
+    h = numpy.asarray(points, dtype=numpy.int64).astype(numpy.uint64)
+    h *= numpy.uint64(0x9E3779B97F4A7C15)
+    h ^= numpy.uint64((seed * 0x100000001B3 + octave) & 0xFFFFFFFFFFFFFFFF)
+
+    # splitmix64 finalizer
+    h ^= h >> numpy.uint64(30)
+    h *= numpy.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> numpy.uint64(27)
+    h *= numpy.uint64(0x94D049BB133111EB)
+    h ^= h >> numpy.uint64(31)
+
+    return (h >> numpy.uint64(11)).astype(numpy.float64) / 2.0 ** 52 - 1
+
+
+def value_noise(x, seed, wavelength, octaves=4, persistence=0.5):
+    """
+    Returns fractal 1D value noise in [-1, 1] at positions (x). Every octave smoothly interpolates lattice_values
+    spaced (wavelength) apart, then halves the wavelength and scales its amplitude by (persistence).
+    :param x:
+    :param seed:
+    :param wavelength:
+    :param octaves:
+    :param persistence:
+    :return:
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+
+    total = numpy.zeros(x.shape)
+    amplitude = 1.0
+    norm = 0.0
+
+    for octave in range(0, octaves):
+        position = x / wavelength
+        points = numpy.floor(position)
+        t = position - points
+        t = t * t * (3 - 2 * t)
+
+        low = lattice_values(seed, octave, points)
+        high = lattice_values(seed, octave, points + 1)
+        total += amplitude * (low + (high - low) * t)
+
+        norm += amplitude
+        amplitude *= persistence
+        wavelength /= 2.0
+
+    return total / norm
+
+
+def settle_liquid(amount, open_tiles, max_iterations=1000, threshold=12, block_width=16):
+    """
+    Lets the liquid in (amount), a 2D integer array of liquid amounts from 0 to 255 indexed [x, y], fall and level out
+    in place over the tiles where (open_tiles) is set. Every iteration each tile passes down as much as fits in the
+    tile below, then neighbouring tiles in a row even out a third of their difference if it is at least (threshold).
+    Only blocks of (block_width) columns that changed, or are next to ones that did, are worked on, and it stops
+    early once nothing changes.
+    :param amount:
+    :param open_tiles:
+    :param max_iterations:
+    :param threshold:
+    :param block_width:
+    :return: number of iterations run
+    """
+    width = amount.shape[0]
+    blocks = -(-width // block_width)
+    awake = numpy.ones(blocks, dtype=bool)
+
+    for iteration in range(0, max_iterations):
+        if not awake.any():
+            return iteration
+
+        # Columns of the awake blocks and one on either side of them, which they can pass liquid to.
+        columns = numpy.repeat(awake, block_width)[:width]
+        columns[1:] |= columns[:-1].copy()
+        columns[:-1] |= columns[1:].copy()
+        columns = numpy.flatnonzero(columns)
+
+        before = amount[columns]
+        current = before.copy()
+        space = open_tiles[columns]
+
+        down = numpy.minimum(current[:, :-1], 255 - current[:, 1:])
+        down *= space[:, 1:]
+        current[:, :-1] -= down
+        current[:, 1:] += down
+
+        # Liquid only flows between open neighbours that are next to each other in the map.
+        difference = current[:-1] - current[1:]
+        flows = space[:-1] & space[1:] & (numpy.diff(columns) == 1)[:, None] & \
+            ((difference >= threshold) | (difference <= -threshold))
+
+        # A third of the difference rounded toward zero, so flows both ways are the same.
+        negative = difference < 0
+        difference += negative
+        difference += negative
+        flow = difference // 3
+        flow *= flows
+        current[:-1] -= flow
+        current[1:] += flow
+
+        changed = columns[(current != before).any(axis=1)] // block_width
+        amount[columns] = current
+
+        awake[:] = False
+        awake[changed] = True
+        awake[numpy.maximum(changed - 1, 0)] = True
+        awake[numpy.minimum(changed + 1, blocks - 1)] = True
+
+    return max_iterations
+
+
+def generation_pass(method=None, margin=0):
+    """
+    Decorates a WorldGenerator pass so the Instrumentation of the generator, if any, records every call of it, with
+    the tiles of the columns it was called on. The pass declares the region it reads and writes: at most (margin)
+    columns beyond x_start and x_end, or None if it needs the whole world at once. GenerationPipeline stages use it
+    unless they are given their own. Used as @generation_pass or @generation_pass(margin=...).
+    :param method:
+    :param margin:
+    :return:
+    """
+    if method is None:
+        return functools.partial(generation_pass, margin=margin)
+
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def run_pass(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        x_start = arguments.arguments['x_start']
+        x_end = arguments.arguments['x_end']
+        if x_end is None:
+            x_end = self.world.header.x_tiles
+
+        with self.instrumentation.record('generate', method.__name__) as record:
+            result = method(self, *args, **kwargs)
+
+        record['counts'] = {'tiles': max(x_end - x_start, 0) * self.world.header.y_tiles}
+
+        return result
+
+    run_pass.margin = margin
+
+    return run_pass
+
+
 class WorldGenerator():
     """
-    Main class that generates worlds.
+    Main class that generates worlds. Everything random is drawn from streams derived from the seed, one per pass and
+    per strip of strip_width columns (see stream), so a pass gives the same world however its columns are split up.
     """
 
-    def __init__(self, world):
+    # Width in columns of the strips that get their own random stream. Changing it changes the generated worlds.
+    strip_width = 256
+
+    # Columns an ore cluster can reach beyond the column it starts in, see ore_cluster_mask.
+    ore_margin = 100
+
+    # Rows of the underworld at the bottom of the world, the layers above it end at underworld_level.
+    underworld_height = 200
+
+    def __init__(self, world, seed=None, instrumentation=None):
         """
         Initializes the Generator
         :param world: Terraria.World object
+        :param seed: seed every random stream is derived from, a fresh one (kept in self.seed) if None
+        :param instrumentation: Terraria.Instrumentation that records every generation pass
         :return:
         """
         self.world = world
+        self.instrumentation = instrumentation
+
+        if seed is None:
+            seed = numpy.random.SeedSequence().entropy
+        self.seed = seed
+
+        # Stream for helpers that are not tied to a pass or strip, like add_ore_cluster.
+        self.random = numpy.random.default_rng(numpy.random.SeedSequence(seed))
+
+    def stream(self, name, strip=0):
+        """
+        Returns the random number generator of pass (name) for strip (strip). It only depends on the seed, (name) and
+        (strip), never on what was drawn from other streams, so strips can be generated in any order or process.
+        :param name:
+        :param strip:
+        :return: generator
+        :return type: numpy.random.Generator
+        """
+        key = zlib.crc32(name.encode('utf-8'))
+
+        return numpy.random.default_rng(numpy.random.SeedSequence(self.seed, spawn_key=(key, strip)))
+
+    def strips(self, x_start, x_end):
+        """
+        Yields every strip that overlaps columns (x_start) to (x_end), as the strip number and its first and last
+        column.
+        :param x_start:
+        :param x_end:
+        :return:
+        """
+        width = WorldGenerator.strip_width
+
+        for strip in range(x_start // width, (x_end + width - 1) // width):
+            yield strip, strip * width, min((strip + 1) * width, self.world.header.x_tiles)
+
+    def underworld_level(self):
+        """
+        Returns the row the underworld starts at, underworld_height rows above the bottom of the world.
+        :return:
+        """
+        return max(int(self.world.header.y_tiles) - WorldGenerator.underworld_height, 0)
 
-    def fill_dirt(self):
+    @generation_pass
+    def fill_dirt(self, x_start=0, x_end=None):
         """
-        Fills in the layer between surface and underworld with dirt.
+        Fills in the layer between surface and underworld with dirt, in columns (x_start) to (x_end) if given.
+        :param x_start:
+        :param x_end:
         :return:
         """
-        dirt = Terraria.Tile()
-        dirt.active = True
-        dirt.tile_type = 0
+        if x_end is None:
+            x_end = self.world.header.x_tiles
+
+        dirt = Terraria.TileState(active=True, tile_type=0)
+
+        self.world.map.fill_rect(x_start, x_end, self.world.header.surface_level, self.underworld_level(), dirt)
+
+    @generation_pass
+    def surface_terrain(self, amplitude=40, wavelength=512, octaves=5, x_start=0, x_end=None):
+        """
+        Lays out hilly terrain in columns (x_start) to (x_end): value_noise moves the surface of every column up to
+        (amplitude) tiles around the surface level and the top of the stone layer half as much around the rock layer.
+        Above the surface is air, then dirt, then stone down to the underworld, written in one bulk write.
+        :param amplitude:
+        :param wavelength: columns between the hills of the broadest octave
+        :param octaves:
+        :param x_start:
+        :param x_end:
+        :return: surface row of every column
+        """
+        if x_end is None:
+            x_end = self.world.header.x_tiles
+
+        # Noise is a function of the absolute column, so strips line up with each other.
+        seed = int(self.stream('surface_terrain').integers(0, 2 ** 63))
+        x = numpy.arange(x_start, x_end)
+
+        surface = int(self.world.header.surface_level) + numpy.rint(
+            amplitude * value_noise(x, seed, wavelength, octaves)).astype(numpy.intp)
+        rock = int(self.world.header.rock_layer) + numpy.rint(
+            amplitude / 2 * value_noise(x, seed + 1, wavelength / 2, octaves)).astype(numpy.intp)
+        rock = numpy.maximum(rock, surface)
+
+        # The same top row for every strip, so rows above the surface are cleared however the columns are split up.
+        top = max(int(self.world.header.surface_level) - int(numpy.ceil(amplitude)), 0)
+        bottom = self.underworld_level()
+
+        if top < bottom:
+            y = numpy.arange(top, bottom)
+            ids = (y >= surface[:, None]).astype(numpy.intp) + (y >= rock[:, None])
+            states = [Terraria.TileState(), Terraria.TileState(active=True, tile_type=0),
+                      Terraria.TileState(active=True, tile_type=1)]
+
+            self.world.map.paste(states, ids, x_start, top)
+
+        return surface
+
+    @generation_pass
+    def carve_caves(self, fill=0.45, iterations=4, x_start=0, x_end=None):
+        """
+        Carves caves between the rock layer and the underworld in columns (x_start) to (x_end). Every tile starts out
+        open with chance (fill), then (iterations) rounds of a cellular automaton smooth the noise into caves: a tile
+        turns solid with 5 or more solid neighbours and stays solid with 4. Neighbour counts for the whole band are
+        array sums, and the caves are cleared to air in one bulk write.
+        :param fill:
+        :param iterations:
+        :param x_start:
+        :param x_end:
+        :return: mask of the carved tiles, indexed [x, y] from (x_start) and the rock layer
+        """
+        if x_end is None:
+            x_end = self.world.header.x_tiles
+
+        y_start = int(self.world.header.rock_layer)
+        y_end = self.underworld_level()
+        rows = max(y_end - y_start, 0)
+
+        # A tile depends on the starting noise up to (iterations) columns away, so that much is drawn on each side.
+        # Drawing whole strips from their own streams keeps the noise the same however the columns are split up.
+        low = max(x_start - iterations, 0)
+        high = min(x_end + iterations, self.world.header.x_tiles)
+
+        solid = numpy.empty((high - low, rows), dtype=bool)
+        for strip, strip_start, strip_end in self.strips(low, high):
+            noise = self.stream('carve_caves', strip).random((strip_end - strip_start, rows)) >= fill
+
+            start = max(strip_start, low)
+            end = min(strip_end, high)
+            solid[start - low:end - low] = noise[start - strip_start:end - strip_start]
+
+        for i in range(0, iterations):
+            # Outside the band counts as solid. Sums over 3 columns, then 3 rows, give each 3x3 block.
+            padded = numpy.pad(solid, 1, constant_values=True).view(numpy.uint8)
+            columns = padded[:-2] + padded[1:-1] + padded[2:]
+            neighbours = columns[:, :-2] + columns[:, 1:-1] + columns[:, 2:] - solid
+
+            solid = (neighbours >= 5) | ((neighbours >= 4) & solid)
 
-        for x in range(0, self.world.header.x_tiles):
-            for y in range(self.world.header.surface_level, 1000):
-                self.world.map.map[x][y] = dirt.clone()
+        caves = ~solid[x_start - low:x_end - low]
+        self.world.map.apply_mask(caves, x_start, y_start, Terraria.TileState())
+
+        return caves
+
+    @generation_pass(margin=None)
+    def pour_liquids(self, liquid_type=8, chance=0.1, max_iterations=1000, x_start=0, x_end=None):
+        """
+        Pours liquid of (liquid_type), 8 for water, 16 for lava and 24 for honey, into the caves between the rock
+        layer and the underworld in columns (x_start) to (x_end). Every open tile with ground below it fills up with
+        chance (chance), then settle_liquid lets it flow for at most (max_iterations) iterations, and the tiles whose
+        liquid changed are written in one bulk write. Liquid stays within the columns and flows around tiles that are
+        active or hold another liquid, so the pass needs the whole world at once to settle across it.
+        :param liquid_type:
+        :param chance:
+        :param max_iterations:
+        :param x_start:
+        :param x_end:
+        :return: number of iterations the liquid took to settle
+        """
+        if x_end is None:
+            x_end = self.world.header.x_tiles
+
+        x_start, x_end, y_start, y_end = self.world.map.clip_region(
+            x_start, x_end, int(self.world.header.rock_layer), self.underworld_level())
+        if x_start >= x_end or y_start >= y_end:
+            return 0
+
+        states, ids = self.world.map.map.get_region(x_start, x_end, y_start, y_end)
+        open_tiles = numpy.array([not state.active and state.liquid_type in (0, liquid_type) for state in states])
+        liquid = numpy.array([(state.liquid_amount or 0) if state.liquid_type == liquid_type else 0
+                              for state in states], dtype=numpy.int16)
+
+        open_tiles = open_tiles[ids]
+        amount = liquid[ids]
+        before = amount.copy()
+
+        ground = open_tiles.copy()
+        ground[:, :-1] &= ~open_tiles[:, 1:]
+
+        for strip, strip_start, strip_end in self.strips(x_start, x_end):
+            random_stream = self.stream('pour_liquids %i' % liquid_type, strip)
+            noise = random_stream.random((strip_end - strip_start, y_end - y_start))
+
+            start = max(strip_start, x_start)
+            end = min(strip_end, x_end)
+            pour = ground[start - x_start:end - x_start] & (noise[start - strip_start:end - strip_start] < chance)
+            amount[start - x_start:end - x_start][pour] = 255
+
+        iterations = settle_liquid(amount, open_tiles, max_iterations)
+
+        changed = amount != before
+        if changed.any():
+            # One state per distinct pair of old state and new amount.
+            pairs, new_ids = numpy.unique(ids[changed] * 256 + amount[changed], return_inverse=True)
+            new_states = [states[pair // 256].replace(liquid_type=liquid_type if pair % 256 else 0,
+                                                      liquid_amount=int(pair % 256) or None) for pair in pairs]
+
+            region = numpy.zeros(ids.shape, dtype=numpy.intp)
+            region[changed] = new_ids.reshape(-1)
+            self.world.map.paste(new_states, region, x_start, y_start, changed)
+
+        return iterations
 
     @staticmethod
-    def should_spawn_ore(n, density, total):
+    def ore_spawn_chance(n, density, total):
         """
-        Returns a boolean on if an ore cluster should be spawned.
-        :param n: Tile number in x column
+        Returns the chance that an ore cluster starts at a tile, growing with its depth below the surface.
+        :param n: Tile number in x column, a number or an array of them
         :param density:
         :param total:
         :return:
         """
 
-        percent = ((n * density) / total) / 100
+        return ((n * density) / total) / 100
+
+    @staticmethod
+    def should_spawn_ore(n, density, total, random_stream=None):
+        """
+        Returns a boolean on if an ore cluster should be spawned, with the chance given by ore_spawn_chance.
+        :param n: Tile number in x column
+        :param density:
+        :param total:
+        :param random_stream: generator to draw from, a fresh one that is not seeded if None
+        :return:
+        """
+        if random_stream is None:
+            random_stream = numpy.random.default_rng()
 
-        return random.random() < percent
+        return random_stream.random() < WorldGenerator.ore_spawn_chance(n, density, total)
 
-    def spawn_ore(self, ore_type, density):
+    @generation_pass(margin=ore_margin)
+    def spawn_ore(self, ore_type, density, x_start=0, x_end=None):
         """
-        Spawns ore across the world.
+        Spawns ore across the world, or only the clusters that start in columns (x_start) to (x_end). Every tile in the
+        band below the surface starts a cluster with the chance given by ore_spawn_chance. Each strip draws its
+        clusters at once from its own stream and writes them in a single bulk write, clusters can spill into the
+        strips around it.
         :param ore_type:
         :param density:
+        :param x_start:
+        :param x_end:
         :return:
         """
+        if x_end is None:
+            x_end = self.world.header.x_tiles
+
         y_start = self.world.header.surface_level
-        y_end = 1000  # TODO: Change. Temp Value.
-        total = y_end - y_start
+        y_end = self.underworld_level()
+        total = max(y_end - y_start, 0)
+
+        tile = Terraria.TileState(active=True, tile_type=ore_type)
+
+        percent = self.ore_spawn_chance(numpy.arange(0, total), density, total)
 
-        tile = Terraria.Tile()
-        tile.active = True
-        tile.tile_type = ore_type
+        for strip, strip_start, strip_end in self.strips(x_start, x_end):
+            random_stream = self.stream('spawn_ore %i' % ore_type, strip)
 
-        for x in range(0, self.world.header.x_tiles):
-            for y in range(y_start, y_end):
-                n = y - y_start
+            # The whole strip is drawn even if only part of it is spawned, so every part gets the same clusters.
+            x, n = numpy.nonzero(random_stream.random((strip_end - strip_start, total)) < percent)
+            x += strip_start
 
-                if self.should_spawn_ore(n, density, total):
-                    print('Ore at: %s, %s' % (x, y))
+            ore_size = random_stream.integers(30, 50, len(x))
 
-                    ore_size = random.choice(range(30, 50))
+            mask, left, top = self.ore_cluster_mask(x, y_start + n, ore_size, random_stream,
+                                                    (x >= x_start) & (x < x_end))
+            if mask is not None:
+                self.world.map.apply_mask(mask, left, top, tile)
 
-                    self.add_ore_cluster(x, y, ore_size, tile)
+    def ore_cluster_mask(self, x, y, size, random_stream=None, keep=None):
+        """
+        Lays out ore clusters of (size) tiles at (x, y), three arrays with one entry per cluster, each a cached
+        ore_cluster_rows layout with a wiggle drawn from (random_stream), self.random if None. Returns the union of the
+        clusters, or of those where (keep) is set, as a boolean mask indexed [x, y] with the position of its corner, or
+        None for the mask if there are no tiles in the world.
+        :param x:
+        :param y:
+        :param size:
+        :param random_stream:
+        :param keep:
+        :return: mask, left, top
+        """
+        if random_stream is None:
+            random_stream = self.random
+
+        count = len(size)
+
+        a = (size / (random_stream.random(count) + 2)).astype(int)
+        size_x = numpy.where(random_stream.random(count) < 0.5, a, size - a)
+        size_y = size - size_x
+
+        # Clusters of the same shape share the cached row layout of ore_cluster_rows.
+        shapes, shape = numpy.unique(numpy.stack([size_x, size_y], axis=1), axis=0, return_inverse=True)
+        shape = shape.reshape(-1)
+        layouts = [ore_cluster_rows(shape_x, shape_y) for shape_x, shape_y in shapes.tolist()]
+        rows, offsets, counts = [numpy.concatenate(arrays) for arrays in zip(*layouts)] if layouts else \
+            [numpy.zeros(0, dtype=int)] * 3
+        shape_rows = numpy.array([len(layout[0]) for layout in layouts], dtype=int)
+        shape_firsts = numpy.cumsum(shape_rows) - shape_rows
+        row_counts = shape_rows[shape]
+
+        # Every row is shifted by a wiggle that drifts from row to row within each cluster.
+        firsts = numpy.cumsum(row_counts) - row_counts
+        adj = random_stream.integers(-2, 3, row_counts.sum())
+        wiggle = numpy.cumsum(adj)
+        drawn = row_counts > 0
+        wiggle -= numpy.repeat((wiggle - adj)[firsts[drawn]], row_counts[drawn])
+
+        # One entry per row of every cluster that is kept, with its row in the layout and its wiggle.
+        clusters = numpy.arange(0, count) if keep is None else numpy.flatnonzero(keep)
+        kept_rows = row_counts[clusters]
+        cluster = numpy.repeat(clusters, kept_rows)
+        within = numpy.arange(0, len(cluster)) - numpy.repeat(numpy.cumsum(kept_rows) - kept_rows, kept_rows)
+        row = shape_firsts[shape[cluster]] + within
+
+        row_x = x[cluster] + offsets[row] + wiggle[firsts[cluster] + within]
+        row_y = y[cluster] + rows[row]
+        num_tiles = counts[row]
+
+        tile_x = numpy.repeat(row_x, num_tiles) + numpy.arange(0, num_tiles.sum()) - \
+            numpy.repeat(numpy.cumsum(num_tiles) - num_tiles, num_tiles)
+        tile_y = numpy.repeat(row_y, num_tiles)
+
+        inside = (tile_x >= 0) & (tile_x < self.world.header.x_tiles) & (tile_y >= 0) & \
+            (tile_y < self.world.header.y_tiles)
+        tile_x = tile_x[inside]
+        tile_y = tile_y[inside]
+
+        if len(tile_x) == 0:
+            return None, 0, 0
+
+        left = tile_x.min()
+        top = tile_y.min()
+        mask = numpy.zeros((tile_x.max() + 1 - left, tile_y.max() + 1 - top), dtype=bool)
+        mask[tile_x - left, tile_y - top] = True
+
+        return mask, int(left), int(top)
 
     def add_ore_cluster(self, x, y, size, tile):
         """
-        Spawns an ore cluster at x, y location
+        Spawns an ore cluster at x, y location, drawing its shape from self.random
         :param x:
         :param y:
         :param size:
-        :param tile:
+        :param tile: Tile or TileState, copied into every cell of the cluster
         :return:
         """
-        map = self.world.map.map
-
-        a = int(size / (random.random() + 2))
-
-        if random.choice([True, False]):
-            size_x = a
-            size_y = size - a
-        else:
-            size_y = a
-            size_x = size - a
-
-        wiggle = 0
+        mask, left, top = self.ore_cluster_mask(numpy.array([x]), numpy.array([y]), numpy.array([size]))
 
-        # For every row in the ore cluster area
-        for i in range(0, size_y):  # i stands for y
+        # Wiggles give every cluster its own shape, so there is no Stencil to reuse. A single state under a mask is
+        # written by apply_mask, which needs no ids array and leaves uniform chunks uniform.
+        if mask is not None:
+            self.world.map.apply_mask(mask, left, top, tile)
 
-            # Selects the number of tiles that should be generated for the cluster
-            center = int(size_y / 2)
-            num_tiles = size_x - int(((i - center) ** 2) / 5)
-
-            if num_tiles <= 0:
-                continue
-
-            # Generate a list with True to generate a tile and False to not.
-            half_non_tiles = int((size_x - num_tiles) / 2)
-            tile_list = [False] * half_non_tiles + [True] * num_tiles + [False] * (size_x - num_tiles - half_non_tiles)
-
-            # Shift the tiles
-            adj = random.choice(range(-2, 3))
-            wiggle += adj
-
-            for j in range(0, size_x):  # j stands for x
-                if tile_list[j]:
-                    b = x + j + wiggle
-                    c = y + i
-
-                    if b >= self.world.header.x_tiles or b < 0:
-                        continue
-
-                    if c >= self.world.header.y_tiles or c < 0:
-                        continue
-
-                    map[b][c] = tile.clone()
+    def stamp(self, stencil, x, y):
+        """
+        Writes (stencil) into the map with its top left corner at (x, y). The stencil is clipped to the map once, tiles
+        outside it are skipped.
+        :param stencil:
+        :param x:
+        :param y:
+        :return:
+        """
+        self.world.map.paste(stencil.states, stencil.ids, x, y, stencil.mask)
 
     def add_chest(self, x, y):
         """
@@ -146,27 +657,7 @@ class WorldGenerator():
 
         self.world.chests.chests.append(chest)
 
-        chest_tiles = [Terraria.Tile(), Terraria.Tile(), Terraria.Tile(), Terraria.Tile()]
-
-        for tile in chest_tiles:
-            tile.active = True
-            tile.tile_type = 21
-
-        chest_tiles[0].u = 612
-        chest_tiles[0].v = 0
-        self.world.map.map[x][y] = chest_tiles[0]
-
-        chest_tiles[1].u = 630
-        chest_tiles[1].v = 0
-        self.world.map.map[x + 1][y] = chest_tiles[1]
-
-        chest_tiles[2].u = 612
-        chest_tiles[2].v = 18
-        self.world.map.map[x][y + 1] = chest_tiles[2]
-
-        chest_tiles[3].u = 630
-        chest_tiles[3].v = 18
-        self.world.map.map[x + 1][y + 1] = chest_tiles[3]
+        self.stamp(frame_stencil(21, 612, 0), x, y)
 
         self.world.chests.total_chests += 1
 
@@ -182,7 +673,7 @@ class WorldGenerator():
         :param tile_type:
         :return:
         """
-        if tile_type != 55 or tile_type != 85:
+        if tile_type != 55 and tile_type != 85:
             raise WorldGenerationException('Invalid tile type for sign creation: %s' % tile_type)
 
         sign = Terraria.Sign()
@@ -194,11 +685,6 @@ class WorldGenerator():
         self.world.signs.signs.append(sign)
         self.world.signs.total_signs += 1
 
-        sign_tiles = [Terraria.Tile(), Terraria.Tile(), Terraria.Tile(), Terraria.Tile()]
-        for s_tile in sign_tiles:
-            s_tile.active = True
-            s_tile.tile_type = tile_type
-
         if tile_type == 85:
             u = 180
             v = 0
@@ -206,20 +692,142 @@ class WorldGenerator():
             u = 0
             v = 0
 
-        sign_tiles[0].u = u
-        sign_tiles[0].v = v
-        self.world.map.map[x][y] = sign_tiles[0]
+        self.stamp(frame_stencil(tile_type, u, v), x, y)
 
-        sign_tiles[1].u = u + 18
-        sign_tiles[1].v = v
-        self.world.map.map[x + 1][y] = sign_tiles[1]
+        return sign
 
-        sign_tiles[2].u = u
-        sign_tiles[2].v = v + 18
-        self.world.map.map[x][y + 1] = sign_tiles[2]
 
-        sign_tiles[3].u = u + 18
-        sign_tiles[3].v = v + 18
-        self.world.map.map[x + 1][y + 1] = sign_tiles[3]
+class Stage():
+    """
+    A generation pass in a GenerationPipeline: the WorldGenerator method (name) called with (args). A pass that runs
+    on strips of the world takes x_start and x_end keywords and reads and writes at most (margin) columns beyond
+    them. A (margin) of None marks a pass that needs the whole world at once. The margin defaults to the one the
+    pass declares with generation_pass, and to None for methods that declare none.
+    """
 
-        return sign
\ No newline at end of file
+    def __init__(self, name, args=(), **kwargs):
+        """
+        Initializes the Stage
+        :param name:
+        :param args:
+        :param kwargs: margin
+        :return:
+        """
+        self.name = name
+        self.args = tuple(args)
+        self.margin = kwargs.pop('margin', getattr(getattr(WorldGenerator, name), 'margin', None))
+
+        if kwargs:
+            raise TypeError('Unknown stage options: %s' % ', '.join(sorted(kwargs)))
+
+
+class GenerationPipeline():
+    """
+    Runs the stages of a world generation in order, each one split into x-strips that a pool of worker processes
+    generates straight into a shared memory map. Strips are at least twice the margin of their stage wide, and the
+    even strips run before the odd ones, so strips that run at the same time never touch the same columns. Passes
+    have to give the same tiles however their columns are split up, as those of WorldGenerator do.
+    """
+
+    def __init__(self, generator, processes=None):
+        """
+        Initializes the Pipeline
+        :param generator: WorldGenerator whose world and seed are used
+        :param processes: number of worker processes, stages run in this process if None or 1
+        :return:
+        """
+        self.generator = generator
+        self.processes = processes
+        self.stages = []
+
+    def add_stage(self, name, *args, **kwargs):
+        """
+        Adds a Stage calling WorldGenerator method (name) with (args), see Stage for the margin keyword.
+        :param name:
+        :param args:
+        :param kwargs: margin
+        :return: stage
+        :return type: Stage
+        """
+        stage = Stage(name, args, **kwargs)
+
+        self.stages.append(stage)
+
+        return stage
+
+    def strips(self, stage):
+        """
+        Returns the strips (stage) is split into, as lists of (x_start, x_end) for the even and for the odd strips.
+        :param stage:
+        :return: even strips, odd strips
+        """
+        width = WorldGenerator.strip_width
+        width *= max(1, -(-2 * stage.margin // width))
+        x_tiles = self.generator.world.header.x_tiles
+
+        strips = [(x, min(x + width, x_tiles)) for x in range(0, x_tiles, width)]
+
+        return strips[0::2], strips[1::2]
+
+    def run(self):
+        """
+        Runs every stage in order. Worlds whose map is not kept in a ColumnarTileStore, and stages with a margin of
+        None, run in this process. The Instrumentation of the generator, if any, records every stage as a whole.
+        :return:
+        """
+        world = self.generator.world
+        parallel = self.processes is not None and self.processes > 1 and \
+            isinstance(world.map.map, Terraria.ColumnarTileStore)
+
+        if not parallel:
+            for stage in self.stages:
+                getattr(self.generator, stage.name)(*stage.args)
+            return
+
+        name = world.map.map.share()
+
+        with ProcessPoolExecutor(self.processes) as pool:
+            for stage in self.stages:
+                if stage.margin is None:
+                    getattr(self.generator, stage.name)(*stage.args)
+                    continue
+
+                with Terraria.measure_section(self.generator.instrumentation, 'generate', stage.name) as record:
+                    for strips in self.strips(stage):
+                        count = len(strips)
+                        for result in pool.map(_run_stage_strip, [name] * count, [world.map.x_tiles] * count,
+                                               [world.map.y_tiles] * count, [world.header] * count,
+                                               [world.tile_importance] * count, [self.generator.seed] * count,
+                                               [stage] * count, strips):
+                            pass  # The workers write into the shared map, this only surfaces their exceptions.
+
+                if record is not None:
+                    record['counts'] = {'tiles': world.map.x_tiles * world.map.y_tiles,
+                                        'strips': sum(len(strips) for strips in self.strips(stage))}
+
+                world.map.map.mark_dirty(0, world.map.x_tiles)
+
+
+def _run_stage_strip(name, x_tiles, y_tiles, header, tile_importance, seed, stage, strip):
+    """
+    Worker process side of GenerationPipeline.run. Runs (stage) on columns (strip) of the shared map named (name).
+    :param name:
+    :param x_tiles:
+    :param y_tiles:
+    :param header:
+    :param tile_importance:
+    :param seed:
+    :param stage:
+    :param strip:
+    :return:
+    """
+    world = Terraria.World()
+    world.header = header
+    world.tile_importance = tile_importance
+    world.map = Terraria.Map(tile_importance, 0, 0)
+    world.map.x_tiles = x_tiles
+    world.map.y_tiles = y_tiles
+    world.map.map = Terraria.ColumnarTileStore(x_tiles, y_tiles, attach=name)
+
+    x_start, x_end = strip
+    getattr(WorldGenerator(world, seed), stage.name)(*stage.args, x_start=x_start, x_end=x_end)
\ No newline at end of file